@@ -1,14 +1,15 @@
 from flask import Flask
 from app.config import load_configurations, configure_logging
-from .views import webhook_blueprint
-import logging
-import sys
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+from .views import webhook_blueprint, metrics_blueprint, admin_blueprint
+from .services.webhook_queue import init_webhook_queue
+from .services.greenapi_client import init_greenapi_client
+from .services.outbound_dispatcher import init_outbound_dispatcher
+from .services.openai_service import init_openai_service, get_state_store, warm_mode_cache
+from .services.message_dedup import init_message_dedup
+from .services.message_debouncer import init_message_debouncer
+from .utils.whatsapp_utils import respond_to_message
+from .utils.tracing import init_tracing
+from .utils.profiler import init_profiler
 
 def create_app():
     app = Flask(__name__)
@@ -19,7 +20,35 @@ def create_app():
     # Load configurations
     load_configurations(app)
 
+    # Per-request tracing and the sampling profiler (both off unless enabled)
+    init_tracing(app)
+    init_profiler(app)
+
+    # Shared GreenAPI client with a keep-alive connection pool
+    greenapi_client = init_greenapi_client(app)
+
+    # Rate-limited outbound queue (only with OUTBOUND_ASYNC)
+    init_outbound_dispatcher(app, greenapi_client)
+
+    # State store, catalog and OpenAI client (nothing is created at import time)
+    init_openai_service()
+
+    # Skip redelivered webhooks by idMessage (optionally shared through the state DB)
+    init_message_dedup(app, get_state_store())
+
+    # Merge bursts of messages from one chat into one turn (only with DEBOUNCE_MS)
+    init_message_debouncer(app, respond_to_message)
+
     # Register blueprints
     app.register_blueprint(webhook_blueprint)
+    app.register_blueprint(metrics_blueprint)
+    app.register_blueprint(admin_blueprint)
+
+    # Preload chat modes of recently active users
+    if app.config["MODE_CACHE_WARMUP"]:
+        warm_mode_cache()
+
+    # Start the webhook worker pool (only with WEBHOOK_ASYNC)
+    init_webhook_queue(app)
 
     return app
\ No newline at end of file
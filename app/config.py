@@ -4,7 +4,8 @@ import sys
 import os
 from dotenv import load_dotenv
 import logging
-from logging.handlers import RotatingFileHandler
+
+from app.utils.logs import setup_logging
 
 def load_configurations(app):
     """
@@ -18,6 +19,50 @@ def load_configurations(app):
     app.config["MANAGER_WAID"] = os.getenv("MANAGER_WAID")  # Added MANAGER_WAID
     app.config["GREENAPI_IDINSTANCE"] = os.getenv("GREENAPI_IDINSTANCE")
     app.config["GREENAPI_APITOKEN"] = os.getenv("GREENAPI_APITOKEN")
+    app.config["GREENAPI_API_URL"] = os.getenv("GREENAPI_API_URL", "https://api.green-api.com")
+    app.config["GREENAPI_CONNECT_TIMEOUT"] = float(os.getenv("GREENAPI_CONNECT_TIMEOUT", "3.05"))
+    app.config["GREENAPI_READ_TIMEOUT"] = float(os.getenv("GREENAPI_READ_TIMEOUT", "10"))
+    app.config["GREENAPI_RETRIES"] = int(os.getenv("GREENAPI_RETRIES", "3"))
+
+    # Асинхронная обработка вебхуков: ответ 200 сразу, обработка в пуле потоков
+    app.config["WEBHOOK_ASYNC"] = os.getenv("WEBHOOK_ASYNC", "false").lower() in ("1", "true", "yes")
+    app.config["WEBHOOK_WORKERS"] = int(os.getenv("WEBHOOK_WORKERS", "4"))
+    app.config["WEBHOOK_QUEUE_SIZE"] = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))
+    app.config["WEBHOOK_DRAIN_TIMEOUT"] = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # секунд
+
+    # Очередь исходящих сообщений с ограничением темпа под тариф GreenAPI
+    app.config["OUTBOUND_ASYNC"] = os.getenv("OUTBOUND_ASYNC", "false").lower() in ("1", "true", "yes")
+    app.config["OUTBOUND_RATE"] = float(os.getenv("OUTBOUND_RATE", "1"))  # сообщений в секунду
+    app.config["OUTBOUND_BURST"] = float(os.getenv("OUTBOUND_BURST", "5"))
+    app.config["OUTBOUND_WORKERS"] = int(os.getenv("OUTBOUND_WORKERS", "2"))
+    app.config["OUTBOUND_QUOTA_PAUSE"] = float(os.getenv("OUTBOUND_QUOTA_PAUSE", "60"))  # секунд
+    app.config["OUTBOUND_MAX_PER_CHAT"] = int(os.getenv("OUTBOUND_MAX_PER_CHAT", "20"))
+    app.config["OUTBOUND_DRAIN_TIMEOUT"] = float(os.getenv("OUTBOUND_DRAIN_TIMEOUT", "10"))  # секунд
+
+    # Склейка серии сообщений одного чата в один ход (0 — выключено)
+    app.config["DEBOUNCE_MS"] = float(os.getenv("DEBOUNCE_MS", "0"))
+    app.config["DEBOUNCE_MAX_WAIT_MS"] = float(os.getenv("DEBOUNCE_MAX_WAIT_MS", "5000"))
+    app.config["DEBOUNCE_WORKERS"] = int(os.getenv("DEBOUNCE_WORKERS", "4"))
+
+    # Пропуск повторно доставленных вебхуков по idMessage
+    app.config["DEDUP_ENABLED"] = os.getenv("DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+    app.config["DEDUP_WINDOW"] = float(os.getenv("DEDUP_WINDOW", "600"))  # секунд
+    app.config["DEDUP_MAX_IDS"] = int(os.getenv("DEDUP_MAX_IDS", "100000"))
+    # Хранить принятые idMessage ещё и в базе состояния (общей для всех процессов)
+    app.config["DEDUP_PERSISTENT"] = os.getenv("DEDUP_PERSISTENT", "false").lower() in ("1", "true", "yes")
+
+    # Трассировка запросов: строка в лог на каждый вебхук с временем этапов
+    app.config["TRACING_ENABLED"] = os.getenv("TRACING_ENABLED", "false").lower() in ("1", "true", "yes")
+    app.config["TRACE_SLOW_MS"] = float(os.getenv("TRACE_SLOW_MS", "0"))  # писать только трассы медленнее
+    # Семплирующий профилировщик (свёрнутые стеки для flame graph)
+    app.config["PROFILER_ENABLED"] = os.getenv("PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+    app.config["PROFILER_INTERVAL_MS"] = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+    app.config["PROFILER_OUTPUT"] = os.getenv("PROFILER_OUTPUT", "profile.folded")
+    # Токен для служебных маршрутов /admin/* (без токена они выключены)
+    app.config["ADMIN_TOKEN"] = os.getenv("ADMIN_TOKEN")
+
+    # Прогрев кеша режимов чата при старте
+    app.config["MODE_CACHE_WARMUP"] = os.getenv("MODE_CACHE_WARMUP", "true").lower() in ("1", "true", "yes")
 
     # Validate essential configurations
     validate_configurations(app)
@@ -35,29 +80,18 @@ def validate_configurations(app):
     missing_configs = [key for key in essential_configs if not app.config.get(key)]
     if missing_configs:
         missing = ", ".join(missing_configs)
-        logging.critical(f"Missing essential configuration(s): {missing}")
+        logging.getLogger(__name__).critical("Missing essential configuration(s): %s", missing)
         sys.exit(1)  # Exit the application if configurations are missing
 
 def configure_logging():
     """
-    Настройка логирования без дублирования.
+    Единая настройка логирования: очередь и поток вывода, JSON-записи,
+    уровни по модулям (см. app/utils/logs.py). Настройки — из окружения и .env.
     """
-    logger = logging.getLogger()
-
-    # Удаляем все существующие обработчики перед настройкой
-    for handler in logger.handlers[:]:
-        logger.removeHandler(handler)
-
-    logger.setLevel(logging.INFO)
-
-    # Обработчик для логов в файл
-    file_handler = RotatingFileHandler('app.log', maxBytes=10*1024*1024, backupCount=5, delay=True)
-    file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(file_formatter)
-    logger.addHandler(file_handler)
-
-    # Обработчик для вывода в консоль
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    stream_handler.setFormatter(stream_formatter)
-    logger.addHandler(stream_handler)
+    load_dotenv()
+    setup_logging(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        levels=os.getenv("LOG_LEVELS", ""),
+        fmt=os.getenv("LOG_FORMAT", "json").lower(),
+        log_file=os.getenv("LOG_FILE", "app.log") or None,
+    )
@@ -4,6 +4,8 @@ import logging
 import hashlib
 import hmac
 
+logger = logging.getLogger(__name__)
+
 
 def validate_signature(payload, signature):
     """
@@ -12,7 +14,7 @@ def validate_signature(payload, signature):
     """
     app_secret = current_app.config.get("APP_SECRET")
     if not app_secret:
-        logging.warning("APP_SECRET not set; skipping signature validation.")
+        logger.warning("APP_SECRET not set; skipping signature validation.")
         return True  # Skip signature check if no secret is configured
 
     expected_signature = hmac.new(
@@ -36,8 +38,32 @@ def signature_required(f):
             7:
         ]  # Removing 'sha256='
         if not validate_signature(request.data.decode("utf-8"), signature):
-            logging.info("Signature verification failed!")
+            logger.info("Signature verification failed!")
             return jsonify({"status": "error", "message": "Invalid signature"}), 403
         return f(*args, **kwargs)
 
     return decorated_function
+
+
+def admin_token_required(f):
+    """
+    Decorator for service routes: the request must carry the ADMIN_TOKEN value
+    in the X-Admin-Token header or as "Authorization: Bearer <token>" (the form
+    Prometheus uses for scraping). Without a configured token the routes are disabled.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        admin_token = current_app.config.get("ADMIN_TOKEN")
+        if not admin_token:
+            return jsonify({"status": "error", "message": "Not found"}), 404
+        token = request.headers.get("X-Admin-Token", "")
+        authorization = request.headers.get("Authorization", "")
+        if not token and authorization.startswith("Bearer "):
+            token = authorization[7:]
+        if not hmac.compare_digest(token, admin_token):
+            logger.info("Admin token verification failed!")
+            return jsonify({"status": "error", "message": "Invalid admin token"}), 403
+        return f(*args, **kwargs)
+
+    return decorated_function
@@ -0,0 +1,259 @@
+import heapq
+import math
+import string
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from rapidfuzz import process, fuzz
+
+# ---------------------------
+# Поисковый индекс каталога
+# ---------------------------
+# Строится один раз на каждую загрузку каталога. Названия и бренды заранее
+# приведены к нижнему регистру, одинаковые названия схлопнуты (один товар
+# обычно есть и во флаконе, и на разлив), а fuzzy-оценка считается пакетно
+# в rapidfuzz только по уникальным строкам. Результаты совпадают с прежним
+# линейным перебором: везде берётся первый подходящий товар в порядке каталога.
+
+# Разделитель для склеенных строк: в тексте сообщений и таблицы его не бывает
+_SEP = "\x00"
+
+_PUNCTUATION = str.maketrans('', '', string.punctuation)
+# Ключ конца бренда в узле префиксного дерева (слова не бывают пустыми)
+_TERMINAL = ""
+# Вес слова при подборе товаров для GPT в зависимости от поля, где оно встретилось
+_FIELD_WEIGHTS = (("name", 3.0), ("brand", 2.0), ("description", 1.0))
+
+
+def normalize_text(text: str) -> str:
+    """Нижний регистр без знаков препинания — как в extract_brand_from_message."""
+    return str(text).lower().translate(_PUNCTUATION).strip()
+
+
+class BrandMatcher:
+    """
+    Поиск бренда в сообщении. Быстрый путь — префиксное дерево по словам
+    брендов: за один проход по словам сообщения находится самое длинное
+    точное вхождение ("giorgio armani" предпочтительнее "armani").
+    Если точного вхождения нет, бренд подбирается fuzzy-сравнением.
+    """
+
+    def __init__(self, brands: Iterable[str]):
+        self.brands = list(dict.fromkeys(b for b in brands if b))
+        self.brand_keys = [b.lower() for b in self.brands]
+        self._trie: dict = {}
+        for brand in self.brands:
+            tokens = normalize_text(brand).split()
+            if not tokens:
+                continue
+            node = self._trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node.setdefault(_TERMINAL, brand)
+
+    def exact(self, tokens: List[str]) -> Optional[str]:
+        best, best_len = None, 0
+        for start in range(len(tokens)):
+            node = self._trie
+            for pos in range(start, len(tokens)):
+                node = node.get(tokens[pos])
+                if node is None:
+                    break
+                brand = node.get(_TERMINAL)
+                if brand is not None and pos - start + 1 > best_len:
+                    best, best_len = brand, pos - start + 1
+        return best
+
+    def fuzzy(self, message_clean: str, score_cutoff: float) -> Optional[str]:
+        best = process.extractOne(message_clean, self.brand_keys, scorer=fuzz.token_set_ratio, score_cutoff=score_cutoff)
+        return self.brands[best[2]] if best else None
+
+    def match(self, message_clean: str, score_cutoff: float = 60) -> Optional[str]:
+        return self.exact(message_clean.split()) or self.fuzzy(message_clean, score_cutoff)
+
+
+class _NameGroup:
+    """Уникальные названия части каталога и первый товар для каждого из них."""
+
+    def __init__(self, names: List[str], indices: List[int]):
+        self.names: List[str] = []
+        self.first: List[int] = []
+        seen: Dict[str, int] = {}
+        for name, idx in zip(names, indices):
+            if name not in seen:
+                seen[name] = len(self.names)
+                self.names.append(name)
+                self.first.append(idx)
+        self.position = seen
+
+
+class CatalogIndex:
+    def __init__(self, products: List[dict]):
+        self.products = products
+        self.names = [str(p.get("name", "")).lower() for p in products]
+        self.brands = [str(p.get("brand", "")).lower() for p in products]
+
+        # Склеенные строки для поиска подстроки за один вызов str.find
+        self._names_blob, self._names_starts = self._build_blob(self.names)
+        self._brands_blob, self._brands_starts = self._build_blob(self.brands)
+
+        # Уникальные названия: по всему каталогу и отдельно по типам товара
+        self.all_names = _NameGroup(self.names, list(range(len(products))))
+        self.names_by_type: Dict[str, _NameGroup] = {}
+        for product_type in {p.get("type") for p in products}:
+            indices = [i for i, p in enumerate(products) if p.get("type") == product_type]
+            self.names_by_type[product_type] = _NameGroup([self.names[i] for i in indices], indices)
+
+        # Бренд (в нижнем регистре) -> номера товаров в порядке каталога
+        self.by_brand: Dict[str, List[int]] = {}
+        for i, brand in enumerate(self.brands):
+            self.by_brand.setdefault(brand, []).append(i)
+        self.brand_keys = list(self.by_brand)
+
+        # Инвертированный индекс: слово названия -> уникальные названия
+        self.tokens: Dict[str, List[int]] = {}
+        for pos, name in enumerate(self.all_names.names):
+            for token in set(name.split()):
+                self.tokens.setdefault(token, []).append(pos)
+
+        self.brand_matcher = BrandMatcher(str(p.get("brand", "")).strip() for p in products)
+
+        self.spilled_names = {self.names[i] for i, p in enumerate(products) if p.get("type") == "spilled"}
+
+        # Подбор товаров для GPT: слово -> [(номер товара, вес)], вес зависит от поля
+        self._terms: Dict[str, List[Tuple[int, float]]] = {}
+        for i, product in enumerate(products):
+            weights: Dict[str, float] = {}
+            for field, weight in _FIELD_WEIGHTS:
+                for term in normalize_text(product.get(field, "")).split():
+                    if len(term) > 1 and weights.get(term, 0) < weight:
+                        weights[term] = weight
+            for term, weight in weights.items():
+                self._terms.setdefault(term, []).append((i, weight))
+        self._vocabulary = list(self._terms)
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    @staticmethod
+    def _build_blob(values: List[str]) -> Tuple[str, List[int]]:
+        starts = []
+        offset = 0
+        for value in values:
+            starts.append(offset)
+            offset += len(value) + 1
+        return _SEP.join(values), starts
+
+    @staticmethod
+    def _blob_find(blob: str, starts: List[int], query: str) -> Optional[int]:
+        pos = blob.find(query)
+        if pos < 0:
+            return None
+        return bisect_right(starts, pos) - 1
+
+    def find_substring(self, query: str) -> Optional[dict]:
+        """Первый товар, в названии или бренде которого встречается query."""
+        if not self.products:
+            return None
+        if _SEP in query:
+            return next((p for p, n, b in zip(self.products, self.names, self.brands) if query in n or query in b), None)
+        hits = [
+            i for i in (
+                self._blob_find(self._names_blob, self._names_starts, query),
+                self._blob_find(self._brands_blob, self._brands_starts, query),
+            )
+            if i is not None
+        ]
+        return self.products[min(hits)] if hits else None
+
+    def candidate_names(self, text: str) -> List[int]:
+        """Уникальные названия, у которых есть общее слово с text."""
+        positions = set()
+        for token in set(text.split()):
+            positions.update(self.tokens.get(token, ()))
+        return sorted(positions)
+
+    def best_name(self, query: str, product_type: Optional[str] = None,
+                  scorer=fuzz.token_sort_ratio) -> Optional[Tuple[str, float, dict]]:
+        """
+        То же, что process.extractOne по названиям товаров (с учётом типа),
+        но по уникальным названиям. Возвращает (название, оценка, первый товар).
+        """
+        group = self.all_names if product_type is None else self.names_by_type.get(product_type)
+        if group is None or not group.names:
+            return None
+
+        # Быстрый путь: оценка 100 означает совпадение набора слов, а такие
+        # названия обязательно есть среди кандидатов инвертированного индекса
+        if scorer is fuzz.token_sort_ratio:
+            for pos in self.candidate_names(query):
+                name = self.all_names.names[pos]
+                local = group.position.get(name)
+                if local is not None and scorer(query, name) == 100:
+                    # Кандидаты отсортированы по порядку появления, значит это первый максимум
+                    return name, 100.0, self.products[group.first[local]]
+
+        best = process.extractOne(query, group.names, scorer=scorer)
+        if best is None:
+            return None
+        name, score, local = best
+        return name, score, self.products[group.first[local]]
+
+    def first_similar_name(self, name: str, score_cutoff: float, scorer=fuzz.token_sort_ratio) -> Optional[dict]:
+        """Первый товар каталога, название которого похоже на name не меньше score_cutoff."""
+        matches = process.extract(name, self.all_names.names, scorer=scorer, score_cutoff=score_cutoff, limit=None)
+        if not matches:
+            return None
+        local = min(m[2] for m in matches)
+        return self.products[self.all_names.first[local]]
+
+    def products_by_brand(self, brand: str, score_cutoff: float, scorer=fuzz.token_set_ratio,
+                          product_type: Optional[str] = None) -> List[dict]:
+        """Товары (в порядке каталога), бренд которых похож на brand не меньше score_cutoff."""
+        matches = process.extract(brand.lower(), self.brand_keys, scorer=scorer, score_cutoff=score_cutoff, limit=None)
+        indices = sorted(i for m in matches for i in self.by_brand[m[0]])
+        return [
+            self.products[i] for i in indices
+            if product_type is None or self.products[i].get("type") == product_type
+        ]
+
+    def products_with_brand(self, brand: str, product_type: Optional[str] = None) -> List[dict]:
+        """Товары с точно таким брендом (без учёта регистра)."""
+        return [
+            self.products[i] for i in self.by_brand.get(brand.lower(), ())
+            if product_type is None or self.products[i].get("type") == product_type
+        ]
+
+    def relevant_products(self, text: str, limit: int, context: str = "", typo_cutoff: float = 80) -> List[dict]:
+        """
+        До limit товаров, лучше всего подходящих к text. Оценка — сумма весов
+        совпавших слов (название > бренд > описание), умноженных на IDF.
+        Слова с опечатками сопоставляются со словарём каталога через fuzz.ratio.
+        Слова из context (например, прошлых сообщений) весят вдвое меньше.
+        """
+        scores: Dict[int, float] = {}
+        for source, factor in ((text, 1.0), (context, 0.5)):
+            for term in set(normalize_text(source).split()):
+                if len(term) < 2:
+                    continue
+                postings = self._terms.get(term)
+                weight = factor
+                if postings is None:
+                    if len(term) < 4 or not self._vocabulary:
+                        continue
+                    best = process.extractOne(term, self._vocabulary, scorer=fuzz.ratio, score_cutoff=typo_cutoff)
+                    if best is None:
+                        continue
+                    postings = self._terms[best[0]]
+                    weight = factor * best[1] / 100
+                idf = math.log(1 + len(self.products) / len(postings))
+                for i, field_weight in postings:
+                    scores[i] = scores.get(i, 0.0) + field_weight * idf * weight
+
+        # При равной оценке выше товар, который раньше в каталоге
+        top = heapq.nsmallest(limit, scores, key=lambda i: (-scores[i], i))
+        return [self.products[i] for i in top]
+
+    def name_in_text(self, text: str) -> bool:
+        """Есть ли в тексте название какого-нибудь товара."""
+        return any(name in text for name in self.all_names.names)
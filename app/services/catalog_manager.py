@@ -0,0 +1,180 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, FrozenSet, List, Optional, Tuple
+
+from app.services.catalog_index import CatalogIndex
+from app.utils.metrics import CATALOG_REFRESH_SECONDS, ERRORS
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Снимки каталога
+# ---------------------------
+# Каталог публикуется целиком: товары, бренды и индексы собираются
+# в неизменяемый снимок вне обработки запросов и подменяются одним
+# присваиванием ссылки. Обработчик берёт снимок один раз в начале
+# и работает с ним до конца, поэтому не увидит новые товары вместе
+# со старым набором брендов.
+#
+# Последний удачный снимок вместе с готовыми индексами сохраняется на диск.
+# При старте процесс поднимает его за миллисекунды и сразу обслуживает
+# запросы, а свежая загрузка из Google Sheets идёт в фоне.
+
+# Меняется при изменении устройства CatalogIndex: старый файл тогда
+# используется только как список товаров, а индексы строятся заново
+SNAPSHOT_FORMAT = 2
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: int
+    products: Tuple[dict, ...]
+    brands: FrozenSet[str]
+    index: CatalogIndex
+    loaded_at: float
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+
+def build_snapshot(products: List[dict], version: int) -> CatalogSnapshot:
+    products = tuple(products)
+    brands = frozenset(p.get('brand', '') for p in products if p.get('brand', ''))
+    return CatalogSnapshot(
+        version=version,
+        products=products,
+        brands=brands,
+        index=CatalogIndex(list(products)),
+        loaded_at=time.time(),
+    )
+
+
+class CatalogManager:
+    """Хранит текущий снимок каталога и обновляет его из одного фонового потока."""
+
+    def __init__(self, loader: Callable[[], Optional[List[dict]]], interval: float = 300.0,
+                 snapshot_path: Optional[str] = None):
+        self._loader = loader
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self._snapshot = build_snapshot([], version=0)
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def current(self) -> CatalogSnapshot:
+        return self._snapshot
+
+    def publish(self, products: List[dict]) -> CatalogSnapshot:
+        with self._refresh_lock:
+            snapshot = build_snapshot(products, version=self._snapshot.version + 1)
+            self._snapshot = snapshot
+        return snapshot
+
+    def refresh(self) -> bool:
+        """
+        Загружает каталог и публикует новый снимок. При ошибке остаётся прежний.
+        Загрузчик возвращает None, если данные не менялись, — тогда снимок не пересобирается.
+        """
+        started = time.perf_counter()
+        try:
+            products = self._loader()
+        except Exception as e:
+            logger.error("Ошибка обновления каталога, остаётся версия %s: %s", self._snapshot.version, e)
+            ERRORS.inc("catalog_refresh")
+            CATALOG_REFRESH_SECONDS.observe(time.perf_counter() - started, "error")
+            return False
+        if products is None:
+            logger.info("Каталог не изменился, остаётся версия %s.", self._snapshot.version)
+            CATALOG_REFRESH_SECONDS.observe(time.perf_counter() - started, "unchanged")
+            return False
+        snapshot = self.publish(products)
+        if self.snapshot_path:
+            self.save(self.snapshot_path)
+        elapsed = time.perf_counter() - started
+        CATALOG_REFRESH_SECONDS.observe(elapsed, "updated")
+        logger.info("Каталог обновлён за %.2f с: версия %s, %s товаров, %s брендов.",
+                    elapsed, snapshot.version, len(snapshot), len(snapshot.brands))
+        if not snapshot.brands:
+            logger.error("Ошибка: список брендов пустой после загрузки!")
+        return True
+
+    def save(self, path: str):
+        """Атомарно записывает текущий снимок на диск."""
+        snapshot = self._snapshot
+        payload = {
+            "format": SNAPSHOT_FORMAT,
+            "version": snapshot.version,
+            "loaded_at": snapshot.loaded_at,
+            "products": list(snapshot.products),
+            "index": snapshot.index,
+        }
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error("Не удалось сохранить снимок каталога в %s: %s", path, e)
+
+    def load(self, path: str) -> bool:
+        """Публикует снимок из файла. Файл пишет только сам сервис (формат pickle)."""
+        try:
+            with open(path, "rb") as f:
+                payload = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error("Снимок каталога %s повреждён: %s", path, e)
+            return False
+
+        products = tuple(payload["products"])
+        if payload.get("format") == SNAPSHOT_FORMAT:
+            snapshot = CatalogSnapshot(
+                version=payload["version"],
+                products=products,
+                brands=frozenset(p.get('brand', '') for p in products if p.get('brand', '')),
+                index=payload["index"],
+                loaded_at=payload["loaded_at"],
+            )
+        else:
+            snapshot = build_snapshot(list(products), version=payload.get("version", 0))
+        with self._refresh_lock:
+            self._snapshot = snapshot
+        logger.info("Каталог поднят из %s: версия %s, %s товаров.", path, snapshot.version, len(snapshot))
+        return True
+
+    def warm_start(self):
+        """
+        Поднимает каталог с диска и обновляет его в фоне.
+        Если файла нет, первая загрузка выполняется синхронно, как раньше.
+        """
+        if self.snapshot_path and self.load(self.snapshot_path):
+            self.start(refresh_now=True)
+        else:
+            self.refresh()
+            self.start()
+
+    def start(self, refresh_now: bool = False):
+        """Запускает единственный планировщик обновлений (поток-демон)."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(refresh_now,), name="catalog-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, refresh_now: bool):
+        if refresh_now:
+            self.refresh()
+        while not self._stop.wait(self.interval):
+            self.refresh()
@@ -0,0 +1,82 @@
+import re
+from typing import List
+
+from app.utils.cache import TTLCache
+from app.utils.tokens import estimate_tokens
+
+# ---------------------------
+# История диалога для промпта GPT
+# ---------------------------
+# Реплики добавляются от самых новых к старым, пока помещаются в бюджет
+# токенов. Более старые реплики не выбрасываются молча, а заменяются
+# короткими выжимками (вопрос клиента и первая фраза ответа) в одном
+# системном сообщении со своим небольшим бюджетом. Выжимка реплики
+# не меняется, поэтому считается один раз и берётся из кеша.
+
+# Служебные токены на каждое сообщение в формате chat (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_USER_CHARS = 80
+SUMMARY_BOT_CHARS = 120
+SUMMARY_HEADER = "Краткое содержание более ранней части диалога:\n"
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+summary_cache = TTLCache(maxsize=5000, ttl=86400)
+
+
+def _shorten(text: str, limit: int) -> str:
+    text = " ".join(str(text).split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def summarize_turn(user_text: str, bot_text: str) -> str:
+    """Выжимка одной реплики: вопрос клиента и первая фраза ответа бота."""
+    key = (user_text, bot_text)
+    summary = summary_cache.get(key)
+    if summary is None:
+        first_sentence = _SENTENCE_END.split(" ".join(str(bot_text).split()), 1)[0]
+        summary = f"клиент: {_shorten(user_text, SUMMARY_USER_CHARS)} → бот: {_shorten(first_sentence, SUMMARY_BOT_CHARS)}"
+        summary_cache.set(key, summary)
+    return summary
+
+
+def _turn_tokens(turn: dict) -> int:
+    return (estimate_tokens(turn["user_message"]) + estimate_tokens(turn["bot_response"])
+            + 2 * MESSAGE_OVERHEAD_TOKENS)
+
+
+def build_history_messages(conversation: List[dict], budget: int, summary_budget: int) -> List[dict]:
+    """
+    Сообщения истории для chat-промпта (conversation — от старых к новым).
+    Целиком входят самые новые реплики, сколько помещается в budget токенов;
+    выжимки предыдущих — в summary_budget токенов.
+    """
+    used = 0
+    cut = len(conversation)
+    for pos in range(len(conversation) - 1, -1, -1):
+        cost = _turn_tokens(conversation[pos])
+        if used + cost > budget:
+            break
+        used += cost
+        cut = pos
+
+    messages = []
+    if cut and summary_budget > 0:
+        lines = []
+        used = estimate_tokens(SUMMARY_HEADER) + MESSAGE_OVERHEAD_TOKENS
+        for turn in reversed(conversation[:cut]):
+            line = "- " + summarize_turn(turn["user_message"], turn["bot_response"])
+            cost = estimate_tokens(line)
+            if used + cost > summary_budget:
+                break
+            lines.append(line)
+            used += cost
+        if lines:
+            messages.append({"role": "system", "content": SUMMARY_HEADER + "\n".join(reversed(lines))})
+
+    for turn in conversation[cut:]:
+        messages.append({"role": "user", "content": turn["user_message"]})
+        messages.append({"role": "assistant", "content": turn["bot_response"]})
+    return messages
@@ -1,8 +1,17 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import hashlib
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# gspread импортируется внутри функций: он тянет за собой google-auth
+# и заметно замедляет импорт приложения, а нужен только при чтении таблицы
 
 # Подключение к Google Sheets через JSON-ключ
 def connect_to_google_sheets(json_keyfile, sheet_name):
+    import gspread
     try:
         # Авторизация через сервисный аккаунт
         gc = gspread.service_account(filename=json_keyfile)
@@ -16,6 +25,7 @@ def connect_to_google_sheets(json_keyfile, sheet_name):
 
 # Получение данных из указанного листа
 def get_sheet_data(json_keyfile, sheet_name, worksheet_name):
+    import gspread
     sheet = connect_to_google_sheets(json_keyfile, sheet_name)
     if sheet:
         try:
@@ -28,3 +38,97 @@ def get_sheet_data(json_keyfile, sheet_name, worksheet_name):
         except Exception as e:
             print(f"Произошла ошибка при получении данных с листа: {e}")
 
+
+
+# ---------------------------
+# Долгоживущий клиент с проверкой изменений
+# ---------------------------
+# Авторизация и открытие таблицы выполняются один раз, оба листа читаются
+# одним пакетным запросом. Перед чтением сверяется время изменения файла
+# (Drive API), после чтения — хеш содержимого: если ничего не поменялось,
+# fetch_if_changed возвращает None и каталог не пересобирается.
+
+
+def records_from_values(values: List[List[Any]]) -> List[dict]:
+    """Превращает строки листа в записи так же, как worksheet.get_all_records()."""
+    from gspread.utils import fill_gaps, numericise_all, to_records
+    values = fill_gaps(values) if values else [[]]
+    if values == [[]]:
+        return []
+    keys, rows = values[0], values[1:]
+    return to_records(keys, [numericise_all(row, default_blank="") for row in rows])
+
+
+class SheetsClient:
+    def __init__(self, json_keyfile: str, sheet_name: str):
+        self.json_keyfile = json_keyfile
+        self.sheet_name = sheet_name
+        self._spreadsheet = None
+        self._lock = threading.Lock()
+        self._last_modified: Optional[str] = None
+        self._last_hash: Optional[str] = None
+        self.api_calls = 0
+        self.skipped = 0
+
+    def _open(self):
+        if self._spreadsheet is None:
+            import gspread
+            gc = gspread.service_account(filename=self.json_keyfile)
+            self._spreadsheet = gc.open(self.sheet_name)
+            self.api_calls += 2
+        return self._spreadsheet
+
+    def _modified_time(self, spreadsheet) -> Optional[str]:
+        try:
+            self.api_calls += 1
+            return spreadsheet.get_lastUpdateTime()
+        except Exception as e:
+            # Нет доступа к Drive API — полагаемся только на хеш содержимого
+            logger.debug("Не удалось получить время изменения таблицы: %s", e)
+            return None
+
+    def fetch(self, worksheet_names: List[str]) -> Dict[str, List[dict]]:
+        """Читает несколько листов одним запросом values:batchGet."""
+        with self._lock:
+            return self._fetch(self._open(), worksheet_names)
+
+    def _fetch(self, spreadsheet, worksheet_names: List[str]) -> Dict[str, List[dict]]:
+        ranges = ["'{}'".format(name.replace("'", "''")) for name in worksheet_names]
+        try:
+            self.api_calls += 1
+            response = spreadsheet.values_batch_get(ranges)
+        except Exception:
+            # Соединение или доступ могли протухнуть — в следующий раз откроем заново
+            self._spreadsheet = None
+            raise
+        value_ranges = response.get("valueRanges", [])
+        return {
+            name: records_from_values(value_range.get("values", []))
+            for name, value_range in zip(worksheet_names, value_ranges)
+        }
+
+    def fetch_if_changed(self, worksheet_names: List[str]) -> Optional[Dict[str, List[dict]]]:
+        """Как fetch(), но возвращает None, если таблица не менялась с прошлого чтения."""
+        with self._lock:
+            spreadsheet = self._open()
+            modified = self._modified_time(spreadsheet)
+            if modified is not None and modified == self._last_modified:
+                self.skipped += 1
+                return None
+
+            data = self._fetch(spreadsheet, worksheet_names)
+            digest = hashlib.sha256(
+                json.dumps(data, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+            ).hexdigest()
+            self._last_modified = modified
+            if digest == self._last_hash:
+                self.skipped += 1
+                return None
+            self._last_hash = digest
+            return data
+
+    def reset(self):
+        """Забывает запомненную версию — следующее чтение вернёт данные."""
+        with self._lock:
+            self._last_modified = None
+            self._last_hash = None
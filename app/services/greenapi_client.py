@@ -0,0 +1,216 @@
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.utils.metrics import ERRORS, GREENAPI_SECONDS
+from app.utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Клиент GreenAPI
+# ---------------------------
+# Один долгоживущий клиент на процесс: пул keep-alive соединений вместо
+# нового TCP/TLS-рукопожатия на каждый ответ, раздельные таймауты
+# подключения и чтения, повторы с экспоненциальной задержкой и джиттером
+# на 5xx и ошибках подключения, предохранитель (circuit breaker) на случай, когда
+# GreenAPI лежит. Клиент не зависит от контекста Flask и годится
+# для фоновых потоков.
+#
+# SendMessage не идемпотентен: таймаут чтения значит, что запрос мог дойти
+# и сообщение уже ушло пользователю, поэтому такой запрос не повторяется.
+
+DEFAULT_BASE_URL = "https://api.green-api.com"
+# GreenAPI отвечает 466, когда исчерпана квота тарифа
+QUOTA_EXCEEDED_STATUS = 466
+
+
+class GreenApiError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class QuotaExceededError(GreenApiError):
+    pass
+
+
+class CircuitOpenError(GreenApiError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold неудач подряд перестаёт пропускать запросы
+    на reset_timeout секунд, затем пропускает один пробный запрос.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class GreenApiClient:
+    def __init__(self, id_instance: str, api_token: str, base_url: str = DEFAULT_BASE_URL,
+                 connect_timeout: float = 3.05, read_timeout: float = 10.0,
+                 retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 pool_size: int = 10, breaker: Optional[CircuitBreaker] = None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._send_url = f"{base_url.rstrip('/')}/waInstance{id_instance}/SendMessage/{api_token}"
+
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        # Повторы делаем сами (с джиттером и учётом предохранителя), адаптер — только пул
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @staticmethod
+    def chat_id_for(wa_id: str) -> str:
+        chat_id = wa_id.replace("+", "").strip()
+        if not (chat_id.endswith("@c.us") or chat_id.endswith("@g.us")):
+            chat_id += "@c.us"
+        return chat_id
+
+    def _backoff(self, attempt: int) -> float:
+        # «Полный джиттер»: случайная пауза до экспоненциального потолка
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def send_message(self, wa_id: str, text: str) -> requests.Response:
+        """
+        Отправляет текстовое сообщение. Повторяет попытку при 5xx и ошибках подключения
+        (но не при таймауте чтения — сообщение могло уже уйти).
+        Бросает QuotaExceededError, CircuitOpenError или GreenApiError.
+        """
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with span("greenapi.send"):
+                response = self._send_message(wa_id, text)
+            outcome = "ok"
+            return response
+        except QuotaExceededError:
+            outcome = "quota"
+            raise
+        except CircuitOpenError:
+            outcome = "circuit_open"
+            raise
+        finally:
+            GREENAPI_SECONDS.observe(time.perf_counter() - started, outcome)
+            if outcome != "ok":
+                ERRORS.inc("greenapi_send")
+
+    def _send_message(self, wa_id: str, text: str) -> requests.Response:
+        if not self.breaker.allow():
+            raise CircuitOpenError("GreenAPI временно недоступен, отправка пропущена")
+
+        payload = {"chatId": self.chat_id_for(wa_id), "message": text}
+        last_error: Optional[GreenApiError] = None
+        # Исход попытки должен попасть в предохранитель при любом исключении,
+        # иначе пробный запрос в состоянии half-open так и останется «в полёте»
+        settled = False
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(self._backoff(attempt - 1))
+                try:
+                    response = self.session.post(self._send_url, json=payload, timeout=self.timeout)
+                except requests.ReadTimeout as e:
+                    # Запрос отправлен, ответа нет — повтор мог бы задублировать сообщение
+                    raise GreenApiError(f"GreenAPI не ответил вовремя, сообщение могло быть доставлено: {e}") from e
+                except requests.ConnectionError as e:
+                    # Сюда же попадает ConnectTimeout: запрос не ушёл, повтор безопасен
+                    last_error = GreenApiError(f"Сетевая ошибка GreenAPI: {e}")
+                    continue
+                except requests.RequestException as e:
+                    # Обрыв ответа, ошибка декодирования, редиректы — запрос мог дойти, не повторяем
+                    raise GreenApiError(f"Ошибка запроса к GreenAPI: {e}") from e
+
+                if response.status_code >= 500:
+                    last_error = GreenApiError(f"GreenAPI ответил {response.status_code}", response.status_code)
+                    continue
+
+                # Ответ получен — сервис жив, даже если запрос отклонён
+                self.breaker.record_success()
+                settled = True
+                if response.status_code == QUOTA_EXCEEDED_STATUS:
+                    raise QuotaExceededError("Квота GreenAPI исчерпана", response.status_code)
+                if not response.ok:
+                    raise GreenApiError(f"GreenAPI отклонил запрос: {response.status_code}", response.status_code)
+                return response
+
+            raise last_error
+        finally:
+            if not settled:
+                self.breaker.record_failure()
+
+    def close(self):
+        self.session.close()
+
+
+_client: Optional[GreenApiClient] = None
+
+
+def init_greenapi_client(app) -> GreenApiClient:
+    """Создаёт общий клиент из конфигурации приложения."""
+    global _client
+    if _client is not None:
+        _client.close()
+    _client = GreenApiClient(
+        app.config["GREENAPI_IDINSTANCE"],
+        app.config["GREENAPI_APITOKEN"],
+        base_url=app.config["GREENAPI_API_URL"],
+        connect_timeout=app.config["GREENAPI_CONNECT_TIMEOUT"],
+        read_timeout=app.config["GREENAPI_READ_TIMEOUT"],
+        retries=app.config["GREENAPI_RETRIES"],
+    )
+    logger.info("Клиент GreenAPI готов: %s", app.config['GREENAPI_API_URL'])
+    return _client
+
+
+def get_greenapi_client() -> Optional[GreenApiClient]:
+    return _client
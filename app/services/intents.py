@@ -0,0 +1,96 @@
+import re
+from typing import Dict, FrozenSet, List, Sequence, Tuple, Union
+
+# ---------------------------
+# Определение намерений по ключевым словам
+# ---------------------------
+# Таблица ключевых слов (RU и KZ) компилируется при импорте в одно регулярное
+# выражение, и все намерения сообщения находятся за один проход по тексту.
+# Ключевое слово срабатывает, если оно встречается в тексте как подстрока —
+# так же, как прежние проверки `word in lower_msg`.
+# Кортеж означает «все слова должны встретиться» (в любом месте текста).
+
+Keyword = Union[str, Tuple[str, ...]]
+
+INTENT_KEYWORDS: Dict[str, List[Keyword]] = {
+    "manager_request": ["переключить", "менеджер", "связаться с менеджером"],
+    "end_dialog": ["завершить разговор", "бот", ("әңгіме", "аяқтау")],
+    "greeting_ru": ["привет", "здравствуйте", "добрый день", "добрый вечер", "салам"],
+    "greeting_kz": ["сәлем", "қайырлы күн", "қайырлы кеш", "салеметсизбе", "салеметсиз бе", "салем"],
+    "address": [
+        "адрес", "где вы", "местоположение", "где находится", "как добраться",
+        "мекенжай", "қай жерде", "орналасқан", "қайда",
+    ],
+    "delivery": ["доставка", "жеткізу"],
+    "installment": [
+        "рассрочка", "оплата частями", "kaspi red", "kaspi рассрочка",
+        "можно в рассрочку", "можно ли оплатить частями",
+    ],
+    "originality": [
+        "оригинал", "копия", "реплика", "подделка", "настоящий",
+        "сертифицированный", "оригинальная продукция", "реплика или оригинал",
+    ],
+    "recommendation": [
+        "подобрать", "помогите выбрать", "посоветуйте", "подскажите",
+        "рекомендовать", "лучший аромат", "что выбрать", "совет",
+    ],
+    "full_bottle": ["полный объем", "флакон", "оригинал", "бутылка", "толық көлем", "құты"],
+    "price": ["цена", "сколько стоит", "стоимость", "по чем", "қанша тұрады"],
+    "follow_up": ["цена", "стоимость", "где купить", "наличие", "доступно", "сколько стоит"],
+    "purchase": [
+        "купить", "заказать", "оформить заказ", "купить сейчас", "хочу купить", "закажу",
+        "сатып алу", "тапсырыс беру",
+    ],
+    "spilled": ["разлив", "разливные", "құйма"],
+    "spilled_request": ["разлив", "разливные", "құйма", "sample", "отливант", "1 мл", "1ml"],
+    "list_request": ["все", "показать", "список", "какие", "барлығы", "қандай"],
+}
+
+
+class IntentEngine:
+    """Однопроходный классификатор намерений по таблице ключевых слов."""
+
+    def __init__(self, table: Dict[str, Sequence[Keyword]]):
+        by_keyword: Dict[str, set] = {}
+        self._conjunctions: List[Tuple[str, FrozenSet[str]]] = []
+
+        for intent, keywords in table.items():
+            for keyword in keywords:
+                if isinstance(keyword, tuple):
+                    # Каждая часть — служебное намерение, итог проверяется после прохода
+                    parts = frozenset(f"{intent}&{part}" for part in keyword)
+                    for part in keyword:
+                        by_keyword.setdefault(part, set()).add(f"{intent}&{part}")
+                    self._conjunctions.append((intent, parts))
+                else:
+                    by_keyword.setdefault(keyword, set()).add(intent)
+
+        # В одной позиции регулярное выражение находит только самое длинное слово,
+        # поэтому каждое слово несёт ещё и намерения всех своих префиксов
+        self._intents: Dict[str, FrozenSet[str]] = {}
+        for keyword in by_keyword:
+            intents = set()
+            for other, other_intents in by_keyword.items():
+                if keyword.startswith(other):
+                    intents |= other_intents
+            self._intents[keyword] = frozenset(intents)
+
+        # Опережающая проверка нулевой ширины даёт совпадение в каждой позиции текста
+        alternatives = "|".join(re.escape(k) for k in sorted(by_keyword, key=len, reverse=True))
+        self._pattern = re.compile(f"(?=({alternatives}))")
+
+    def classify(self, text: str) -> FrozenSet[str]:
+        found = set()
+        for match in self._pattern.finditer(text.lower()):
+            found |= self._intents[match.group(1)]
+        for intent, parts in self._conjunctions:
+            if parts <= found:
+                found.add(intent)
+        return frozenset(i for i in found if "&" not in i)
+
+
+intent_engine = IntentEngine(INTENT_KEYWORDS)
+
+
+def classify_intents(text: str) -> FrozenSet[str]:
+    return intent_engine.classify(text)
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.utils.metrics import ERRORS, OPENAI_SECONDS
+from app.utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Клиент OpenAI
+# ---------------------------
+# Все обращения к модели идут через один LLMClient: общий лимит
+# одновременных запросов (остальные ждут своей очереди, а не открывают
+# новые соединения), общий срок на вызов с учётом ожидания и повторов,
+# повторы с экспоненциальной задержкой и джиттером на 429, 5xx и сетевых
+# ошибках. Сам запрос выполняет транспорт: по умолчанию — официальный
+# SDK openai, для тестов и нагрузочных прогонов — HTTPTransport, которому
+# достаточно любого OpenAI-совместимого адреса (например, локальной заглушки).
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+
+class LLMError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None,
+                 retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class LLMTimeoutError(LLMError):
+    pass
+
+
+def _retry_after(headers) -> Optional[float]:
+    try:
+        return float(headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _status_error(status: int, headers=None) -> LLMError:
+    retryable = status == 429 or status >= 500
+    return LLMError(f"OpenAI ответил {status}", status, retryable=retryable, retry_after=_retry_after(headers))
+
+
+class OpenAISDKTransport:
+    """Запросы через официальный SDK (openai>=1). Повторы SDK выключены — их делает LLMClient."""
+
+    def __init__(self, api_key: str, base_url: Optional[str] = None):
+        # SDK импортируется только здесь: его импорт занимает заметное время
+        import openai
+        self._openai = openai
+        self._client = openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self._async_client = None
+        self._api_key = api_key
+        self._base_url = base_url
+
+    def _convert(self, error: Exception) -> LLMError:
+        openai = self._openai
+        if isinstance(error, openai.APITimeoutError):
+            return LLMTimeoutError("Таймаут запроса к OpenAI", retryable=True)
+        if isinstance(error, openai.APIConnectionError):
+            return LLMError(f"Сетевая ошибка OpenAI: {error}", retryable=True)
+        if isinstance(error, openai.APIStatusError):
+            return _status_error(error.status_code, error.response.headers)
+        return LLMError(f"Ошибка OpenAI: {error}")
+
+    def create(self, payload: dict, timeout: float) -> str:
+        try:
+            response = self._client.chat.completions.create(**payload, timeout=timeout)
+        except self._openai.OpenAIError as e:
+            raise self._convert(e) from e
+        return response.choices[0].message.content or ""
+
+    async def acreate(self, payload: dict, timeout: float) -> str:
+        if self._async_client is None:
+            self._async_client = self._openai.AsyncOpenAI(api_key=self._api_key, base_url=self._base_url, max_retries=0)
+        try:
+            response = await self._async_client.chat.completions.create(**payload, timeout=timeout)
+        except self._openai.OpenAIError as e:
+            raise self._convert(e) from e
+        return response.choices[0].message.content or ""
+
+    def close(self):
+        self._client.close()
+
+
+class HTTPTransport:
+    """Прямой POST {base_url}/chat/completions через пул keep-alive соединений requests."""
+
+    def __init__(self, api_key: str, base_url: str, pool_size: int = 10):
+        self._url = f"{base_url.rstrip('/')}/chat/completions"
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def create(self, payload: dict, timeout: float) -> str:
+        try:
+            response = self.session.post(self._url, json=payload, timeout=timeout)
+        except requests.Timeout as e:
+            raise LLMTimeoutError("Таймаут запроса к OpenAI", retryable=True) from e
+        except requests.ConnectionError as e:
+            raise LLMError(f"Сетевая ошибка OpenAI: {e}", retryable=True) from e
+        if not response.ok:
+            raise _status_error(response.status_code, response.headers)
+        try:
+            return response.json()["choices"][0]["message"]["content"] or ""
+        except (ValueError, KeyError, IndexError) as e:
+            raise LLMError(f"Непонятный ответ OpenAI: {e}", response.status_code) from e
+
+    def close(self):
+        self.session.close()
+
+
+def _observe(started: float, outcome: str):
+    OPENAI_SECONDS.observe(time.perf_counter() - started, outcome)
+    if outcome != "ok":
+        ERRORS.inc("openai")
+
+
+class LLMClient:
+    def __init__(self, transport, model: str = DEFAULT_MODEL, timeout: float = 20.0,
+                 deadline: float = 45.0, retries: int = 2, backoff_base: float = 0.5,
+                 backoff_max: float = 8.0, max_concurrency: int = 8):
+        self.transport = transport
+        self.model = model
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_concurrency = max_concurrency
+        # Один лимит на процесс — и для complete(), и для acomplete()
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        # acomplete() ждёт слот в отдельных потоках: в общем пуле asyncio ожидающие
+        # заняли бы все потоки, нужные транспорту без acreate() для самих запросов
+        self._slot_executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm-slot")
+
+    def _payload(self, messages: List[dict], max_tokens: int, temperature: float, model: Optional[str]) -> dict:
+        return {
+            "model": model or self.model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+
+    def _backoff(self, attempt: int, error: LLMError) -> float:
+        if error.retry_after is not None:
+            return min(self.backoff_max, error.retry_after)
+        # «Полный джиттер»: случайная пауза до экспоненциального потолка
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def complete(self, messages: List[dict], max_tokens: int = 400, temperature: float = 0.7,
+                 model: Optional[str] = None, deadline: Optional[float] = None) -> str:
+        """
+        Возвращает текст ответа модели. deadline — общий срок в секундах,
+        включая ожидание свободного слота и повторы.
+        Бросает LLMTimeoutError или LLMError.
+        """
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with span("openai"):
+                text = self._complete(messages, max_tokens, temperature, model, deadline)
+            outcome = "ok"
+            return text
+        except LLMTimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            _observe(started, outcome)
+
+    def _complete(self, messages: List[dict], max_tokens: int, temperature: float,
+                  model: Optional[str], deadline: Optional[float]) -> str:
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        if not self._semaphore.acquire(timeout=max(0.0, deadline_at - time.monotonic())):
+            raise LLMTimeoutError("Нет свободного слота для запроса к OpenAI")
+        try:
+            payload = self._payload(messages, max_tokens, temperature, model)
+            last_error: LLMError = LLMTimeoutError("Срок запроса к OpenAI истёк")
+            for attempt in range(self.retries + 1):
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    return self.transport.create(payload, timeout=min(self.timeout, remaining)).strip()
+                except LLMError as e:
+                    if not e.retryable:
+                        raise
+                    last_error = e
+                if attempt == self.retries:
+                    break
+                delay = self._backoff(attempt, last_error)
+                if time.monotonic() + delay >= deadline_at:
+                    break
+                logger.warning("OpenAI: %s, повтор через %.1f с", last_error, delay)
+                time.sleep(delay)
+            raise last_error
+        finally:
+            self._semaphore.release()
+
+    async def acomplete(self, messages: List[dict], max_tokens: int = 400, temperature: float = 0.7,
+                        model: Optional[str] = None, deadline: Optional[float] = None) -> str:
+        """Асинхронный вариант complete(). Транспорт без acreate() выполняется в пуле потоков."""
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with span("openai"):
+                text = await self._acomplete(messages, max_tokens, temperature, model, deadline)
+            outcome = "ok"
+            return text
+        except LLMTimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            _observe(started, outcome)
+
+    async def _acomplete(self, messages: List[dict], max_tokens: int, temperature: float,
+                         model: Optional[str], deadline: Optional[float]) -> str:
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        if not await self._acquire_slot(deadline_at):
+            raise LLMTimeoutError("Нет свободного слота для запроса к OpenAI")
+        try:
+            payload = self._payload(messages, max_tokens, temperature, model)
+            acreate = getattr(self.transport, "acreate", None)
+            last_error: LLMError = LLMTimeoutError("Срок запроса к OpenAI истёк")
+            for attempt in range(self.retries + 1):
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout = min(self.timeout, remaining)
+                try:
+                    if acreate is not None:
+                        text = await acreate(payload, timeout=timeout)
+                    else:
+                        text = await asyncio.to_thread(self.transport.create, payload, timeout)
+                    return text.strip()
+                except LLMError as e:
+                    if not e.retryable:
+                        raise
+                    last_error = e
+                if attempt == self.retries:
+                    break
+                delay = self._backoff(attempt, last_error)
+                if time.monotonic() + delay >= deadline_at:
+                    break
+                logger.warning("OpenAI: %s, повтор через %.1f с", last_error, delay)
+                await asyncio.sleep(delay)
+            raise last_error
+        finally:
+            self._semaphore.release()
+
+    async def _acquire_slot(self, deadline_at: float) -> bool:
+        """Берёт слот общего семафора, не блокируя цикл событий: ожидание — в пуле потоков."""
+        if self._semaphore.acquire(blocking=False):
+            return True
+        waiter = asyncio.get_running_loop().run_in_executor(self._slot_executor, self._wait_slot, deadline_at)
+        try:
+            return await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            # Поток всё равно дождётся слота — его нужно вернуть
+            waiter.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or not f.result() or self._semaphore.release())
+            raise
+
+    def _wait_slot(self, deadline_at: float) -> bool:
+        # Остаток срока считается здесь: задача могла постоять в очереди пула
+        return self._semaphore.acquire(timeout=max(0.0, deadline_at - time.monotonic()))
+
+    def close(self):
+        self._slot_executor.shutdown(wait=False)
+        self.transport.close()
+
+
+def client_from_env() -> LLMClient:
+    """
+    Клиент по переменным окружения. OPENAI_TRANSPORT=http вместо SDK
+    отправляет запросы напрямую на OPENAI_BASE_URL (например, на заглушку).
+    """
+    api_key = os.getenv("OPENAI_API_KEY", "")
+    base_url = os.getenv("OPENAI_BASE_URL") or None
+    if os.getenv("OPENAI_TRANSPORT", "sdk").lower() == "http":
+        transport = HTTPTransport(api_key, base_url or "https://api.openai.com/v1")
+    else:
+        transport = OpenAISDKTransport(api_key, base_url)
+    return LLMClient(
+        transport,
+        model=os.getenv("OPENAI_MODEL", DEFAULT_MODEL),
+        timeout=float(os.getenv("OPENAI_TIMEOUT", "20")),
+        deadline=float(os.getenv("OPENAI_DEADLINE", "45")),
+        retries=int(os.getenv("OPENAI_RETRIES", "2")),
+        max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")),
+    )
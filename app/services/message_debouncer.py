@@ -0,0 +1,240 @@
+import atexit
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from app.utils.tracing import current_trace_id, start_trace
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Склейка серий сообщений одного чата
+# ---------------------------
+# Пользователи часто пишут одну мысль тремя-четырьмя сообщениями подряд.
+# Сообщения чата, пришедшие с паузами меньше window секунд, копятся
+# и обрабатываются одним ходом: один вызов generate_response, один ответ.
+# Серия не тянется бесконечно — не дольше max_wait от первого сообщения.
+# Сроки всех чатов хранятся в одной куче, её разбирает один поток-таймер;
+# готовые серии обрабатывает небольшой пул потоков, а не поток на чат.
+#
+# У чата обрабатывается не больше одного хода одновременно: серия, готовая,
+# пока предыдущий ход ещё отвечает, ждёт его окончания (а следующие серии
+# добавляются к ней), и ответы приходят в порядке сообщений.
+
+
+class _Pending:
+    __slots__ = ("sender", "sender_name", "texts", "first_at", "due", "trace_id")
+
+    def __init__(self, sender: str, sender_name: str, first_at: float, trace_id: Optional[str]):
+        self.sender = sender
+        self.sender_name = sender_name
+        self.texts: List[str] = []
+        self.first_at = first_at
+        self.due = first_at
+        # Склеенный ход продолжает трассу первого сообщения серии
+        self.trace_id = trace_id
+
+
+class MessageDebouncer:
+    def __init__(self, handler: Callable[[str, str, str, str], None], window: float = 1.5,
+                 max_wait: float = 5.0, workers: int = 4):
+        self._handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self._workers_count = workers
+
+        self._cond = threading.Condition()
+        self._pending: Dict[str, _Pending] = {}
+        # Чаты, ход которых сейчас обрабатывается, и готовые ходы, ждущие его окончания
+        self._inflight: Set[str] = set()
+        self._queued: Dict[str, _Pending] = {}
+        # (срок, номер, chat_id); устаревшие записи пропускаются при разборе
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = 0
+        self._stopped = False
+        self._timer: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        self._received = 0
+        self._flushed = 0
+        self._largest_batch = 0
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self._workers_count, thread_name_prefix="debounce")
+        self._timer = threading.Thread(target=self._run, name="debounce-timer", daemon=True)
+        self._timer.start()
+
+    def stop(self):
+        """Останавливает таймер и сразу обрабатывает всё накопленное, включая ходы, ждущие своей очереди."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        if self._executor is None:
+            return
+        with self._cond:
+            ready = list(self._pending.items())
+            self._pending.clear()
+            self._heap.clear()
+            queued = len(self._queued)
+        if ready or queued:
+            logger.info("Склейка сообщений останавливается: обрабатывается %s накопленных ходов.",
+                        len(ready) + queued)
+        # При завершении интерпретатора пул уже не принимает задачи,
+        # поэтому накопленное разбирают отдельные потоки
+        turns = deque((chat_id, pending) for chat_id, pending in ready if self._claim(chat_id, pending))
+
+        def drain():
+            while True:
+                try:
+                    chat_id, pending = turns.popleft()
+                except IndexError:
+                    return
+                self._handle(chat_id, pending)
+
+        threads = [threading.Thread(target=drain, name=f"debounce-stop-{i}")
+                   for i in range(min(self._workers_count, len(turns)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Ходы, вставшие в очередь за уже идущими, доработают потоки пула
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def submit(self, chat_id: str, sender: str, sender_name: str, text: str):
+        if self._stopped:
+            # Таймера уже нет — сообщение обрабатывается сразу, в потоке вызывающего
+            self._handler(chat_id, sender, sender_name, text)
+            return
+        now = time.monotonic()
+        with self._cond:
+            pending = self._pending.get(chat_id)
+            if pending is None:
+                pending = self._pending[chat_id] = _Pending(sender, sender_name, now, current_trace_id())
+            pending.texts.append(text)
+            pending.due = min(now + self.window, pending.first_at + self.max_wait)
+            self._seq += 1
+            heapq.heappush(self._heap, (pending.due, self._seq, chat_id))
+            self._received += 1
+            # Будим таймер, только если этот срок стал ближайшим
+            if self._heap[0][1] == self._seq:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    due, _, chat_id = self._heap[0]
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    pending = self._pending.get(chat_id)
+                    # Срок сдвинулся новым сообщением — это устаревшая запись
+                    if pending is None or pending.due != due:
+                        continue
+                    del self._pending[chat_id]
+                    break
+            self._dispatch(chat_id, pending)
+
+    def _dispatch(self, chat_id: str, pending: _Pending):
+        if self._claim(chat_id, pending):
+            self._executor.submit(self._handle, chat_id, pending)
+
+    def _claim(self, chat_id: str, pending: _Pending) -> bool:
+        """
+        Возвращает True, если ход нужно обработать сейчас. Если у чата уже идёт ход,
+        этот встаёт за ним (сливаясь с уже ждущим) и будет обработан тем же потоком.
+        """
+        with self._cond:
+            if chat_id in self._inflight:
+                queued = self._queued.get(chat_id)
+                if queued is None:
+                    self._queued[chat_id] = pending
+                    self._flushed += 1
+                else:
+                    queued.texts.extend(pending.texts)
+                    pending = queued
+                self._largest_batch = max(self._largest_batch, len(pending.texts))
+                return False
+            self._inflight.add(chat_id)
+            self._flushed += 1
+            self._largest_batch = max(self._largest_batch, len(pending.texts))
+            return True
+
+    def _handle(self, chat_id: str, pending: Optional[_Pending]):
+        # Ходы чата, накопившиеся за время ответа, обрабатываются тут же, по порядку
+        while pending is not None:
+            if len(pending.texts) > 1:
+                logger.info("Склеено %s сообщений от %s в один ход.", len(pending.texts), pending.sender)
+            try:
+                with start_trace("debounced_turn", pending.trace_id):
+                    self._handler(chat_id, pending.sender, pending.sender_name, "\n".join(pending.texts))
+            except Exception:
+                logger.exception("Ошибка обработки сообщений чата %s", chat_id)
+            with self._cond:
+                pending = self._queued.pop(chat_id, None)
+                if pending is None:
+                    self._inflight.discard(chat_id)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "window_ms": round(self.window * 1000),
+                "pending_chats": len(self._pending),
+                "inflight_chats": len(self._inflight),
+                "queued_turns": len(self._queued),
+                "received": self._received,
+                "turns": self._flushed,
+                "merged": self._received - self._flushed - sum(len(p.texts) for p in self._pending.values()),
+                "largest_batch": self._largest_batch,
+            }
+
+
+_debouncer: Optional[MessageDebouncer] = None
+_atexit_registered = False
+
+
+def init_message_debouncer(app, handler: Callable[[str, str, str, str], None]) -> Optional[MessageDebouncer]:
+    """Включает склейку сообщений, если задан DEBOUNCE_MS > 0."""
+    global _debouncer, _atexit_registered
+    if app.config["DEBOUNCE_MS"] <= 0:
+        return None
+    if _debouncer is not None:
+        _debouncer.stop()
+    _debouncer = MessageDebouncer(
+        handler,
+        window=app.config["DEBOUNCE_MS"] / 1000,
+        max_wait=app.config["DEBOUNCE_MAX_WAIT_MS"] / 1000,
+        workers=app.config["DEBOUNCE_WORKERS"],
+    )
+    _debouncer.start()
+    # Регистрируется после очереди исходящих (init_outbound_dispatcher вызывается раньше),
+    # поэтому при выходе останавливается до неё — ответы досланных ходов ещё уйдут
+    if not _atexit_registered:
+        atexit.register(stop_message_debouncer)
+        _atexit_registered = True
+    return _debouncer
+
+
+def stop_message_debouncer():
+    """Обрабатывает накопленные сообщения при завершении процесса."""
+    if _debouncer is not None:
+        _debouncer.stop()
+
+
+def get_message_debouncer() -> Optional[MessageDebouncer]:
+    return _debouncer
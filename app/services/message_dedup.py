@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.services.state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Защита от повторной доставки вебхуков
+# ---------------------------
+# GreenAPI повторяет вебхук, если не дождался ответа, и одно сообщение
+# клиента могло дать два обращения к GPT и два ответа. Перед обработкой
+# idMessage проверяется по индексу уже принятых сообщений за последние
+# window секунд. Индекс в памяти ограничен maxsize записями; общий для
+# нескольких процессов вариант — таблица processed_message в базе состояния.
+
+
+class MessageDeduplicator:
+    def __init__(self, window: float = 600.0, maxsize: int = 100000, backend: Optional[StateStore] = None):
+        self.window = window
+        self.maxsize = maxsize
+        self.backend = backend
+        # idMessage -> время приёма; порядок вставки совпадает с порядком истечения
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+
+    def _expire(self, now: float):
+        while self._seen:
+            seen_at = next(iter(self._seen.values()))
+            if seen_at > now - self.window and len(self._seen) <= self.maxsize:
+                break
+            self._seen.popitem(last=False)
+
+    def claim(self, message_id: str) -> bool:
+        """True — сообщение новое и принято в обработку, False — повтор."""
+        now = time.monotonic()
+        with self._lock:
+            self.checked += 1
+            self._expire(now)
+            if message_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen[message_id] = now
+        if self.backend is not None:
+            try:
+                if not self.backend.claim_message(message_id, self.window):
+                    with self._lock:
+                        self.duplicates += 1
+                    return False
+            except Exception as e:
+                # База недоступна — обходимся индексом в памяти
+                logger.error("Не удалось проверить idMessage %s в базе: %s", message_id, e)
+        return True
+
+    def release(self, message_id: str):
+        """Забывает сообщение, которое не удалось обработать, — повторная доставка пройдёт."""
+        with self._lock:
+            self._seen.pop(message_id, None)
+        if self.backend is not None:
+            try:
+                self.backend.release_message(message_id)
+            except Exception as e:
+                logger.error("Не удалось снять отметку idMessage %s: %s", message_id, e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": "sqlite" if self.backend is not None else "memory",
+                "window_s": self.window,
+                "size": len(self._seen),
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "duplicate_ratio": round(self.duplicates / self.checked, 4) if self.checked else 0.0,
+            }
+
+
+_deduplicator: Optional[MessageDeduplicator] = None
+
+
+def init_message_dedup(app, backend: Optional[StateStore] = None) -> Optional[MessageDeduplicator]:
+    """Создаёт индекс принятых сообщений, если не выключен DEDUP_ENABLED."""
+    global _deduplicator
+    if not app.config["DEDUP_ENABLED"]:
+        _deduplicator = None
+        return None
+    _deduplicator = MessageDeduplicator(
+        window=app.config["DEDUP_WINDOW"],
+        maxsize=app.config["DEDUP_MAX_IDS"],
+        backend=backend if app.config["DEDUP_PERSISTENT"] else None,
+    )
+    return _deduplicator
+
+
+def get_message_dedup() -> Optional[MessageDeduplicator]:
+    return _deduplicator
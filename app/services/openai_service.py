@@ -1,104 +1,139 @@
-import openai
-import shelve
 import os
 import logging
-import sys
 import threading
-from threading import Timer
-from typing import Optional, Tuple, List
-import string
-
-from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, String, Enum
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+import time
+from typing import Dict, FrozenSet, Optional, Tuple, List
+
 import enum
 
 # Для быстрого поиска (RapidFuzz)
 from rapidfuzz import process, fuzz
 
-# Модуль для работы с Google Sheets (убедитесь, что он настроен и работает)
-from app.services.google_sheets_service import get_sheet_data
-
-# ---------------------------
-# Настройка кодировки консоли
-# ---------------------------
-try:
-    sys.stdout.reconfigure(encoding='utf-8')
-    sys.stderr.reconfigure(encoding='utf-8')
-except AttributeError:
-    pass
+from app.utils.cache import TTLCache
+from app.utils.concurrency import KeyedLock
+from app.utils.metrics import ERRORS, MODE_SWITCHES, RESPONSE_SECONDS
+from app.utils.tracing import span, traced
+from app.utils.tokens import estimate_tokens
+from app.services.state_store import SQLiteStateStore, migrate_legacy_state
+from app.services.catalog_index import CatalogIndex, normalize_text
+from app.services.catalog_manager import CatalogManager, CatalogSnapshot
+from app.services.intents import classify_intents
+from app.services.llm_client import LLMClient, client_from_env
+from app.services.conversation_context import build_history_messages
 
-# ---------------------------
-# Загрузка переменных окружения
-# ---------------------------
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-WHATSAPP_API_URL = os.getenv("WHATSAPP_API_URL", "")
-WHATSAPP_API_TOKEN = os.getenv("WHATSAPP_API_TOKEN", "")
+# Модуль для работы с Google Sheets (убедитесь, что он настроен и работает)
+from app.services.google_sheets_service import SheetsClient, get_sheet_data
 
-openai.api_key = OPENAI_API_KEY
+logger = logging.getLogger(__name__)
 
 # ---------------------------
-# Настройка логирования
+# Ленивая инициализация
 # ---------------------------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    stream=sys.stdout,
-    encoding="utf-8"
-)
+# Импорт модуля ничего не делает: база состояния, каталог и клиент OpenAI
+# создаются при первом обращении или в init_openai_service() из create_app.
+# Настройки читаются из окружения в момент создания, то есть уже после
+# load_dotenv() в load_configurations.
+_init_lock = threading.RLock()
+_llm_client: Optional[LLMClient] = None
+
+def get_llm_client() -> LLMClient:
+    global _llm_client
+    if _llm_client is None:
+        with _init_lock:
+            if _llm_client is None:
+                _llm_client = client_from_env()
+    return _llm_client
+
+# Какая ветка generate_response ответила на последнее сообщение этого потока —
+# для замеров времени по веткам
+_branch = threading.local()
+
+def note_branch(name: Optional[str]):
+    _branch.name = name
+
+def last_branch() -> Optional[str]:
+    return getattr(_branch, "name", None)
+
+# Параметры генерации для веток, которые обращаются к GPT
+LLM_BRANCH_PARAMS = {
+    "recommendation": {"max_tokens": 500, "temperature": 0.7},
+    "fallback": {"max_tokens": 400, "temperature": 0.2},
+}
 
 # ---------------------------
 # Потокобезопасность
 # ---------------------------
-lock = threading.Lock()
+# Сообщения одного пользователя обрабатываются по очереди, разных — параллельно
+chat_locks = KeyedLock()
 
 # ---------------------------
-# Настройка базы данных SQLite через SQLAlchemy
+# Хранилище состояния пользователей (SQLite, WAL)
 # ---------------------------
-Base = declarative_base()
-
 class ChatMode(enum.Enum):
     BOT = "bot"
     MANAGER = "manager"
 
-class UserState(Base):
-    __tablename__ = 'user_states'
-    wa_id = Column(String, primary_key=True)
-    mode = Column(Enum(ChatMode), default=ChatMode.BOT)
-
-engine = create_engine('sqlite:///bot_database.db')
-Base.metadata.create_all(engine)
-SessionLocal = sessionmaker(bind=engine)
+_state_store: Optional[SQLiteStateStore] = None
+
+def get_state_store() -> SQLiteStateStore:
+    """Открывает базу состояния (и один раз переносит старые данные) при первом обращении."""
+    global _state_store
+    if _state_store is None:
+        with _init_lock:
+            if _state_store is None:
+                path = os.getenv("STATE_DB_PATH", "bot_state.db")
+                # Реплик на пользователя до архивации
+                history_window = int(os.getenv("HISTORY_WINDOW", "50"))
+                # Срок хранения архива переписки в днях (0 — бессрочно)
+                retention_days = float(os.getenv("HISTORY_ARCHIVE_DAYS", "365"))
+                pool_size = int(os.getenv("STATE_DB_POOL_SIZE", "8"))
+                store = SQLiteStateStore(path, history_window=history_window,
+                                         archive_retention_days=retention_days, pool_size=pool_size)
+                migrate_legacy_state(store)
+                _state_store = store
+    return _state_store
+
+# Режим читается почти на каждом сообщении, а меняется редко — держим его в памяти.
+# Запись сквозная: сначала база, затем кеш. Изменения из других процессов
+# становятся видны не позже чем через MODE_CACHE_TTL секунд.
+_mode_cache: Optional[TTLCache] = None
+
+def get_mode_cache() -> TTLCache:
+    global _mode_cache
+    if _mode_cache is None:
+        with _init_lock:
+            if _mode_cache is None:
+                _mode_cache = TTLCache(
+                    maxsize=int(os.getenv("MODE_CACHE_SIZE", "10000")),
+                    ttl=float(os.getenv("MODE_CACHE_TTL", "300")),
+                )
+    return _mode_cache
 
 def get_user_mode(wa_id: str) -> ChatMode:
-    session = SessionLocal()
-    try:
-        user = session.query(UserState).filter_by(wa_id=wa_id).first()
-        if user:
-            return user.mode
-        # Если пользователя нет — создаём запись с режимом BOT
-        new_user = UserState(wa_id=wa_id, mode=ChatMode.BOT)
-        session.add(new_user)
-        session.commit()
-        return new_user.mode
-    finally:
-        session.close()
+    mode_cache = get_mode_cache()
+    mode = mode_cache.get(wa_id)
+    if mode is not None:
+        return mode
+    # Промах не пишет в базу: нет записи — значит режим BOT
+    stored = get_state_store().get_mode(wa_id)
+    mode = ChatMode(stored) if stored else ChatMode.BOT
+    mode_cache.set(wa_id, mode)
+    return mode
 
 def set_user_mode(wa_id: str, mode: ChatMode):
-    session = SessionLocal()
-    try:
-        user = session.query(UserState).filter_by(wa_id=wa_id).first()
-        if user:
-            user.mode = mode
-        else:
-            user = UserState(wa_id=wa_id, mode=mode)
-            session.add(user)
-        session.commit()
-    finally:
-        session.close()
+    get_state_store().set_mode(wa_id, mode.value)
+    get_mode_cache().set(wa_id, mode)
+    MODE_SWITCHES.inc(mode.value)
+
+def warm_mode_cache(active_days: float = 7, limit: Optional[int] = None) -> int:
+    """Загружает в кеш режимы пользователей, писавших за последние active_days дней."""
+    mode_cache = get_mode_cache()
+    since = time.time() - active_days * 86400
+    rows = get_state_store().recent_modes(since, limit or mode_cache.maxsize)
+    for wa_id, mode in rows:
+        mode_cache.set(wa_id, ChatMode(mode))
+    logger.info("Кеш режимов прогрет: %s пользователей.", len(rows))
+    return len(rows)
 
 # ---------------------------
 # Словари ключевых слов для определения языка
@@ -136,15 +171,14 @@ SPILLED_SHEET = "spilled"
 def load_products_data(sheet_name: str) -> List[dict]:
     try:
         data = get_sheet_data(JSON_KEYFILE, SHEET_ID, sheet_name)
-        logging.info(f"Лист '{sheet_name}' загружен ({len(data)} строк).")
+        logger.info("Лист '%s' загружен (%s строк).", sheet_name, len(data))
         return data
     except Exception as e:
-        logging.error(f"Ошибка загрузки листа '{sheet_name}': {e}")
+        logger.error("Ошибка загрузки листа '%s': %s", sheet_name, e)
         return []
 
 
-def load_and_prepare_products(sheet_name: str, product_type: str) -> List[dict]:
-    raw_data = get_sheet_data(JSON_KEYFILE, SHEET_ID, sheet_name)
+def prepare_products(raw_data: List[dict], product_type: str) -> List[dict]:
     for item in raw_data:
         # Проставляем тип товара (original/spilled)
         item['type'] = product_type
@@ -179,86 +213,151 @@ def deduplicate_products(products: List[dict]) -> List[dict]:
             product['name'] = str(product.get('name', '')).title().strip()
             unique.append(product)
         else:
-            logging.debug(f"Дубликат пропущен: {product.get('name')} / {volume}")
+            logger.debug("Дубликат пропущен: %s / %s", product.get('name'), volume)
     return unique
 
 
-def get_unique_brands(products: List[dict]) -> set:
-    brands = set()
-    for p in products:
-        brand = p.get('brand', '')
-        if brand:
-            brands.add(brand)
-    return brands
-
-products_data: List[dict] = []
-unique_brands: set = set()
-
-def refresh_products_data():
-    global products_data, unique_brands
-    logging.info("Обновляем данные о продуктах из Google Sheets...")
-    original_list = load_and_prepare_products(ORIGINAL_SHEET, 'original')
-    spilled_list = load_and_prepare_products(SPILLED_SHEET, 'spilled')
-    combined = original_list + spilled_list
-    products_data = deduplicate_products(combined)
-    unique_brands = get_unique_brands(products_data)
-    logging.info(f" Всего товаров загружено: {len(products_data)}")
-    logging.info(f"Уникальных брендов загружено: {len(unique_brands)}")
-    logging.info(" Список загруженных товаров:")
-    for product in products_data:
-        logging.info(f"- {product.get('name')} ({product.get('type')})")
-
-def periodic_update():
-    refresh_products_data()
-    Timer(300, periodic_update).start()
-
-periodic_update()
-
-
-def find_products_by_brand(brand: str, products: List[dict]) -> List[dict]:
-    return [
-        p for p in products
-        if fuzz.token_set_ratio(p.get('brand', '').lower(), brand.lower()) >= 70
-    ]
-
-def is_follow_up_question(message: str, items: List[dict]) -> bool:
-    keywords = ["цена", "стоимость", "где купить", "наличие", "доступно", "сколько стоит"]
-    msg_lower = message.lower()
-    has_keyword = any(k in msg_lower for k in keywords)
-    has_product_name = any(p['name'].lower() in msg_lower for p in items)
-    return has_keyword and not has_product_name
-
-def is_purchase_request(message: str) -> bool:
-    buy_keywords = ["купить", "заказать", "оформить заказ", "купить сейчас", "хочу купить", "закажу","сатып алу", "тапсырыс беру" ]
-    return any(k in message.lower() for k in buy_keywords)
+# Один клиент на процесс: авторизация и открытие таблицы — только при первом чтении
+sheets_client = SheetsClient(JSON_KEYFILE, SHEET_ID)
+
+def load_catalog() -> Optional[List[dict]]:
+    """
+    Загружает оба листа одним запросом и возвращает список товаров без дубликатов.
+    Возвращает None, если таблица не менялась с прошлой загрузки.
+    """
+    logger.info("Обновляем данные о продуктах из Google Sheets...")
+    sheets = sheets_client.fetch_if_changed([ORIGINAL_SHEET, SPILLED_SHEET])
+    if sheets is None:
+        return None
+    try:
+        original_list = prepare_products(sheets.get(ORIGINAL_SHEET, []), 'original')
+        spilled_list = prepare_products(sheets.get(SPILLED_SHEET, []), 'spilled')
+        products = deduplicate_products(original_list + spilled_list)
+    except Exception:
+        # Данные прочитаны, но не разобраны — при следующем обновлении читаем заново
+        sheets_client.reset()
+        raise
+    # Полный список товаров — только в DEBUG: при тысячах позиций это тысячи строк на каждое обновление
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(" Список загруженных товаров:")
+        for product in products:
+            logger.debug("- %s (%s)", product.get('name'), product.get('type'))
+    return products
+
+# Один планировщик обновлений вместо двух цепочек Timer (300 и 3000 секунд)
+_catalog: Optional[CatalogManager] = None
+
+def get_catalog() -> CatalogManager:
+    """Поднимает каталог (с диска или из таблицы) и запускает обновления при первом обращении."""
+    global _catalog
+    if _catalog is None:
+        with _init_lock:
+            if _catalog is None:
+                manager = CatalogManager(
+                    load_catalog,
+                    interval=float(os.getenv("CATALOG_REFRESH_INTERVAL", "300")),
+                    # Последний удачный каталог на диске — для быстрого старта без Google Sheets
+                    snapshot_path=os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.pkl"),
+                )
+                manager.warm_start()
+                _catalog = manager
+    return _catalog
+
+# ---------------------------
+# Кеш ответов GPT
+# ---------------------------
+# Похожие вопросы («посоветуйте сладкое») повторяются почти дословно.
+# Для веток из LLM_CACHE_BRANCHES ответ GPT кешируется по нормализованному
+# сообщению, языку и версии каталога: после обновления цен старые ответы
+# просто перестают находиться. Кеш используется только для пользователей
+# без истории диалога — ответ с учётом переписки одному человеку не
+# подходит другому, а отбрасывать историю ради кеша нельзя.
+# Ветки: "recommendation" (общие рекомендации) и "fallback" (последний шаг).
+# По умолчанию кеширование выключено.
+_answer_caches: Optional[Dict[str, TTLCache]] = None
+
+def get_answer_caches() -> Dict[str, TTLCache]:
+    global _answer_caches
+    if _answer_caches is None:
+        with _init_lock:
+            if _answer_caches is None:
+                branches = os.getenv("LLM_CACHE_BRANCHES", "")
+                _answer_caches = {
+                    branch.strip(): TTLCache(
+                        maxsize=int(os.getenv("LLM_CACHE_SIZE", "1000")),
+                        ttl=float(os.getenv("LLM_CACHE_TTL", "3600")),
+                    )
+                    for branch in branches.split(",") if branch.strip()
+                }
+    return _answer_caches
+
+def get_answer_cache(branch: str) -> Optional[TTLCache]:
+    """Кеш ответов ветки или None, если для неё кеширование выключено."""
+    return get_answer_caches().get(branch)
+
+def answer_cache_key(message: str, lang: str, snapshot: CatalogSnapshot) -> tuple:
+    return " ".join(normalize_text(message).split()), lang, snapshot.version
+
+def init_openai_service():
+    """Создаёт всё, что нужно для ответов, заранее — до первого сообщения. Повторный вызов ничего не делает."""
+    get_state_store()
+    get_mode_cache()
+    get_answer_caches()
+    get_catalog()
+    get_llm_client()
+
+
+@traced("catalog.products_by_brand")
+def find_products_by_brand(brand: str, index: CatalogIndex) -> List[dict]:
+    return index.products_by_brand(brand, 70, scorer=fuzz.token_set_ratio)
+
+def is_follow_up_question(message: str, index: CatalogIndex, intents: Optional[FrozenSet[str]] = None) -> bool:
+    if intents is None:
+        intents = classify_intents(message)
+    return "follow_up" in intents and not index.name_in_text(message.lower())
+
+def is_purchase_request(message: str, intents: Optional[FrozenSet[str]] = None) -> bool:
+    if intents is None:
+        intents = classify_intents(message)
+    return "purchase" in intents
 
 def save_last_product(wa_id: str, product: dict):
-    with shelve.open("last_product_db", writeback=True) as db:
-        db[wa_id] = product
+    get_state_store().set_last_product(wa_id, product)
 
 def get_last_product(wa_id: str, query: Optional[str] = None) -> Optional[dict]:
-    with shelve.open("last_product_db") as db:
-        last_product = db.get(wa_id)
+    last_product = get_state_store().get_last_product(wa_id)
 
-        # Если есть запрос, проверяем, соответствует ли последний товар названию
-        if query and last_product:
-            match_score = fuzz.partial_ratio(query.lower(), last_product["name"].lower())
-            if match_score >= 85:  # Порог схожести
-                return last_product
-            return None  # Если не соответствует
-        return last_product
+    # Если есть запрос, проверяем, соответствует ли последний товар названию
+    if query and last_product:
+        match_score = fuzz.partial_ratio(query.lower(), last_product["name"].lower())
+        if match_score >= 85:  # Порог схожести
+            return last_product
+        return None  # Если не соответствует
+    return last_product
 
 
 def save_user_conversation(wa_id: str, user_text: str, bot_text: str):
-    with shelve.open("conversation_history", writeback=True) as db:
-        if wa_id not in db:
-            db[wa_id] = []
-        db[wa_id].append({"user_message": user_text, "bot_response": bot_text})
-
-def get_user_conversation(wa_id: str, max_messages: int = 10) -> List[dict]:
-    with shelve.open("conversation_history") as db:
-        full_history = db.get(wa_id, [])
-        return full_history[-max_messages:]
+    get_state_store().append_history(wa_id, user_text, bot_text)
+
+def get_user_conversation(wa_id: str, max_messages: Optional[int] = None) -> List[dict]:
+    max_messages = max_messages or int(os.getenv("HISTORY_TURNS", "20"))
+    return get_state_store().get_history(wa_id, max_messages)
+
+@traced("history.build")
+def get_history_messages(conversation: List[dict]) -> List[dict]:
+    """История для промпта GPT в пределах HISTORY_TOKEN_BUDGET (старые реплики — выжимками)."""
+    return build_history_messages(
+        conversation,
+        budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "1200")),
+        summary_budget=int(os.getenv("HISTORY_SUMMARY_TOKENS", "200")),
+    )
+
+def mark_user_greeted(wa_id: str) -> bool:
+    """
+    Отмечает, что пользователь получил приветствие.
+    Возвращает True, если это его первое сообщение.
+    """
+    return get_state_store().mark_greeted(wa_id)
 
 # ---------------------------
 # Функция определения языка
@@ -284,62 +383,90 @@ def detect_language(message: str) -> str:
 # ---------------------------
 # Основная логика
 # ---------------------------
-def get_products_list():
-    return "\n".join([f"{p['name']} ({p['cost']} KZT)" for p in products_data]) 
-
+def format_product_line(product: dict) -> str:
+    return (f"{product.get('name')} ({product.get('volume', '')}, "
+            f"{product.get('cost')} KZT, {product.get('country', '')})")
 
-def extract_brand_from_message(message: str) -> Tuple[Optional[str], Optional[List[str]], bool]:
+@traced("catalog.products_context")
+def get_products_context(message: str, conversation: List[dict],
+                         snapshot: Optional[CatalogSnapshot] = None) -> str:
     """
-    Более гибкий поиск бренда с помощью fuzzy, чтобы 'Armani' находил 'Giorgio Armani'.
+    Список товаров для системного промпта вместо всего каталога: сначала
+    самые подходящие к сообщению и последним репликам пользователя,
+    затем (если осталось место) остальные по порядку каталога.
+    Не больше PRODUCT_CONTEXT_LIMIT строк и PRODUCT_CONTEXT_TOKENS токенов.
+    """
+    snapshot = snapshot or get_catalog().current()
+    limit = int(os.getenv("PRODUCT_CONTEXT_LIMIT", "40"))
+    budget = int(os.getenv("PRODUCT_CONTEXT_TOKENS", "1500"))
+
+    history = " ".join(c["user_message"] for c in conversation[-3:])
+    relevant = snapshot.index.relevant_products(message, limit, context=history)
+
+    lines, used, seen = [], 0, set()
+    for product in relevant + list(snapshot.products):
+        if len(lines) >= limit:
+            break
+        if id(product) in seen:
+            continue
+        seen.add(id(product))
+        line = format_product_line(product)
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    logger.debug("Товаров в промпте: %s (подобрано %s), ~%s токенов.", len(lines), len(relevant), used)
+    return "\n".join(lines)
+
+
+@traced("catalog.extract_brand")
+def extract_brand_from_message(message: str, index: Optional[CatalogIndex] = None) -> Tuple[Optional[str], Optional[List[str]], bool]:
+    """
+    Ищет бренд в сообщении: сначала точное вхождение слов бренда,
+    затем fuzzy, чтобы 'Armani' находил 'Giorgio Armani'.
     Возвращает (best_match, None, is_spilled).
     """
-    message_clean = message.lower().translate(str.maketrans('', '', string.punctuation)).strip()
+    message_clean = normalize_text(message)
     is_spilled = any(word in message_clean for word in ["разлив", "разливные", "құйма"])
 
-    best_match = None
-    highest_score = 0
-
-    for brand in unique_brands:
-        # Тут можно попробовать token_set_ratio
-        score = fuzz.token_set_ratio(message_clean, brand.lower())
-        if score > highest_score:
-            highest_score = score
-            best_match = brand
-
-    # Порог лучше подбирать на практике
-    if best_match and highest_score >= 60:
-        return best_match, None, is_spilled
-    else:
-        return None, None, is_spilled
+    # Порог fuzzy лучше подбирать на практике
+    index = index or get_catalog().current().index
+    best_match = index.brand_matcher.match(message_clean, score_cutoff=60)
+    return best_match, None, is_spilled
 
 
 
-def search_product(query: str) -> Optional[dict]:
+@traced("catalog.search_product")
+def search_product(query: str, index: Optional[CatalogIndex] = None) -> Optional[dict]:
     query = query.lower().strip()
-    logging.info(f"Поиск продукта: {query}")
+    logger.info("Поиск продукта: %s", query)
+
+    index = index or get_catalog().current().index
 
     # 1. Прямое совпадение по названию или бренду
-    for product in products_data:
-        if query in product["name"].lower() or query in product["brand"].lower():
-            return product
+    product = index.find_substring(query)
+    if product:
+        return product
 
     # 2. Улучшенный поиск по бренду
-    extracted_brand, _, _ = extract_brand_from_message(query)
+    extracted_brand, _, _ = extract_brand_from_message(query, index)
     if extracted_brand:
-        brand_products = [p for p in products_data if fuzz.token_sort_ratio(extracted_brand.lower(), p["brand"].lower()) >= 75]
+        brand_products = index.products_by_brand(extracted_brand, 75, scorer=fuzz.token_sort_ratio)
         if brand_products:
             return brand_products[0]
 
     # 3. Улучшенный fuzzy поиск по названию
-    best_match = process.extractOne(query, [p["name"].lower() for p in products_data], scorer=fuzz.token_sort_ratio)
+    best_match = index.best_name(query)
     if best_match and best_match[1] >= 70:
-        return next((p for p in products_data if fuzz.token_sort_ratio(p["name"].lower(), best_match[0]) >= 80), None)
+        return index.first_similar_name(best_match[0], 80)
 
-    logging.info(f"Продукт '{query}' не найден в базе.")
+    logger.info("Продукт '%s' не найден в базе.", query)
     return None
 
 
-def find_best_match(query: str, items: List[dict]) -> Optional[dict]:
+@traced("catalog.find_best_match")
+def find_best_match(query: str, index: CatalogIndex) -> Optional[dict]:
     """
     Улучшенный поиск товара с приоритетом на 'original'.
     Если пользователь в тексте явно не просил 'разлив', 'спиллед' и т.п.,
@@ -352,68 +479,72 @@ def find_best_match(query: str, items: List[dict]) -> Optional[dict]:
     spilled_keywords = ["разлив", "разливные", "құйма", "отливант", "sample", "decant", "1ml", "1 мл"]
     user_asks_spilled = any(kw in query_clean for kw in spilled_keywords)
 
-    # Функция для fuzzy-поиска внутри списка
-    def fuzzy_search(q, candidates):
-        best = process.extractOne(
-            q,
-            [c["name"].lower() for c in candidates if "name" in c],
-            scorer=fuzz.token_sort_ratio
-        )
+    # Fuzzy-поиск по названиям товаров одного типа
+    def fuzzy_search(q, product_type):
+        best = index.best_name(q, product_type=product_type)
         if best and best[1] >= 70:
-            # Находим сам товар
-            return next((p for p in candidates if p["name"].lower() == best[0]), None)
+            return best[2]
         return None
 
     if user_asks_spilled:
         # Если пользователь явно говорит про разлив
-        spilled_only = [p for p in items if p.get("type") == "spilled"]
-        return fuzzy_search(query_clean, spilled_only)
+        return fuzzy_search(query_clean, "spilled")
 
     else:
         # Сначала пытаемся найти original
-        original_only = [p for p in items if p.get("type") == "original"]
-        found_original = fuzzy_search(query_clean, original_only)
+        found_original = fuzzy_search(query_clean, "original")
 
         if found_original:
             return found_original
         else:
             # Если в original ничего не нашли, пробуем spilled
-            spilled_only = [p for p in items if p.get("type") == "spilled"]
-            return fuzzy_search(query_clean, spilled_only)
+            return fuzzy_search(query_clean, "spilled")
 
 
 
-def is_price_query(message: str) -> bool:
+def is_price_query(message: str, intents: Optional[FrozenSet[str]] = None) -> bool:
     """
     Проверяет, спрашивает ли пользователь цену.
     """
-    price_keywords = ["цена", "сколько стоит", "стоимость", "по чем", "қанша тұрады"]
-    text = message.lower()
-    return any(kw in text for kw in price_keywords)
+    if intents is None:
+        intents = classify_intents(message)
+    return "price" in intents
 
-def is_general_recommendation_query(message: str) -> bool:
+def is_general_recommendation_query(message: str, intents: Optional[FrozenSet[str]] = None) -> bool:
     """
     Проверяет, хочет ли пользователь общую консультацию по выбору аромата,
     а не конкретный товар.
     """
-    recommendation_keywords = [
-        "подобрать", "помогите выбрать", "посоветуйте", "подскажите",
-        "рекомендовать", "лучший аромат", "что выбрать", "совет"
-    ]
-    
     # Если в сообщении есть слова о выборе, считаем это рекомендацией
-    text = message.lower()
-    return any(kw in text for kw in recommendation_keywords)
+    if intents is None:
+        intents = classify_intents(message)
+    return "recommendation" in intents
 
 
 def generate_response(message_body: str, wa_id: str, sender_name: str) -> Optional[str]:
-    with lock:
-        logging.info(f"Пользователь {wa_id} спрашивает: {message_body}")
+    """Ответ на сообщение; время ответа пишется в метрики по ветке, которая ответила."""
+    started = time.perf_counter()
+    try:
+        with span("generate_response"):
+            return _generate_response(message_body, wa_id, sender_name)
+    except Exception:
+        note_branch("error")
+        ERRORS.inc("generate_response")
+        raise
+    finally:
+        RESPONSE_SECONDS.observe(time.perf_counter() - started, last_branch() or "unknown")
+
+
+def _generate_response(message_body: str, wa_id: str, sender_name: str) -> Optional[str]:
+    with chat_locks.hold(wa_id):
+        note_branch(None)
+        logger.info("Пользователь %s спрашивает: %s", wa_id, message_body)
 
 
         # 1. Проверка пустого сообщения
         if not message_body or not isinstance(message_body, str):
-            logging.info(f"Получено не текстовое сообщение от {wa_id}. Переключаем на менеджера.")
+            note_branch("non_text")
+            logger.info("Получено не текстовое сообщение от %s. Переключаем на менеджера.", wa_id)
 
             set_user_mode(wa_id, ChatMode.MANAGER)
 
@@ -425,40 +556,43 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
 
         # 2. Приветствие нового пользователя
-        with shelve.open("user_sessions") as db:
-            if wa_id not in db:  # Если это первое сообщение от пользователя
-                db[wa_id] = True  # Записываем в базу, что пользователь уже получил приветствие
-                
-                welcome_message_ru = (
-                    f" Здравствуйте, {sender_name}! \n\n"
-                    "Если хотите оформить заказ, напишите *'менеджер'*, и я вас соединю.\n"
-                    "Если хотите подобрать парфюм, укажите предпочтения (например: цветочный, свежий, сладкий) "
-                    "или название конкретного аромата.\n"
-                    "Я помогу вам с ценами, наличием и подбором.\n\n"
-                    "Чем могу помочь? "
-                )
-                welcome_message_kz = (
-                    f" Сәлеметсіз бе, {sender_name}! \n\n"
-                    "Егер сіз тапсырыс бергіңіз келсе, *'менеджер'* деп жазыңыз, мен сізді қосамын.\n"
-                    "Егер сізге хош иіс таңдау қажет болса, өз қалауыңызды айтыңыз "
-                    "(мысалы: гүлді, сергіткіш, тәтті) немесе нақты иісті атаңыз.\n"
-                    "Мен баға, қол жетімділік және таңдау бойынша көмектесе аламын.\n\n"
-                    "Қалай көмектесе аламын? "
-                )
+        if mark_user_greeted(wa_id):  # Если это первое сообщение от пользователя
+            note_branch("welcome")
+            welcome_message_ru = (
+                f" Здравствуйте, {sender_name}! \n\n"
+                "Если хотите оформить заказ, напишите *'менеджер'*, и я вас соединю.\n"
+                "Если хотите подобрать парфюм, укажите предпочтения (например: цветочный, свежий, сладкий) "
+                "или название конкретного аромата.\n"
+                "Я помогу вам с ценами, наличием и подбором.\n\n"
+                "Чем могу помочь? "
+            )
+            welcome_message_kz = (
+                f" Сәлеметсіз бе, {sender_name}! \n\n"
+                "Егер сіз тапсырыс бергіңіз келсе, *'менеджер'* деп жазыңыз, мен сізді қосамын.\n"
+                "Егер сізге хош иіс таңдау қажет болса, өз қалауыңызды айтыңыз "
+                "(мысалы: гүлді, сергіткіш, тәтті) немесе нақты иісті атаңыз.\n"
+                "Мен баға, қол жетімділік және таңдау бойынша көмектесе аламын.\n\n"
+                "Қалай көмектесе аламын? "
+            )
 
-                response = welcome_message_ru if detect_language(message_body) == "ru" else welcome_message_kz
-                return response  # Отправляем приветственное сообщение и завершаем обработку
+            response = welcome_message_ru if detect_language(message_body) == "ru" else welcome_message_kz
+            return response  # Отправляем приветственное сообщение и завершаем обработку
 
 
         # 3. Определяем язык, проверяем режим (BOT / MANAGER)
         lower_msg = message_body.lower()
         lang = detect_language(lower_msg)  # Определяем язык
+        # Все намерения сообщения за один проход; дальше ветки проверяются по порядку
+        intents = classify_intents(lower_msg)
+        # Снимок каталога фиксируется на всё время обработки сообщения
+        snapshot = get_catalog().current()
+        catalog_index = snapshot.index
         current_mode = get_user_mode(wa_id)
 
         if current_mode == ChatMode.MANAGER:
+            note_branch("manager_mode")
             # Если пользователь в режиме MANAGER, но хочет завершить
-            if ("завершить разговор" in lower_msg or "бот" in lower_msg) or \
-               ("әңгіме" in lower_msg and "аяқтау" in lower_msg):
+            if "end_dialog" in intents:
                 set_user_mode(wa_id, ChatMode.BOT)
                 response_ru = "Диалог с менеджером завершён, я снова к вашим услугам!"
                 response_kz = "Менеджермен сөйлесу аяқталды, мен қайтадан сізге көмектесе аламын!"
@@ -467,8 +601,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
         
 
         # 4. Проверка, хочет ли пользователь менеджера
-        if ("переключить" in lower_msg or "менеджер" in lower_msg or "связаться с менеджером" in lower_msg) or \
-           ("менеджер" in lower_msg and "байланыс" in lower_msg):
+        if "manager_request" in intents:
+            note_branch("manager_request")
             set_user_mode(wa_id, ChatMode.MANAGER)
             response_ru = "Я переключаю вас на менеджера. Ожидайте, он скоро с вами свяжется!"
             response_kz = "Мен сізді менеджерге қосамын. Ол сізбен жақында байланысады!"
@@ -476,8 +610,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
 
         # 5. Проверка, хочет ли пользователь завершить разговор
-        if ("завершить разговор" in lower_msg or "бот" in lower_msg) or \
-           ("әңгіме" in lower_msg and "аяқтау" in lower_msg):
+        if "end_dialog" in intents:
+            note_branch("end_dialog")
             set_user_mode(wa_id, ChatMode.BOT)
             response_ru = "Диалог с менеджером завершён, я снова к вашим услугам!"
             response_kz = "Менеджермен сөйлесу аяқталды, мен қайтадан сізге көмектесе аламын!"
@@ -485,11 +619,9 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
             return answer
 
         # 6. **Приветствие** (если пользователь просто поздоровался)
-        greeting_ru = ["привет", "здравствуйте", "добрый день", "добрый вечер", "салам"]
-        greeting_kz = ["сәлем", "қайырлы күн", "қайырлы кеш" "салеметсизбе", "салеметсиз бе", "салем",]
-
-        if (any(word in lower_msg for word in greeting_ru) and lang == "ru") or \
-           (any(word in lower_msg for word in greeting_kz) and lang == "kz"):
+        if ("greeting_ru" in intents and lang == "ru") or \
+           ("greeting_kz" in intents and lang == "kz"):
+            note_branch("greeting")
             resp_ru = ( f" Здравствуйте, {sender_name}!\n\n" 
                        "Если хотите оформить заказ, напишите *'менеджер'*, и я вас соединю.\n" 
                        "Если хотите подобрать парфюм, укажите предпочтения (например: цветочный, свежий, сладкий) " "или название конкретного аромата.\n" 
@@ -507,8 +639,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
             return response
         
         # 7. **Проверка запроса про адрес** 
-        if any(word in lower_msg for word in ["адрес", "где вы", "местоположение", "где находится", "как добраться"]) or \
-        any(word in lower_msg for word in ["мекенжай", "қай жерде", "орналасқан", "қайда"]):
+        if "address" in intents:
+            note_branch("address")
 
             resp_ru = (
                 "Наш магазин парфюмерии aera находится по адресу: \n"
@@ -531,7 +663,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
 
         # 8. Шаблонные ответы (пример: доставка)
-        if "доставка" in lower_msg or "жеткізу" in lower_msg:
+        if "delivery" in intents:
+            note_branch("delivery")
             resp_ru = (
                 "Мы доставляем заказы по всему Казахстану:\n"
                 "В пределах г. Астана — стандартная доставка.\n"
@@ -556,12 +689,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
         
 
                 # 8(2). Проверяем, спрашивает ли пользователь про рассрочку
-        installment_keywords = [
-            "рассрочка", "оплата частями", "kaspi red", "kaspi рассрочка",
-            "можно в рассрочку", "можно ли оплатить частями"
-        ]
-
-        if any(word in lower_msg for word in installment_keywords):
+        if "installment" in intents:
+            note_branch("installment")
             resp_ru = (
                 "Мы предоставляем возможность оплаты в рассрочку. "
                 "Для уточнения деталей напишите *'менеджер'*, он подскажет все условия!"
@@ -576,12 +705,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
             return response
 
         # 8(3). Проверяем, спрашивает ли пользователь про оригинал или копию
-        originality_keywords = [
-            "оригинал", "копия", "реплика", "подделка", "настоящий",
-            "сертифицированный", "оригинальная продукция", "реплика или оригинал"
-        ]
-
-        if any(word in lower_msg for word in originality_keywords):
+        if "originality" in intents:
+            note_branch("originality")
             resp_ru = (
                 "Вся продукция в нашем магазине является оригинальной и сертифицированной. "
                 "Если у вас есть дополнительные вопросы, напишите *'менеджер'*, он предоставит всю информацию!"
@@ -597,11 +722,21 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
 
         # 9. Проверка, хочет ли пользователь общую рекомендацию
-        if is_general_recommendation_query(lower_msg):
-            logging.info(f"Запрос на рекомендацию: {message_body}")
+        if is_general_recommendation_query(lower_msg, intents):
+            note_branch("recommendation")
+            logger.info("Запрос на рекомендацию: %s", message_body)
 
             try:
                 conversation = get_user_conversation(wa_id)
+                # Кеш — только для первого вопроса: ответ не должен зависеть от истории диалога
+                cache = get_answer_cache("recommendation") if not conversation else None
+                cache_key = answer_cache_key(message_body, lang, snapshot)
+                cached = cache.get(cache_key) if cache is not None else None
+                if cached is not None:
+                    logger.info("Рекомендация взята из кеша ответов.")
+                    save_user_conversation(wa_id, message_body, cached)
+                    return cached
+
                 messages = [
                     {
                         "role": "system",
@@ -616,7 +751,7 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
                         "НЕЛЬЗЯ придумывать или дополнять поля `name`, `volume`, `cost`, `country` "
                         "значениями, которых нет в базе. Никаких гипотез!\n\n"
                         "Вот список товаров:\n"
-                        f"{get_products_list()}\n"
+                        f"{get_products_context(message_body, conversation, snapshot)}\n"
                         "Если запрос не относится к товарам или базе, предложи обратиться к менеджеру."
                         "Если у пользователя остались вопросы, предлагай написать *'менеджер'* для связи с сотрудником.\n"
                         "Если не можешь найти товар, просто сообщи, что переключаешь пользователя на менеджера."
@@ -624,49 +759,44 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
                     }
                 ]
 
-                for c in conversation:
-                    messages.append({"role": "user", "content": c["user_message"]})
-                    messages.append({"role": "assistant", "content": c["bot_response"]})
+                messages.extend(get_history_messages(conversation))
                 messages.append({"role": "user", "content": message_body})
 
-                gpt_response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=messages,
-                    max_tokens=500,
-                    temperature=0.7
-                )
-                answer_raw = gpt_response["choices"][0]["message"]["content"].strip()
+                answer_raw = get_llm_client().complete(messages, **LLM_BRANCH_PARAMS["recommendation"])
 
                 # Проверяем, есть ли в ответе упоминание разливных ароматов
-                is_spilled_response = any(p['name'].lower() in answer_raw.lower() and p['type'] == 'spilled' for p in products_data)
+                answer_lower = answer_raw.lower()
+                is_spilled_response = any(name in answer_lower for name in catalog_index.spilled_names)
 
                 # Проверяем, что в ответе есть конкретный продукт и указана цена
-                has_price = any(str(p['cost']) in answer_raw for p in products_data if p['cost'])
+                has_price = any(str(p['cost']) in answer_raw for p in snapshot.products if p['cost'])
 
                 # Если ответ точно о разливном аромате и есть цена, добавляем уточнение
                 if is_spilled_response and has_price:
                     answer_raw += "\n *Некоторые цены указаны за 1 мл.*"
 
-
+                if cache is not None:
+                    cache.set(cache_key, answer_raw)
 
                 save_user_conversation(wa_id, message_body, answer_raw)
                 return answer_raw
                 
             except Exception as e:
-                logging.error(f"Ошибка при обращении к OpenAI: {e}")
+                logger.error("Ошибка при обращении к OpenAI: %s", e)
+                ERRORS.inc("recommendation")
                 resp_ru = "Извините, не могу найти информацию по вашему вопросу. Если хотите поговорить с менеджером, напишите 'менеджер'."
                 resp_kz = "Кешіріңіз, бізде бұл сұраққа қатысты ақпарат жоқ. Егер сіз менеджермен сөйлескіңіз келсе, «менеджер» деп жазыңыз."
                 return resp_ru if lang == "ru" else resp_kz
 
 
         # 8. Полный флакон
-        if any(word in lower_msg for word in ["полный объем", "флакон", "оригинал", "бутылка"]) or \
-        any(word in lower_msg for word in ["толық көлем", "құты"]):
+        if "full_bottle" in intents:
+            note_branch("full_bottle")
 
-            logging.info("Запрос на оригинальный флакон")
+            logger.info("Запрос на оригинальный флакон")
             
             # Пытаемся найти продукт по текущему запросу
-            original_product = search_product(lower_msg)
+            original_product = search_product(lower_msg, catalog_index)
             
             # Если по текущему запросу продукт не найден,
             # просим пользователя уточнить название товара.
@@ -690,7 +820,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
 
         # 9. Цена (is_price_query)
-        if is_price_query(lower_msg):
+        if is_price_query(lower_msg, intents):
+            note_branch("price")
             # Получаем последний обсуждаемый товар
             last_product = get_last_product(wa_id)
 
@@ -713,7 +844,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
         
     
         # 10. Проверка уточнений (is_follow_up_question)
-        if is_follow_up_question(message_body, products_data):
+        if is_follow_up_question(message_body, catalog_index, intents):
+            note_branch("follow_up")
             last_product = get_last_product(wa_id)
             
             # Проверяем, содержит ли запрос название последнего товара
@@ -735,21 +867,20 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
 
         # 11. Разлив
-        extracted_brand, ambiguity, is_spilled = extract_brand_from_message(message_body)
+        extracted_brand, ambiguity, is_spilled = extract_brand_from_message(message_body, catalog_index)
         
         if extracted_brand == "Нет бренда":
-            logging.info("Бренд не найден, продолжаем обработку другим способом.")
+            logger.info("Бренд не найден, продолжаем обработку другим способом.")
         
-        if is_spilled or "разлив" in lower_msg or "разливные" in lower_msg or "құйма" in lower_msg:
+        if is_spilled or "spilled" in intents:
+            note_branch("spilled")
             if extracted_brand:
-                logging.info(f"Запрос на разливную парфюмерию для бренда: {extracted_brand}")
+                logger.info("Запрос на разливную парфюмерию для бренда: %s", extracted_brand)
 
                 # Используем fuzzy matching для поиска товаров с типом "spilled"
-                brand_products = [
-                    p for p in products_data 
-                    if p.get('type') == 'spilled' and 
-                    fuzz.token_set_ratio(p.get('brand', '').lower(), extracted_brand.lower()) >= 80
-                ]
+                brand_products = catalog_index.products_by_brand(
+                    extracted_brand, 80, scorer=fuzz.token_set_ratio, product_type="spilled"
+                )
                 
                 # Если не найдено ни одного товара, просим уточнить запрос, вместо ответа о не наличии
                 if not brand_products:
@@ -757,7 +888,7 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
                     save_user_conversation(wa_id, message_body, response)
                     return response
 
-                detailed_request = any(word in lower_msg for word in ["все", "показать", "список", "какие", "барлығы", "қандай"])
+                detailed_request = "list_request" in intents
                 if detailed_request:
                     resp_ru = f"Из разливной парфюмерии бренда {extracted_brand} у нас есть:\n" + "\n".join(
                         [f"{i+1}. {p['name']}" for i, p in enumerate(brand_products)]
@@ -799,6 +930,7 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
             
         # Если есть двусмысленность в бренде
         if ambiguity:
+            note_branch("brand_ambiguity")
             resp_ru = "Уточните, пожалуйста, какой бренд вы имеете в виду: " + ", ".join(ambiguity)
             resp_kz = "Қай брендті айтып тұрғаныңызды нақтылаңыз: " + ", ".join(ambiguity)
             answer = resp_ru if lang == "ru" else resp_kz
@@ -808,31 +940,21 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
         # 12 Бренд (extract_brand_from_message)
         if extracted_brand:
-            logging.info(f"Найден бренд: {extracted_brand}")
+            note_branch("brand")
+            logger.info("Найден бренд: %s", extracted_brand)
             
             # --- Определяем, спрашивает ли пользователь разлив
-            spilled_keywords = ["разлив", "разливные", "құйма", "sample", "отливант", "1 мл", "1ml"]
             lower_msg_clean = lower_msg.replace("мл.","мл").strip()
-            user_asks_spilled = any(kw in lower_msg_clean for kw in spilled_keywords)
+            user_asks_spilled = "spilled_request" in intents
 
             # --- Собираем товары по бренду (original или spilled)
             if user_asks_spilled:
-                brand_products = [
-                    p for p in products_data
-                    if p.get("brand", "").lower() == extracted_brand.lower()
-                    and p.get("type") == "spilled"
-                ]
+                brand_products = catalog_index.products_with_brand(extracted_brand, product_type="spilled")
             else:
-                brand_products_original = [
-                    p for p in products_data
-                    if fuzz.token_set_ratio(p["brand"].lower(), extracted_brand.lower()) >= 70
-                    and p["type"] == "original"
-                ]
-                brand_products_spilled = [
-                    p for p in products_data
-                    if p.get("brand", "").lower() == extracted_brand.lower()
-                    and p.get("type") == "spilled"
-                ]
+                brand_products_original = catalog_index.products_by_brand(
+                    extracted_brand, 70, scorer=fuzz.token_set_ratio, product_type="original"
+                )
+                brand_products_spilled = catalog_index.products_with_brand(extracted_brand, product_type="spilled")
                 brand_products = brand_products_original if brand_products_original else brand_products_spilled
 
             # --- Вычисляем leftover
@@ -880,8 +1002,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
                 scorer=fuzz.token_sort_ratio
             )
             if fuzzy_match and fuzzy_match[1] >= 60:
-                matched_name = fuzzy_match[0]
-                matched_item = next((p for p in brand_products if p["name"].lower() == matched_name), None)
+                # extractOne возвращает номер первого лучшего совпадения — это и есть товар
+                matched_item = brand_products[fuzzy_match[2]]
                 if matched_item:
                     # Возвращаем информацию об этом конкретном товаре
                     cost_text = matched_item.get('cost', 'нет цены')
@@ -942,7 +1064,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
 
         # 13. Покупка (is_purchase_request)
-        if is_purchase_request(lower_msg):
+        if is_purchase_request(lower_msg, intents):
+            note_branch("purchase")
             resp_ru = "Я не могу оформить заказ, но передам ваш запрос менеджеру! Напишите *'менеджер'*, и он свяжется с вами."
             resp_kz = "Мен тапсырысты рәсімдей алмаймын, бірақ сізді менеджерге қосамын! *'менеджер'* деп жазыңыз, ол сізбен байланысады."
             
@@ -952,7 +1075,7 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
         
 
         # 14. Ищем конкретный товар
-        matched_product = find_best_match(lower_msg, products_data)
+        matched_product = find_best_match(lower_msg, catalog_index)
 
         # Проверяем, что matched_product не список и не None
         if isinstance(matched_product, list) and matched_product:
@@ -961,6 +1084,7 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
             matched_product = None  # Если не dict и не список, устанавливаем None
 
         if matched_product:
+            note_branch("product")
             # Получаем данные с безопасным `.get()`, чтобы избежать `NoneType` ошибки
             name = matched_product.get('name', 'Неизвестно')
             description = matched_product.get('description', 'нет данных')
@@ -1001,57 +1125,57 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
         
         if matched_product is None:
-            logging.info("Ничего не нашли по find_best_match.") 
+            logger.info("Ничего не нашли по find_best_match.") 
         elif matched_product.get('cost') is None:
-            logging.info(f"У товара {matched_product['name']} нет цены.")
+            logger.info("У товара %s нет цены.", matched_product['name'])
         else:
-            logging.info(f"Цена продукта {matched_product['name']}: {matched_product['cost']} KZT")
+            logger.info("Цена продукта %s: %s KZT", matched_product['name'], matched_product['cost'])
 
 
 
 
         # 15. Если всё остальное не подошло — просим ChatGPT ответить
+        note_branch("fallback")
         answer_raw = None  # Переменная для хранения ответа от ChatGPT
 
         try:
             conversation = get_user_conversation(wa_id)
-            
-            # Составляем системное сообщение с жёсткой инструкцией:
-            system_message = (
-                "Ты — ассистент магазина парфюмерии. Отвечай кратко на русском или казахском.\n"
-                "У тебя есть база товаров (ниже), содержащая поля `name`, `volume`, `cost`, `country`.\n"
-                "Ты можешь предоставлять пользователю ТОЛЬКО информацию из этих полей.\n\n"
-                # ↓↓↓ В ЭТОМ МЕСТЕ меняем инструкцию ↓↓↓
-                "Если пользователь спрашивает про любой товар, которого нет в этом списке, НЕ говори, что его нет, "
-                "а сразу советуй переключиться на менеджера.\n"
-                # ↑↑↑ Вместо «скажи, что нет в наличии», просим «советуй переключиться на менеджера» ↑↑↑
-                "Если у товара в базе нет указанных полей (например, нет `volume`), "
-                "скажи, что такой информации нет и тоже предложи обратиться к менеджеру.\n\n"
-                "НЕЛЬЗЯ придумывать или дополнять поля `name`, `volume`, `cost`, `country` "
-                "значениями, которых нет в базе. Никаких гипотез!\n\n"
-                "Вот список товаров:\n"
-                f"{get_products_list()}\n"
-                "Если запрос не относится к товарам или базе, предложи обратиться к менеджеру. "
-                "Если у пользователя остались вопросы, предлагай написать *'менеджер'*.\n"
-            )
+            # Кеш — только для первого вопроса: ответ не должен зависеть от истории диалога
+            cache = get_answer_cache("fallback") if not conversation else None
+            cache_key = answer_cache_key(message_body, lang, snapshot)
+            answer_raw = cache.get(cache_key) if cache is not None else None
+            if answer_raw is None:
+
+                # Составляем системное сообщение с жёсткой инструкцией:
+                system_message = (
+                    "Ты — ассистент магазина парфюмерии. Отвечай кратко на русском или казахском.\n"
+                    "У тебя есть база товаров (ниже), содержащая поля `name`, `volume`, `cost`, `country`.\n"
+                    "Ты можешь предоставлять пользователю ТОЛЬКО информацию из этих полей.\n\n"
+                    # ↓↓↓ В ЭТОМ МЕСТЕ меняем инструкцию ↓↓↓
+                    "Если пользователь спрашивает про любой товар, которого нет в этом списке, НЕ говори, что его нет, "
+                    "а сразу советуй переключиться на менеджера.\n"
+                    # ↑↑↑ Вместо «скажи, что нет в наличии», просим «советуй переключиться на менеджера» ↑↑↑
+                    "Если у товара в базе нет указанных полей (например, нет `volume`), "
+                    "скажи, что такой информации нет и тоже предложи обратиться к менеджеру.\n\n"
+                    "НЕЛЬЗЯ придумывать или дополнять поля `name`, `volume`, `cost`, `country` "
+                    "значениями, которых нет в базе. Никаких гипотез!\n\n"
+                    "Вот список товаров:\n"
+                    f"{get_products_context(message_body, conversation, snapshot)}\n"
+                    "Если запрос не относится к товарам или базе, предложи обратиться к менеджеру. "
+                    "Если у пользователя остались вопросы, предлагай написать *'менеджер'*.\n"
+                )
 
-            messages = [
-                {"role": "system", "content": system_message}
-            ]
+                messages = [
+                    {"role": "system", "content": system_message}
+                ]
 
-            # Добавляем историю диалога
-            for c in conversation:
-                messages.append({"role": "user", "content": c["user_message"]})
-                messages.append({"role": "assistant", "content": c["bot_response"]})
-            messages.append({"role": "user", "content": message_body})
-
-            gpt_response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                max_tokens=400,
-                temperature=0.2, 
-            )
-            answer_raw = gpt_response["choices"][0]["message"]["content"].strip()
+                # Добавляем историю диалога
+                messages.extend(get_history_messages(conversation))
+                messages.append({"role": "user", "content": message_body})
+
+                answer_raw = get_llm_client().complete(messages, **LLM_BRANCH_PARAMS["fallback"])
+                if cache is not None:
+                    cache.set(cache_key, answer_raw)
             save_user_conversation(wa_id, message_body, answer_raw)
 
             # --- Фильтруем "плохие" ответы (если GPT не нашел товар)
@@ -1070,7 +1194,7 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
 
             # Если в ответе GPT встречается какая-то из «плохих» фраз:
             if any(phrase in answer_raw.lower() for phrase in trigger_phrases):
-                logging.warning(f"ChatGPT не дал точный ответ. Переключаем пользователя {wa_id} на менеджера.")
+                logger.warning("ChatGPT не дал точный ответ. Переключаем пользователя %s на менеджера.", wa_id)
                 set_user_mode(wa_id, ChatMode.MANAGER)
 
                 response_ru = "Переключаю вас на менеджера, он поможет вам более детально!"
@@ -1084,7 +1208,8 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
             return answer_raw
 
         except Exception as e:
-            logging.error(f"Ошибка при обращении к OpenAI: {e}")
+            logger.error("Ошибка при обращении к OpenAI: %s", e)
+            ERRORS.inc("fallback")
             answer_raw = None
 
         # 16. Если совсем ничего не сработало — переключаем на менеджера
@@ -1092,26 +1217,3 @@ def generate_response(message_body: str, wa_id: str, sender_name: str) -> Option
         response = "Извините, я не смог распознать ваш запрос. Переключаю вас на менеджера для более точного ответа."
         save_user_conversation(wa_id, message_body, response)
         return response
-
-
-def update_products_data():
-    global products_data, unique_brands
-    try:
-        logging.info("Обновляем данные о продуктах...")
-        original_list = load_and_prepare_products(ORIGINAL_SHEET, 'original')
-        spilled_list = load_and_prepare_products(SPILLED_SHEET, 'spilled')
-        combined = original_list + spilled_list
-        products_data = deduplicate_products(combined)
-
-        # Проверяем, что бренды загружены корректно
-        unique_brands = get_unique_brands(products_data)
-        if not unique_brands:
-            logging.error("Ошибка: unique_brands пустой после загрузки!")
-
-        logging.info(f"Продукты обновлены: {len(products_data)} шт.")
-        logging.info(f"Уникальных брендов загружено: {len(unique_brands)}")
-    except Exception as e:
-        logging.error(f"Ошибка обновления продуктов: {e}")
-    Timer(3000, update_products_data).start()
-
-update_products_data()
\ No newline at end of file
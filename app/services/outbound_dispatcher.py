@@ -0,0 +1,266 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from app.services.greenapi_client import CircuitOpenError, GreenApiClient, GreenApiError, QuotaExceededError
+from app.utils.tracing import current_trace_id, start_trace
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Очередь исходящих сообщений
+# ---------------------------
+# Ответы не отправляются из потока запроса, а ставятся в очередь.
+# Порядок сообщений внутри одного чата сохраняется (у чата не бывает
+# двух отправок одновременно), общий темп ограничен token bucket под
+# тариф GreenAPI. При quotaExceeded и при открытом предохранителе клиента
+# отправка приостанавливается, а сообщение возвращается в начало очереди
+# своего чата. Очередь чата ограничена max_per_chat — при переполнении
+# отбрасывается самый старый ответ. При остановке накопленные сообщения
+# досылаются (не дольше drain_timeout), неотправленные попадают в лог.
+
+
+class TokenBucket:
+    """Не больше rate отправок в секунду в среднем, всплеск до capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class OutboundDispatcher:
+    def __init__(self, client: GreenApiClient, rate: float = 1.0, burst: float = 5.0,
+                 workers: int = 2, quota_pause: float = 60.0, max_per_chat: int = 20,
+                 drain_timeout: float = 10.0):
+        self._client = client
+        self._bucket = TokenBucket(rate, burst)
+        self._workers_count = workers
+        self.quota_pause = quota_pause
+        self.max_per_chat = max_per_chat
+        self.drain_timeout = drain_timeout
+
+        self._cond = threading.Condition()
+        # chat_id -> очередь (текст, время постановки, trace_id)
+        self._chats: Dict[str, Deque[Tuple[str, float, Optional[str]]]] = {}
+        self._ready: Deque[str] = deque()
+        self._inflight: Set[str] = set()
+        self._paused_until = 0.0
+        self._stopped = False
+        self._threads = []
+
+        self._backlog = 0
+        self._sent = 0
+        self._failed = 0
+        self._requeued = 0
+        self._dropped = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._latency_last = 0.0
+
+    def start(self):
+        for i in range(self._workers_count):
+            t = threading.Thread(target=self._worker, name=f"outbound-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Досылает накопленные сообщения (не дольше timeout, по умолчанию drain_timeout)
+        и останавливает обработчики. Если пауза отправки длится дольше, ждать не имеет смысла.
+        """
+        timeout = self.drain_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._backlog and self._threads and not self._stopped:
+                now = time.monotonic()
+                if now >= deadline or self._paused_until >= deadline:
+                    break
+                self._cond.wait(deadline - now)
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(max(0.1, deadline - time.monotonic()))
+        self._threads = []
+        with self._cond:
+            if self._backlog:
+                # В backlog входят и сообщения, которые обработчик уже взял, но не успел отправить
+                logger.warning("Очередь исходящих остановлена, не отправлено %s сообщений; в очередях чатов: %s",
+                               self._backlog, {wa_id: len(queue) for wa_id, queue in self._chats.items()})
+
+    def enqueue(self, wa_id: str, text: str) -> bool:
+        """Ставит ответ в очередь чата. Возвращает False, если очередь уже остановлена."""
+        with self._cond:
+            if self._stopped:
+                logger.warning("Очередь исходящих остановлена, ответ в %s не отправлен.", wa_id)
+                self._dropped += 1
+                return False
+            queue = self._chats.get(wa_id)
+            if queue is None:
+                queue = self._chats[wa_id] = deque()
+            if len(queue) >= self.max_per_chat:
+                queue.popleft()
+                self._backlog -= 1
+                self._dropped += 1
+                logger.warning("Очередь ответов в %s переполнена (%s), самый старый отброшен.",
+                               wa_id, self.max_per_chat)
+            queue.append((text, time.monotonic(), current_trace_id()))
+            self._backlog += 1
+            if wa_id not in self._inflight and len(queue) == 1:
+                self._ready.append(wa_id)
+            self._cond.notify()
+            return True
+
+    def pause(self, seconds: Optional[float] = None, reason: str = "квота GreenAPI"):
+        """Приостанавливает отправку (например, по вебхуку quotaExceeded)."""
+        seconds = self.quota_pause if seconds is None else seconds
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning("Отправка сообщений приостановлена на %g с (%s).", seconds, reason)
+
+    def _next(self) -> Optional[Tuple[str, str, float, Optional[str]]]:
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                    continue
+                if self._ready:
+                    break
+                self._cond.wait()
+            wa_id = self._ready.popleft()
+            text, enqueued_at, trace_id = self._chats[wa_id].popleft()
+            self._inflight.add(wa_id)
+            return wa_id, text, enqueued_at, trace_id
+
+    def _done(self, wa_id: str, requeue: Optional[Tuple[str, float, Optional[str]]] = None):
+        with self._cond:
+            self._inflight.discard(wa_id)
+            queue = self._chats[wa_id]
+            if requeue is not None:
+                queue.appendleft(requeue)
+            else:
+                self._backlog -= 1
+            if queue:
+                self._ready.append(wa_id)
+            else:
+                del self._chats[wa_id]
+            # Будит и обработчики, и stop(), который ждёт опустошения очереди
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            wa_id, text, enqueued_at, trace_id = item
+            self._bucket.acquire()
+            try:
+                with start_trace("outbound_send", trace_id):
+                    self._client.send_message(wa_id, text)
+            except QuotaExceededError:
+                with self._cond:
+                    self._requeued += 1
+                self.pause()
+                self._done(wa_id, requeue=(text, enqueued_at, trace_id))
+                continue
+            except CircuitOpenError:
+                # Сообщение не отправлялось — ждём, пока предохранитель пропустит пробный запрос
+                with self._cond:
+                    self._requeued += 1
+                self.pause(self._client.breaker.reset_timeout, reason="GreenAPI недоступен")
+                self._done(wa_id, requeue=(text, enqueued_at, trace_id))
+                continue
+            except GreenApiError as e:
+                with self._cond:
+                    self._failed += 1
+                logger.error("Не удалось отправить сообщение в %s: %s", wa_id, e)
+                self._done(wa_id)
+                continue
+            except Exception:
+                # Обработчик не должен погибнуть, а чат — остаться «в полёте» навсегда
+                with self._cond:
+                    self._failed += 1
+                logger.exception("Непредвиденная ошибка отправки сообщения в %s", wa_id)
+                self._done(wa_id)
+                continue
+
+            latency = time.monotonic() - enqueued_at
+            with self._cond:
+                self._sent += 1
+                self._latency_total += latency
+                self._latency_last = latency
+                self._latency_max = max(self._latency_max, latency)
+            self._done(wa_id)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "backlog": self._backlog,
+                "chats_waiting": len(self._chats),
+                "inflight": len(self._inflight),
+                "sent": self._sent,
+                "failed": self._failed,
+                "requeued": self._requeued,
+                "dropped": self._dropped,
+                "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 1),
+                "latency_avg_ms": round(self._latency_total / self._sent * 1000, 2) if self._sent else 0.0,
+                "latency_max_ms": round(self._latency_max * 1000, 2),
+                "latency_last_ms": round(self._latency_last * 1000, 2),
+            }
+
+
+_dispatcher: Optional[OutboundDispatcher] = None
+_atexit_registered = False
+
+
+def init_outbound_dispatcher(app, client: GreenApiClient) -> Optional[OutboundDispatcher]:
+    """Запускает очередь исходящих сообщений, если включён OUTBOUND_ASYNC."""
+    global _dispatcher, _atexit_registered
+    if not app.config.get("OUTBOUND_ASYNC"):
+        return None
+    if _dispatcher is not None:
+        _dispatcher.stop()
+    _dispatcher = OutboundDispatcher(
+        client,
+        rate=app.config["OUTBOUND_RATE"],
+        burst=app.config["OUTBOUND_BURST"],
+        workers=app.config["OUTBOUND_WORKERS"],
+        quota_pause=app.config["OUTBOUND_QUOTA_PAUSE"],
+        max_per_chat=app.config["OUTBOUND_MAX_PER_CHAT"],
+        drain_timeout=app.config["OUTBOUND_DRAIN_TIMEOUT"],
+    )
+    _dispatcher.start()
+    if not _atexit_registered:
+        atexit.register(stop_outbound_dispatcher)
+        _atexit_registered = True
+    return _dispatcher
+
+
+def stop_outbound_dispatcher():
+    """Досылает очередь при завершении процесса."""
+    if _dispatcher is not None:
+        _dispatcher.stop()
+
+
+def get_outbound_dispatcher() -> Optional[OutboundDispatcher]:
+    return _dispatcher
@@ -0,0 +1,434 @@
+import dbm
+import json
+import logging
+import queue
+import shelve
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from app.utils.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Хранилище состояния пользователей
+# ---------------------------
+# Режим чата, факт приветствия, последний товар и история диалога
+# хранятся в одной базе SQLite вместо трёх shelve-файлов и отдельной
+# базы SQLAlchemy. Соединения берутся из небольшого пула и возвращаются
+# после каждой операции: werkzeug создаёт поток на запрос, и соединение на
+# поток открывалось бы заново для каждого вебхука. WAL позволяет читать
+# параллельно с записью, в том числе из разных процессов.
+#
+# История диалога — журнал только на добавление: одна реплика = одна строка.
+# У пользователя хранится не больше окна последних реплик; когда журнал
+# вырастает на половину окна, старые строки переносятся в архив одним пакетом.
+# Так стоимость записи не зависит от длины переписки. Архив хранится
+# archive_retention_days дней (0 — без ограничения); более старые строки
+# удаляются попутно, раз в ARCHIVE_PURGE_EVERY переносов.
+
+
+class StateStore(ABC):
+    """Интерфейс хранилища состояния пользователя (ключ — wa_id)."""
+
+    @abstractmethod
+    def get_mode(self, wa_id: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set_mode(self, wa_id: str, mode: str):
+        ...
+
+    @abstractmethod
+    def recent_modes(self, since: float, limit: int) -> List[Tuple[str, str]]:
+        """Режимы пользователей, активных после момента since (unix time)."""
+
+    @abstractmethod
+    def mark_greeted(self, wa_id: str) -> bool:
+        """Возвращает True, если пользователь приветствуется впервые."""
+
+    @abstractmethod
+    def get_last_product(self, wa_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def set_last_product(self, wa_id: str, product: dict):
+        ...
+
+    @abstractmethod
+    def get_history(self, wa_id: str, limit: int) -> List[dict]:
+        ...
+
+    @abstractmethod
+    def append_history(self, wa_id: str, user_text: str, bot_text: str):
+        ...
+
+    @abstractmethod
+    def claim_message(self, message_id: str, window: float) -> bool:
+        """
+        Отмечает входящее сообщение как обработанное. Возвращает False,
+        если оно уже было отмечено за последние window секунд.
+        """
+
+    @abstractmethod
+    def release_message(self, message_id: str):
+        """Снимает отметку, чтобы повторная доставка была обработана."""
+
+    def close(self):
+        pass
+
+
+DEFAULT_HISTORY_WINDOW = 50
+DEFAULT_POOL_SIZE = 8
+DEFAULT_ARCHIVE_RETENTION_DAYS = 365
+
+
+class SQLiteStateStore(StateStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_state (
+            wa_id        TEXT PRIMARY KEY,
+            mode         TEXT NOT NULL DEFAULT 'bot',
+            greeted      INTEGER NOT NULL DEFAULT 0,
+            last_product TEXT,
+            history_rows INTEGER NOT NULL DEFAULT 0,
+            updated_at   REAL NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS user_state_updated_at ON user_state (updated_at);
+        CREATE TABLE IF NOT EXISTS conversation (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            wa_id        TEXT NOT NULL,
+            user_message TEXT,
+            bot_response TEXT,
+            created_at   REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversation_wa_id ON conversation (wa_id, id);
+        CREATE TABLE IF NOT EXISTS conversation_archive (
+            id           INTEGER PRIMARY KEY,
+            wa_id        TEXT NOT NULL,
+            user_message TEXT,
+            bot_response TEXT,
+            created_at   REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversation_archive_created_at ON conversation_archive (created_at);
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS processed_message (
+            id_message TEXT PRIMARY KEY,
+            seen_at    REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS processed_message_seen_at ON processed_message (seen_at);
+    """
+
+    # Запросы — неизменяемые строки, поэтому sqlite3 держит их
+    # подготовленными в кеше выражений каждого соединения
+    SQL_GET_MODE = "SELECT mode FROM user_state WHERE wa_id = ?"
+    SQL_SET_MODE = (
+        "INSERT INTO user_state (wa_id, mode, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(wa_id) DO UPDATE SET mode = excluded.mode, updated_at = excluded.updated_at"
+    )
+    SQL_RECENT_MODES = (
+        "SELECT wa_id, mode FROM user_state WHERE updated_at >= ? ORDER BY updated_at DESC LIMIT ?"
+    )
+    SQL_MARK_GREETED = (
+        "INSERT INTO user_state (wa_id, greeted, updated_at) VALUES (?, 1, ?) "
+        "ON CONFLICT(wa_id) DO UPDATE SET greeted = 1, updated_at = excluded.updated_at WHERE greeted = 0"
+    )
+    SQL_GET_LAST_PRODUCT = "SELECT last_product FROM user_state WHERE wa_id = ?"
+    SQL_SET_LAST_PRODUCT = (
+        "INSERT INTO user_state (wa_id, last_product, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(wa_id) DO UPDATE SET last_product = excluded.last_product, updated_at = excluded.updated_at"
+    )
+    SQL_GET_HISTORY = (
+        "SELECT user_message, bot_response FROM ("
+        "SELECT id, user_message, bot_response FROM conversation WHERE wa_id = ? ORDER BY id DESC LIMIT ?"
+        ") ORDER BY id"
+    )
+    SQL_APPEND_HISTORY = (
+        "INSERT INTO conversation (wa_id, user_message, bot_response, created_at) VALUES (?, ?, ?, ?)"
+    )
+    SQL_COUNT_HISTORY = (
+        "INSERT INTO user_state (wa_id, history_rows, updated_at) VALUES (?, 1, ?) "
+        "ON CONFLICT(wa_id) DO UPDATE SET history_rows = history_rows + 1, updated_at = excluded.updated_at"
+    )
+    SQL_GET_HISTORY_ROWS = "SELECT history_rows FROM user_state WHERE wa_id = ?"
+    # id последней строки, которая выпадает из окна
+    SQL_WINDOW_EDGE = "SELECT id FROM conversation WHERE wa_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?"
+    SQL_ARCHIVE_HISTORY = (
+        "INSERT INTO conversation_archive SELECT * FROM conversation WHERE wa_id = ? AND id <= ?"
+    )
+    SQL_TRIM_HISTORY = "DELETE FROM conversation WHERE wa_id = ? AND id <= ?"
+    SQL_SET_HISTORY_ROWS = "UPDATE user_state SET history_rows = ? WHERE wa_id = ?"
+    SQL_PURGE_ARCHIVE = "DELETE FROM conversation_archive WHERE created_at < ?"
+    # Архив старше срока хранения чистится раз в столько переносов в архив
+    ARCHIVE_PURGE_EVERY = 100
+    # Вставка или обновление устаревшей отметки — новое сообщение; иначе строка не меняется
+    SQL_CLAIM_MESSAGE = (
+        "INSERT INTO processed_message (id_message, seen_at) VALUES (?, ?) "
+        "ON CONFLICT(id_message) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_at < ?"
+    )
+    SQL_RELEASE_MESSAGE = "DELETE FROM processed_message WHERE id_message = ?"
+    SQL_PURGE_MESSAGES = "DELETE FROM processed_message WHERE seen_at < ?"
+    # Устаревшие отметки удаляются раз в столько вызовов claim_message
+    PURGE_EVERY = 1000
+    SQL_GET_META = "SELECT value FROM meta WHERE key = ?"
+    SQL_SET_META = (
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+    )
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000,
+                 history_window: int = DEFAULT_HISTORY_WINDOW, archive_history: bool = True,
+                 archive_retention_days: float = DEFAULT_ARCHIVE_RETENTION_DAYS,
+                 pool_size: int = DEFAULT_POOL_SIZE):
+        if pool_size < 1:
+            raise ValueError("Размер пула соединений должен быть положительным")
+        self.path = path
+        self.history_window = history_window
+        self.archive_history = archive_history
+        self.archive_retention_days = archive_retention_days
+        self.pool_size = pool_size
+        self._busy_timeout_ms = busy_timeout_ms
+        # Свободные соединения; LIFO — чаще берётся «тёплое» соединение
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._opened = 0
+        self._pool_lock = threading.Lock()
+        self._schema_ready = False
+        self._claims = 0
+        self._compactions = 0
+
+    def _open(self) -> sqlite3.Connection:
+        # isolation_level=None — автокоммит; транзакции открываем явно.
+        # Соединение переходит между потоками, но в каждый момент занято одним
+        conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=64, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {int(self._busy_timeout_ms)}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        with self._pool_lock:
+            if not self._schema_ready:
+                conn.executescript(self.SCHEMA)
+                self._schema_ready = True
+        return conn
+
+    @contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        """Соединение из пула на время одной операции; при исчерпании пула — ожидание свободного."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._opened < self.pool_size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._pool_lock:
+                        self._opened -= 1
+                    raise
+            else:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    @traced("state.get_mode")
+    def get_mode(self, wa_id: str) -> Optional[str]:
+        with self._conn() as conn:
+            row = conn.execute(self.SQL_GET_MODE, (wa_id,)).fetchone()
+        return row[0] if row else None
+
+    @traced("state.set_mode")
+    def set_mode(self, wa_id: str, mode: str):
+        with self._conn() as conn:
+            conn.execute(self.SQL_SET_MODE, (wa_id, mode, time.time()))
+
+    def recent_modes(self, since: float, limit: int) -> List[Tuple[str, str]]:
+        with self._conn() as conn:
+            return conn.execute(self.SQL_RECENT_MODES, (since, limit)).fetchall()
+
+    @traced("state.mark_greeted")
+    def mark_greeted(self, wa_id: str) -> bool:
+        with self._conn() as conn:
+            return conn.execute(self.SQL_MARK_GREETED, (wa_id, time.time())).rowcount > 0
+
+    @traced("state.get_last_product")
+    def get_last_product(self, wa_id: str) -> Optional[dict]:
+        with self._conn() as conn:
+            row = conn.execute(self.SQL_GET_LAST_PRODUCT, (wa_id,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    @traced("state.set_last_product")
+    def set_last_product(self, wa_id: str, product: dict):
+        payload = json.dumps(product, ensure_ascii=False, default=str)
+        with self._conn() as conn:
+            conn.execute(self.SQL_SET_LAST_PRODUCT, (wa_id, payload, time.time()))
+
+    @traced("state.get_history")
+    def get_history(self, wa_id: str, limit: int) -> List[dict]:
+        with self._conn() as conn:
+            rows = conn.execute(self.SQL_GET_HISTORY, (wa_id, limit)).fetchall()
+        return [{"user_message": user_message, "bot_response": bot_response} for user_message, bot_response in rows]
+
+    @traced("state.append_history")
+    def append_history(self, wa_id: str, user_text: str, bot_text: str):
+        with self._conn() as conn:
+            # BEGIN IMMEDIATE берёт блокировку записи сразу: счётчик строк
+            # не разойдётся при записи из нескольких процессов
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._append_history(conn, wa_id, user_text, bot_text, time.time())
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _append_history(self, conn: sqlite3.Connection, wa_id: str, user_text: str, bot_text: str, now: float):
+        """Добавляет реплику внутри уже открытой транзакции."""
+        conn.execute(self.SQL_APPEND_HISTORY, (wa_id, user_text, bot_text, now))
+        conn.execute(self.SQL_COUNT_HISTORY, (wa_id, now))
+        rows = conn.execute(self.SQL_GET_HISTORY_ROWS, (wa_id,)).fetchone()[0]
+        if rows > self.history_window + self.history_window // 2:
+            self._compact_history(conn, wa_id)
+
+    def _compact_history(self, conn: sqlite3.Connection, wa_id: str):
+        edge = conn.execute(self.SQL_WINDOW_EDGE, (wa_id, self.history_window)).fetchone()
+        if edge:
+            if self.archive_history:
+                conn.execute(self.SQL_ARCHIVE_HISTORY, (wa_id, edge[0]))
+            conn.execute(self.SQL_TRIM_HISTORY, (wa_id, edge[0]))
+        conn.execute(self.SQL_SET_HISTORY_ROWS, (self.history_window, wa_id))
+        self._compactions += 1
+        if self.archive_retention_days and self._compactions % self.ARCHIVE_PURGE_EVERY == 0:
+            conn.execute(self.SQL_PURGE_ARCHIVE, (time.time() - self.archive_retention_days * 86400,))
+
+    @traced("state.claim_message")
+    def claim_message(self, message_id: str, window: float) -> bool:
+        now = time.time()
+        with self._conn() as conn:
+            claimed = conn.execute(self.SQL_CLAIM_MESSAGE, (message_id, now, now - window)).rowcount == 1
+            self._claims += 1
+            if self._claims % self.PURGE_EVERY == 0:
+                conn.execute(self.SQL_PURGE_MESSAGES, (now - window,))
+        return claimed
+
+    @traced("state.release_message")
+    def release_message(self, message_id: str):
+        with self._conn() as conn:
+            conn.execute(self.SQL_RELEASE_MESSAGE, (message_id,))
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._conn() as conn:
+            row = conn.execute(self.SQL_GET_META, (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._conn() as conn:
+            conn.execute(self.SQL_SET_META, (key, value))
+
+    def import_state(self, flag: str, modes: dict, last_products: dict, histories: dict, greeted) -> bool:
+        """
+        Записывает перенесённое состояние одной транзакцией и ставит отметку flag в meta.
+        Проверка отметки и запись идут под одной блокировкой записи (BEGIN IMMEDIATE),
+        поэтому из нескольких одновременно стартующих процессов перенос выполнит ровно один.
+        Возвращает False, если отметка уже стоит.
+        """
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute(self.SQL_GET_META, (flag,)).fetchone():
+                    conn.execute("ROLLBACK")
+                    return False
+                now = time.time()
+                for wa_id, mode in modes.items():
+                    conn.execute(self.SQL_SET_MODE, (wa_id, mode, now))
+                for wa_id, product in last_products.items():
+                    payload = json.dumps(product, ensure_ascii=False, default=str)
+                    conn.execute(self.SQL_SET_LAST_PRODUCT, (wa_id, payload, now))
+                for wa_id, history in histories.items():
+                    for item in history:
+                        self._append_history(conn, wa_id, item.get("user_message", ""),
+                                             item.get("bot_response", ""), now)
+                for wa_id in greeted:
+                    conn.execute(self.SQL_MARK_GREETED, (wa_id, now))
+                conn.execute(self.SQL_SET_META, (flag, str(int(now))))
+                conn.execute("COMMIT")
+                return True
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        """Закрывает свободные соединения; занятые вернутся в пул и будут открыты заново по мере надобности."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._pool_lock:
+                self._opened -= 1
+
+
+# ---------------------------
+# Перенос данных из старых файлов
+# ---------------------------
+LEGACY_SHELVES = {
+    "last_product": "last_product_db",
+    "history": "conversation_history",
+    "greeted": "user_sessions",
+}
+LEGACY_MODES_DB = "bot_database.db"
+
+
+def _read_legacy_shelve(path: str) -> dict:
+    if dbm.whichdb(path) in (None, ""):
+        return {}
+    try:
+        with shelve.open(path, flag="r") as db:
+            return dict(db)
+    except Exception as e:
+        logger.error("Не удалось прочитать %s: %s", path, e)
+        return {}
+
+
+def _read_legacy_modes(path: str) -> dict:
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        return {}
+    try:
+        rows = conn.execute("SELECT wa_id, mode FROM user_states").fetchall()
+    except sqlite3.DatabaseError:
+        rows = []
+    finally:
+        conn.close()
+    # SQLAlchemy Enum хранил имена членов перечисления ("BOT"/"MANAGER")
+    return {wa_id: str(mode).lower() for wa_id, mode in rows if mode}
+
+
+def migrate_legacy_state(store: SQLiteStateStore):
+    """Однократно переносит состояние из shelve-файлов и bot_database.db."""
+    # Быстрая проверка без блокировки; окончательная — внутри import_state
+    if store.get_meta("legacy_imported"):
+        return
+
+    modes = _read_legacy_modes(LEGACY_MODES_DB)
+    last_products = _read_legacy_shelve(LEGACY_SHELVES["last_product"])
+    histories = _read_legacy_shelve(LEGACY_SHELVES["history"])
+    greeted = _read_legacy_shelve(LEGACY_SHELVES["greeted"])
+
+    if not store.import_state("legacy_imported", modes, last_products, histories, greeted):
+        # Другой процесс успел перенести данные раньше
+        return
+    total = len(set(modes) | set(last_products) | set(histories) | set(greeted))
+    if total:
+        logger.info("Перенесено состояние %s пользователей из старых файлов.", total)
@@ -0,0 +1,184 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+from app.utils.tracing import current_trace_id, start_trace
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Асинхронная обработка вебхуков
+# ---------------------------
+# Вебхук проверяется в запросе, кладётся в ограниченную очередь,
+# и GreenAPI сразу получает 200. Очередь разбирает пул рабочих потоков.
+# GreenAPI считает такой вебхук доставленным, поэтому при завершении
+# процесса очередь дорабатывается (не дольше drain_timeout), а то, что
+# не успело обработаться, попадает в лог.
+
+
+class WebhookQueue:
+    """
+    Ограниченная очередь вебхуков с пулом обработчиков.
+    Если очередь заполнена, submit() возвращает False — вызывающий отвечает 429.
+    """
+
+    def __init__(self, app, handler: Callable[[dict], object], workers: int = 4, maxsize: int = 100,
+                 drain_timeout: float = 30.0):
+        self._app = app
+        self._handler = handler
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=maxsize)
+        self._workers_count = workers
+        self.drain_timeout = drain_timeout
+        self._threads = []
+        self._stopped = False
+        self._stats_lock = threading.Lock()
+        self._accepted = 0
+        self._rejected = 0
+        self._processed = 0
+        self._failed = 0
+        self._busy = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+
+    def start(self):
+        for i in range(self._workers_count):
+            t = threading.Thread(target=self._worker, name=f"webhook-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info("Очередь вебхуков запущена: %s обработчиков, ёмкость %s", self._workers_count, self._queue.maxsize)
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Перестаёт принимать вебхуки, дожидается разбора очереди (не дольше timeout,
+        по умолчанию drain_timeout) и останавливает обработчики.
+        """
+        timeout = self.drain_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        self._stopped = True
+        # Метки остановки встают в конец очереди: обработчики сначала разберут вебхуки
+        for _ in self._threads:
+            try:
+                self._queue.put((time.monotonic(), None, None), timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        alive = sum(t.is_alive() for t in self._threads)
+        self._threads = []
+
+        undrained = 0
+        while True:
+            try:
+                _, payload, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if payload is not None:
+                undrained += 1
+        with self._stats_lock:
+            busy = self._busy
+        if undrained or busy:
+            logger.warning("Очередь вебхуков остановлена: не обработано %s вебхуков, ещё обрабатывается %s "
+                           "(обработчиков не завершилось: %s).", undrained, busy, alive)
+
+    def submit(self, payload: dict) -> bool:
+        if self._stopped:
+            # Ответ 429 — GreenAPI доставит вебхук повторно
+            return False
+        try:
+            # trace_id едет вместе с вебхуком: обработка продолжит ту же трассу
+            self._queue.put_nowait((time.monotonic(), payload, current_trace_id()))
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            return False
+        with self._stats_lock:
+            self._accepted += 1
+        return True
+
+    def _worker(self):
+        while True:
+            enqueued_at, payload, trace_id = self._queue.get()
+            if payload is None:
+                self._queue.task_done()
+                return
+
+            wait = time.monotonic() - enqueued_at
+            with self._stats_lock:
+                self._busy += 1
+                self._wait_total += wait
+                self._wait_last = wait
+                self._wait_max = max(self._wait_max, wait)
+
+            failed = False
+            try:
+                with self._app.app_context(), start_trace("webhook_worker", trace_id):
+                    self._handler(payload)
+            except Exception as e:
+                failed = True
+                logger.error("Ошибка обработки вебхука из очереди: %s", e)
+            finally:
+                with self._stats_lock:
+                    self._busy -= 1
+                    self._processed += 1
+                    if failed:
+                        self._failed += 1
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            started = self._processed + self._busy
+            return {
+                "depth": self._queue.qsize(),
+                "capacity": self._queue.maxsize,
+                "workers": self._workers_count,
+                "busy_workers": self._busy,
+                "accepted": self._accepted,
+                "rejected": self._rejected,
+                "processed": self._processed,
+                "failed": self._failed,
+                "wait_avg_ms": round(self._wait_total / started * 1000, 2) if started else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 2),
+                "wait_last_ms": round(self._wait_last * 1000, 2),
+            }
+
+
+_webhook_queue: Optional[WebhookQueue] = None
+_atexit_registered = False
+
+
+def init_webhook_queue(app) -> Optional[WebhookQueue]:
+    """Создаёт и запускает очередь, если в конфигурации включён режим WEBHOOK_ASYNC."""
+    global _webhook_queue, _atexit_registered
+    if not app.config.get("WEBHOOK_ASYNC"):
+        return None
+
+    from app.utils.whatsapp_utils import process_greenapi_message
+
+    if _webhook_queue is not None:
+        _webhook_queue.stop()
+    _webhook_queue = WebhookQueue(
+        app,
+        process_greenapi_message,
+        workers=app.config["WEBHOOK_WORKERS"],
+        maxsize=app.config["WEBHOOK_QUEUE_SIZE"],
+        drain_timeout=app.config["WEBHOOK_DRAIN_TIMEOUT"],
+    )
+    _webhook_queue.start()
+    app.extensions["webhook_queue"] = _webhook_queue
+    # atexit вызывает обработчики в обратном порядке регистрации: очередь вебхуков
+    # запускается последней и останавливается первой — её ответы ещё пройдут
+    # через склейку сообщений и очередь исходящих
+    if not _atexit_registered:
+        atexit.register(stop_webhook_queue)
+        _atexit_registered = True
+    return _webhook_queue
+
+
+def stop_webhook_queue():
+    """Дорабатывает принятые вебхуки при завершении процесса."""
+    if _webhook_queue is not None:
+        _webhook_queue.stop()
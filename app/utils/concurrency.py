@@ -0,0 +1,68 @@
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+# ---------------------------
+# Блокировки по чатам
+# ---------------------------
+# У каждого wa_id своя очередь: сообщения одного чата обрабатываются строго
+# по очереди и в порядке прихода, разные чаты друг друга не ждут. Запись о
+# чате живёт, пока её кто-то держит или ждёт, и удаляется последним
+# освободившим — словарь не растёт с числом чатов.
+
+
+class _Entry:
+    __slots__ = ("cond", "next_ticket", "serving", "refs")
+
+    def __init__(self, mutex: threading.Lock):
+        self.cond = threading.Condition(mutex)
+        # Билеты выдаются по порядку прихода — обслуживание строго FIFO
+        self.next_ticket = 0
+        self.serving = 0
+        self.refs = 0
+
+
+class KeyedLock:
+    """
+    Блокировки по ключу (wa_id) с очередью FIFO внутри ключа.
+    Держатели разных ключей не блокируют друг друга.
+    """
+
+    def __init__(self):
+        # Короткая общая блокировка: только выдача билетов и учёт ссылок
+        self._mutex = threading.Lock()
+        self._entries: Dict[str, _Entry] = {}
+
+    def __len__(self) -> int:
+        """Число чатов, у которых сейчас есть держатель или ожидающие."""
+        with self._mutex:
+            return len(self._entries)
+
+    def acquire(self, key: str):
+        with self._mutex:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(self._mutex)
+            entry.refs += 1
+            ticket = entry.next_ticket
+            entry.next_ticket += 1
+            while entry.serving != ticket:
+                entry.cond.wait()
+
+    def release(self, key: str):
+        with self._mutex:
+            entry = self._entries[key]
+            entry.serving += 1
+            entry.refs -= 1
+            if entry.refs == 0:
+                del self._entries[key]
+            else:
+                entry.cond.notify_all()
+
+    @contextmanager
+    def hold(self, key: str):
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key)
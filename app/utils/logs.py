@@ -0,0 +1,148 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional
+
+from app.utils.tracing import current_trace_id
+
+# ---------------------------
+# Логирование
+# ---------------------------
+# Поток запроса не пишет ни в файл, ни в консоль: корневой логгер отдаёт
+# записи в очередь (QueueHandler), а файл и консоль обслуживает отдельный
+# поток QueueListener. В потоке запроса остаётся только подстановка
+# аргументов в сообщение — и то лишь для записей, прошедших уровень:
+# вызовы пишутся как logger.debug("... %s", value), а дорогие значения
+# (JSON вебхука) оборачиваются в LazyJSON и сериализуются только при выводе.
+#
+# Записи — JSON-строки (LOG_FORMAT=json) или прежний текст (LOG_FORMAT=text).
+# Уровни задаются общим LOG_LEVEL и по модулям в LOG_LEVELS, например
+# "app.services.openai_service=DEBUG,werkzeug=WARNING".
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+_listener: Optional[QueueListener] = None
+_atexit_registered = False
+
+
+class LazyJSON:
+    """Значение для логирования: JSON строится, только если запись действительно выводится."""
+
+    __slots__ = ("data", "indent")
+
+    def __init__(self, data, indent: Optional[int] = None):
+        self.data = data
+        self.indent = indent
+
+    def __str__(self) -> str:
+        return json.dumps(self.data, indent=self.indent, ensure_ascii=False, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            payload["trace_id"] = trace_id
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class _TraceQueueHandler(QueueHandler):
+    """
+    Готовит запись к передаче в другой поток: подставляет аргументы,
+    сворачивает исключение в текст и запоминает trace_id текущей трассы
+    (contextvar виден только в потоке запроса).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.trace_id = current_trace_id()
+        return record
+
+
+def parse_levels(spec: str) -> Dict[str, int]:
+    """"app.views=DEBUG,werkzeug=WARNING" -> {"app.views": 10, "werkzeug": 30}."""
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if not name.strip() or not level.strip():
+            continue
+        value = logging.getLevelName(level.strip().upper())
+        if not isinstance(value, int):
+            raise ValueError(f"Неизвестный уровень логирования {level!r} для {name.strip()}")
+        levels[name.strip()] = value
+    return levels
+
+
+def setup_logging(level: str = "INFO", levels: str = "", fmt: str = "json",
+                  log_file: Optional[str] = "app.log") -> QueueListener:
+    """
+    Настраивает корневой логгер заново (повторный вызов заменяет прежнюю настройку)
+    и запускает поток вывода. Возвращает QueueListener.
+    """
+    global _listener, _atexit_registered
+    stop_logging()
+    if not _atexit_registered:
+        atexit.register(stop_logging)
+        _atexit_registered = True
+
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers: List[logging.Handler] = []
+    if log_file:
+        file_handler = RotatingFileHandler(log_file, maxBytes=10 * 1024 * 1024, backupCount=5,
+                                           encoding="utf-8", delay=True)
+        handlers.append(file_handler)
+    # Сообщения на русском и казахском — консоль в UTF-8
+    try:
+        sys.stdout.reconfigure(encoding="utf-8")
+        sys.stderr.reconfigure(encoding="utf-8")
+    except AttributeError:
+        pass
+    handlers.append(logging.StreamHandler(sys.stdout))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_TraceQueueHandler(log_queue))
+    root.setLevel(logging.getLevelName(level.upper()))
+    for name, value in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(value)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает поток вывода."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
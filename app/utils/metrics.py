@@ -0,0 +1,245 @@
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# ---------------------------
+# Метрики в формате Prometheus
+# ---------------------------
+# Счётчики и гистограммы пишутся без общей блокировки: у каждого потока
+# своя «полоса» значений, и поток меняет только её. Блокировка берётся
+# один раз — когда поток впервые пишет в метрику — и при чтении /metrics,
+# которое складывает полосы. Полосы завершившихся потоков (werkzeug
+# создаёт поток на запрос) сворачиваются в общий итог, чтобы не копиться.
+
+# Границы корзин в секундах: от миллисекунд (ветки без GPT) до десятков секунд (GPT с повторами)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Сколько полос живых потоков можно накопить до свёртки
+_COMPACT_MIN = 64
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (поток, полоса); полоса — словарь значения меток -> значение
+        self._shards: List[Tuple[threading.Thread, dict]] = []
+        self._retired: dict = {}
+        self._compact_at = _COMPACT_MIN
+
+    def _labels(self, labels: Tuple[str, ...]) -> LabelValues:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получено {labels}")
+        return tuple(str(value) for value in labels)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+                if len(self._shards) >= self._compact_at:
+                    self._compact()
+        return shard
+
+    def _compact(self):
+        """Сворачивает полосы завершившихся потоков в общий итог. Вызывается под self._lock."""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                for key, value in shard.items():
+                    self._merge(self._retired, key, value)
+        self._shards = alive
+        self._compact_at = max(_COMPACT_MIN, 2 * len(alive))
+
+    def _merge(self, total: dict, key: LabelValues, value):
+        raise NotImplementedError
+
+    def _collect(self) -> dict:
+        with self._lock:
+            self._compact()
+            total: dict = {}
+            for key, value in self._retired.items():
+                self._merge(total, key, value)
+            for _, shard in self._shards:
+                # Копия: поток-владелец может добавить метку во время чтения
+                for key, value in list(shard.items()):
+                    self._merge(total, key, value)
+        return total
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._collect().items()):
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key: LabelValues, value) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        key = self._labels(labels)
+        shard = self._shard()
+        shard[key] = shard.get(key, 0.0) + amount
+
+    def _merge(self, total: dict, key: LabelValues, value: float):
+        total[key] = total.get(key, 0.0) + value
+
+    def value(self, *labels: str) -> float:
+        return self._collect().get(self._labels(labels), 0.0)
+
+    def _render_sample(self, key: LabelValues, value: float) -> List[str]:
+        return [f"{self.name}{_labels_text(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        key = self._labels(labels)
+        shard = self._shard()
+        # Корзины без накопления + сумма + количество
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def _merge(self, total: dict, key: LabelValues, value: list):
+        current = total.get(key)
+        if current is None:
+            total[key] = list(value)
+        else:
+            for i, item in enumerate(value):
+                current[i] += item
+
+    def count(self, *labels: str) -> int:
+        entry = self._collect().get(self._labels(labels))
+        return entry[-1] if entry else 0
+
+    def _render_sample(self, key: LabelValues, value: list) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), value):
+            cumulative += count
+            labels = _labels_text(self.labelnames + ("le",), key + (_format_value(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _labels_text(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(value[-2])}")
+        lines.append(f"{self.name}_count{labels} {value[-1]}")
+        return lines
+
+
+# Сборщик возвращает (имя, описание, [(метки, значение), ...]) — значения состояния
+# (глубина очереди, доля попаданий кеша), которые читаются в момент запроса /metrics
+GaugeSamples = Tuple[str, str, List[Tuple[Dict[str, str], float]]]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[GaugeSamples]]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[GaugeSamples]]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus (text/plain; version=0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            for name, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels_text(labels.keys(), labels.values())} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def stats_gauges(prefix: str, documentation: str, stats: dict,
+                 labels: Optional[Dict[str, str]] = None) -> List[GaugeSamples]:
+    """Числовые поля словаря stats() (очереди, кеши) как набор метрик prefix_<поле>."""
+    result = []
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        result.append((f"{prefix}_{key}", f"{documentation}: {key}", [(dict(labels or {}), value)]))
+    return result
+
+
+REGISTRY = Registry()
+
+# ---------------------------
+# Метрики сервиса
+# ---------------------------
+WEBHOOK_SECONDS = REGISTRY.histogram(
+    "bot_webhook_seconds", "Время обработки вебхука GreenAPI", ("status",))
+RESPONSE_SECONDS = REGISTRY.histogram(
+    "bot_generate_response_seconds", "Время generate_response по веткам", ("branch",))
+OPENAI_SECONDS = REGISTRY.histogram(
+    "bot_openai_request_seconds", "Время запроса к OpenAI с повторами", ("outcome",))
+GREENAPI_SECONDS = REGISTRY.histogram(
+    "bot_greenapi_send_seconds", "Время отправки сообщения через GreenAPI с повторами", ("outcome",))
+CATALOG_REFRESH_SECONDS = REGISTRY.histogram(
+    "bot_catalog_refresh_seconds", "Время обновления каталога", ("outcome",),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+MODE_SWITCHES = REGISTRY.counter(
+    "bot_mode_switches_total", "Переключения режима чата", ("mode",))
+ERRORS = REGISTRY.counter(
+    "bot_errors_total", "Ошибки по этапам обработки", ("stage",))
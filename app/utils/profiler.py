@@ -0,0 +1,150 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Семплирующий профилировщик
+# ---------------------------
+# Отдельный поток раз в interval секунд снимает стеки всех остальных потоков
+# (sys._current_frames) и считает одинаковые стеки. Результат — «свёрнутые»
+# стеки (collapsed stacks): строка «поток;файл:функция;...;файл:функция N»,
+# которую принимают flamegraph.pl и speedscope. Код обработчиков не меняется,
+# а пока профилировщик не запущен, он не стоит ничего — потока нет.
+# Включается PROFILER_ENABLED при старте или через /admin/profiler.
+
+# Стеки глубже обрезаются со стороны корня
+MAX_DEPTH = 64
+
+
+class SamplingProfiler:
+    def __init__(self, output: str = "profile.folded", interval: float = 0.01, flush_interval: float = 60.0):
+        self.output = output
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_names: Dict[int, str] = {}
+        self._started_at = 0.0
+        self.samples = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info("Профилировщик запущен: шаг %g мс, файл %s", self.interval * 1000, self.output)
+
+    def stop(self) -> str:
+        """Останавливает съём стеков, записывает файл и возвращает свёрнутые стеки."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        logger.info("Профилировщик остановлен: %s снимков записано в %s", self.samples, self.output)
+        return self.collapsed()
+
+    def _run(self):
+        own = threading.get_ident()
+        last_flush = time.monotonic()
+        while not self._stop.wait(self.interval):
+            self._sample(own)
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+
+    def _thread_name(self, ident: int) -> str:
+        name = self._thread_names.get(ident)
+        if name is None:
+            self._thread_names = {t.ident: t.name for t in threading.enumerate()}
+            name = self._thread_names.get(ident, str(ident))
+        return name
+
+    def _sample(self, own: int):
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_DEPTH:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            names.append(self._thread_name(ident))
+            stacks.append(";".join(reversed(names)))
+        with self._lock:
+            self._counts.update(stacks)
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        with self._lock:
+            items = sorted(self._counts.items())
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+    def flush(self):
+        """Атомарно переписывает файл свёрнутых стеков текущими итогами."""
+        tmp_path = f"{self.output}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.collapsed())
+            os.replace(tmp_path, self.output)
+        except OSError as e:
+            logger.error("Не удалось записать профиль в %s: %s", self.output, e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self.running,
+                "interval_ms": round(self.interval * 1000, 3),
+                "samples": self.samples,
+                "stacks": len(self._counts),
+                "output": self.output,
+                "running_s": round(time.monotonic() - self._started_at, 1) if self.running else 0.0,
+            }
+
+
+_profiler: Optional[SamplingProfiler] = None
+_profiler_lock = threading.Lock()
+
+
+def init_profiler(app) -> Optional[SamplingProfiler]:
+    """Запускает профилировщик при старте, если включён PROFILER_ENABLED."""
+    if not app.config["PROFILER_ENABLED"]:
+        return None
+    return start_profiler(app.config["PROFILER_OUTPUT"], app.config["PROFILER_INTERVAL_MS"] / 1000)
+
+
+def start_profiler(output: str, interval: float) -> SamplingProfiler:
+    """Запускает новый сеанс профилирования (текущий, если уже идёт, продолжается)."""
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None or not _profiler.running:
+            _profiler = SamplingProfiler(output, interval)
+            _profiler.start()
+        return _profiler
+
+
+def stop_profiler() -> Optional[str]:
+    """Останавливает профилировщик; возвращает свёрнутые стеки или None, если он не запущен."""
+    with _profiler_lock:
+        if _profiler is None or not _profiler.running:
+            return None
+        return _profiler.stop()
+
+
+def get_profiler() -> Optional[SamplingProfiler]:
+    return _profiler
@@ -0,0 +1,58 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Оценка размера текста в токенах
+# ---------------------------
+# Бюджет промпта должен соблюдаться, поэтому оценка не должна занижать
+# число токенов. Если установлен tiktoken, токены считаются токенизатором
+# модели (OPENAI_MODEL) точно. Без него — грубая оценка с запасом:
+# латиница и цифры — 3 символа на токен, любой другой символ — токен.
+# Кириллица в cl100k/o200k дробится заметно мельче латиницы, а буквы
+# казахского алфавита (ә, ғ, қ, ң, ө, ұ, ү, һ, і) нередко занимают
+# отдельный токен, так что прежние «3 символа на токен» занижали оценку.
+
+ASCII_CHARS_PER_TOKEN = 3
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """Токенизатор модели или None, если tiktoken не установлен или не смог загрузить словарь."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+
+                    from app.services.llm_client import DEFAULT_MODEL
+
+                    try:
+                        _encoding = tiktoken.encoding_for_model(os.getenv("OPENAI_MODEL", DEFAULT_MODEL))
+                    except KeyError:
+                        _encoding = tiktoken.get_encoding("o200k_base")
+                except ImportError:
+                    logger.info("tiktoken не установлен — токены оцениваются приближённо, с запасом.")
+                except Exception as e:
+                    # Словарь скачивается при первом обращении — без сети его может не быть
+                    logger.warning("Не удалось загрузить токенизатор tiktoken (%s) — оценка с запасом.", e)
+                _encoding_loaded = True
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Число токенов в тексте: точное с tiktoken, иначе оценка с запасом
+    (латиница и цифры — по 3 символа на токен, остальные символы — по токену).
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // ASCII_CHARS_PER_TOKEN + (len(text) - ascii_chars) + 1
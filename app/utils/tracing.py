@@ -0,0 +1,172 @@
+import functools
+import logging
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------
+# Трассировка запросов
+# ---------------------------
+# У каждого вебхука свой trace_id. Вызовы базы, каталога, OpenAI и GreenAPI
+# внутри обработки оформляются как вложенные отрезки (span), и по окончании
+# обработки в лог пишется одна строка: trace_id, общее время и время
+# каждого отрезка. Если обработка продолжается в другом потоке (очередь
+# вебхуков, склейка сообщений, очередь исходящих), trace_id передаётся
+# вместе с задачей и там открывается продолжение с тем же trace_id.
+#
+# Выключено по умолчанию (TRACING_ENABLED). В выключенном состоянии span()
+# возвращает один и тот же пустой объект, а @traced вызывает функцию
+# напрямую после одной проверки флага.
+
+# Больше отрезков в одной трассе не записывается (например, цикл по товарам)
+MAX_SPANS = 200
+
+_enabled = False
+# Трассы быстрее порога в лог не пишутся
+_slow_ms = 0.0
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+class Trace:
+    __slots__ = ("trace_id", "name", "started", "spans", "stack", "dropped")
+
+    def __init__(self, trace_id: str, name: str):
+        self.trace_id = trace_id
+        self.name = name
+        self.started = time.perf_counter()
+        # (путь отрезка, длительность в секундах) в порядке завершения
+        self.spans: List[Tuple[str, float]] = []
+        self.stack: List[str] = []
+        self.dropped = 0
+
+    def summary(self, elapsed: float) -> str:
+        parts = [f"{path} {duration * 1000:.1f}" for path, duration in self.spans]
+        if self.dropped:
+            parts.append(f"…ещё {self.dropped}")
+        return (f"trace {self.trace_id} {self.name} {elapsed * 1000:.1f} ms"
+                + (": " + ", ".join(parts) if parts else ""))
+
+
+class _NullScope:
+    """Пустой контекст для выключенной трассировки."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullScope()
+
+
+class _TraceScope:
+    __slots__ = ("trace", "token")
+
+    def __init__(self, name: str, trace_id: Optional[str]):
+        self.trace = Trace(trace_id or new_trace_id(), name)
+        self.token = None
+
+    def __enter__(self) -> Trace:
+        self.token = _current.set(self.trace)
+        return self.trace
+
+    def __exit__(self, *exc):
+        _current.reset(self.token)
+        elapsed = time.perf_counter() - self.trace.started
+        if elapsed * 1000 >= _slow_ms and logger.isEnabledFor(logging.INFO):
+            logger.info("%s", self.trace.summary(elapsed))
+        return False
+
+
+class _Span:
+    __slots__ = ("trace", "name", "path", "started")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+        self.path = "/".join(trace.stack + [name])
+        self.started = 0.0
+
+    def __enter__(self):
+        self.trace.stack.append(self.name)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.started
+        trace = self.trace
+        trace.stack.pop()
+        if len(trace.spans) < MAX_SPANS:
+            trace.spans.append((self.path, duration))
+        else:
+            trace.dropped += 1
+        return False
+
+
+def configure(enabled: bool, slow_ms: float = 0.0):
+    global _enabled, _slow_ms
+    _enabled = enabled
+    _slow_ms = slow_ms
+
+
+def init_tracing(app):
+    configure(app.config["TRACING_ENABLED"], app.config["TRACE_SLOW_MS"])
+    if _enabled:
+        logger.info("Трассировка запросов включена (в лог — трассы от %g мс).", _slow_ms)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id() -> Optional[str]:
+    """trace_id текущей обработки — чтобы передать его в другой поток. None, если трассировка выключена."""
+    trace = _current.get()
+    return trace.trace_id if trace is not None else None
+
+
+def start_trace(name: str, trace_id: Optional[str] = None):
+    """
+    Начинает трассу (или продолжение трассы trace_id в другом потоке).
+    Внутри уже открытой трассы ничего не начинает.
+    """
+    if not _enabled or _current.get() is not None:
+        return _NULL
+    return _TraceScope(name, trace_id)
+
+
+def span(name: str):
+    """Отрезок внутри текущей трассы: with span("openai"): ..."""
+    if not _enabled:
+        return _NULL
+    trace = _current.get()
+    if trace is None:
+        return _NULL
+    return _Span(trace, name)
+
+
+def traced(name: str) -> Callable:
+    """Декоратор: вызов функции — отрезок текущей трассы."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
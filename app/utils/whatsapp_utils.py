@@ -1,35 +1,23 @@
 import logging
-import json
-import requests
 import re
-import sys
-from flask import current_app, jsonify
+import requests
+from flask import jsonify
 from app.services.openai_service import generate_response, ChatMode, set_user_mode, detect_language
+from app.services.greenapi_client import GreenApiError, get_greenapi_client
+from app.services.outbound_dispatcher import get_outbound_dispatcher
+from app.services.message_debouncer import get_message_debouncer
+from app.utils.logs import LazyJSON
+from app.utils.metrics import ERRORS
+from app.utils.tracing import traced
 
-logging.getLogger().setLevel(logging.WARNING)
-# Настройка логирования с поддержкой UTF-8
-logger = logging.getLogger()
-if not logger.hasHandlers():
-    logger.setLevel(logging.INFO)
-
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
-
-    try:
-        console_handler.stream.reconfigure(encoding="utf-8")  # Python 3.7+
-    except AttributeError:
-        pass  # Если старый Python, игнорируем
-
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    console_handler.setFormatter(formatter)
+logger = logging.getLogger(__name__)
 
-    logger.addHandler(console_handler)
 
 def log_http_response(response):
     """Логирует HTTP-ответ с сокращенной детализацией."""
-    logging.debug(f"HTTP Status: {response.status_code}")
-    logging.debug(f"Content-Type: {response.headers.get('content-type')}")
-    logging.debug("Response Body: " + json.dumps(response.text, ensure_ascii=False))
+    logger.debug("HTTP Status: %s", response.status_code)
+    logger.debug("Content-Type: %s", response.headers.get('content-type'))
+    logger.debug("Response Body: %s", LazyJSON(response.text))
 
 def process_text_for_whatsapp(text):
     """Форматирует текст для отправки в WhatsApp."""
@@ -41,35 +29,55 @@ def process_text_for_whatsapp(text):
 
 def send_greenapi_message(wa_id, text):
     """Отправляет текстовое сообщение через GreenAPI."""
-    id_instance = current_app.config.get("GREENAPI_IDINSTANCE")
-    api_token = current_app.config.get("GREENAPI_APITOKEN")
-    if not id_instance or not api_token:
-        logging.error("Отсутствуют учетные данные GreenAPI в конфигурации.")
+    client = get_greenapi_client()
+    if client is None:
+        logger.error("Клиент GreenAPI не инициализирован (нет учетных данных в конфигурации).")
         return None
 
-    url = f"https://api.green-api.com/waInstance{id_instance}/SendMessage/{api_token}"
-    phone_sanitized = wa_id.replace("+", "").strip()
-    if not (phone_sanitized.endswith("@c.us") or phone_sanitized.endswith("@g.us")):
-        phone_sanitized += "@c.us"
-
-    payload = {"chatId": phone_sanitized, "message": text}
-    headers = {"Content-Type": "application/json"}
-
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        response.raise_for_status()
+        response = client.send_message(wa_id, text)
         log_http_response(response)
         return response
-    except requests.Timeout:
-        logging.error(f"Timeout при отправке сообщения в {wa_id}")
-        return None
-    except requests.RequestException as e:
-        logging.error(f"Ошибка отправки сообщения в {wa_id}: {e}")
+    except (GreenApiError, requests.RequestException) as e:
+        logger.error("Ошибка отправки сообщения в %s: %s", wa_id, e)
         return None
 
+@traced("deliver_reply")
+def deliver_reply(wa_id, text):
+    """
+    Отправляет ответ пользователю: через очередь исходящих сообщений,
+    если она включена, иначе сразу. Возвращает True, если ответ принят.
+    """
+    dispatcher = get_outbound_dispatcher()
+    if dispatcher is not None:
+        return dispatcher.enqueue(wa_id, text)
+    return send_greenapi_message(wa_id, text) is not None
+
+def respond_to_message(chat_id, sender, sender_name, message_text):
+    """Генерирует ответ на текст пользователя и отправляет его в чат."""
+    # Определяем режим пользователя
+    current_mode = ChatMode.BOT  # По умолчанию бот-режим
+    bot_reply = generate_response(message_text, sender, sender_name)
+
+    if current_mode == ChatMode.MANAGER:
+        logger.info("%s в режиме MANAGER. Отправляем автоответ.", sender)
+        auto_reply = "Вы на связи с менеджером. Пожалуйста, ожидайте."
+        deliver_reply(chat_id, auto_reply)
+        return
+
+    if bot_reply:
+        formatted_reply = process_text_for_whatsapp(bot_reply)
+        if deliver_reply(chat_id, formatted_reply):
+            logger.info("Бот ответил %s: %s", sender_name, formatted_reply.encode('utf-8', 'ignore').decode('utf-8'))
+        else:
+            logger.error("Ошибка отправки ответа %s", sender_name)
+    else:
+        logger.warning("Не удалось сгенерировать ответ для %s.", sender_name)
+
+@traced("process_message")
 def process_greenapi_message(body):
     try:
-        logging.debug("Webhook received: " + json.dumps(body, indent=2, ensure_ascii=False))
+        logger.debug("Webhook received: %s", LazyJSON(body, indent=2))
 
         type_webhook = body.get("typeWebhook", "")
         sender_data = body.get("senderData", {})
@@ -82,17 +90,17 @@ def process_greenapi_message(body):
 
         # Если бот отправил сообщение самому себе, переопределяем тип вебхука
         if sender == bot_number and type_webhook == "outgoingMessageReceived":
-            logging.info("Сообщение от бота самому себе обнаружено, обрабатываем как входящее.")
+            logger.info("Сообщение от бота самому себе обнаружено, обрабатываем как входящее.")
             type_webhook = "incomingMessageReceived"
 
         # Игнорируем неважные события
         if type_webhook not in ["incomingMessageReceived"]:
-            logging.debug(f"Игнорируем webhook типа: {type_webhook}")
+            logger.debug("Игнорируем webhook типа: %s", type_webhook)
             return jsonify({"status": "ignored"}), 200
 
         # Игнорируем сообщения из групповых чатов
         if chat_id.endswith("@g.us"):
-            logging.debug("Групповое сообщение проигнорировано.")
+            logger.debug("Групповое сообщение проигнорировано.")
             return jsonify({"status": "ignored", "message": "Group messages are ignored."}), 200
 
         message_text = None
@@ -101,7 +109,7 @@ def process_greenapi_message(body):
 
         # Автоматически переключаем на менеджера, если сообщение не текстовое
         if message_type not in ["textMessage", "extendedTextMessage"]:
-            logging.info(f"Неподдерживаемый тип сообщения от {sender} ({message_type}). Переключаем на менеджера.")
+            logger.info("Неподдерживаемый тип сообщения от %s (%s). Переключаем на менеджера.", sender, message_type)
             
             # Переключаем пользователя в режим общения с менеджером
             set_user_mode(sender, ChatMode.MANAGER)
@@ -113,7 +121,7 @@ def process_greenapi_message(body):
             lang = detect_language("")
             bot_reply = response_ru if lang == "ru" else response_kz
             
-            send_greenapi_message(chat_id, bot_reply)
+            deliver_reply(chat_id, bot_reply)
             
             return jsonify({"status": "switched", "message": "User switched to manager mode due to non-text message."}), 200
 
@@ -125,39 +133,27 @@ def process_greenapi_message(body):
             message_text = message_data["extendedTextMessageData"].get("text", "")
 
         if not message_text:
-            logging.warning(f"Входящее сообщение от {sender} не содержит текста.")
+            logger.warning("Входящее сообщение от %s не содержит текста.", sender)
             return jsonify({"status": "ignored", "message": "Empty text message ignored."}), 200
 
-        logging.debug(f"Входящее сообщение от {sender_name} ({sender}): {message_text}")
-
-        # Определяем режим пользователя
-        current_mode = ChatMode.BOT  # По умолчанию бот-режим
-        bot_reply = generate_response(message_text, sender, sender_name)
+        logger.debug("Входящее сообщение от %s (%s): %s", sender_name, sender, message_text)
 
-        if current_mode == ChatMode.MANAGER:
-            logging.info(f"{sender} в режиме MANAGER. Отправляем автоответ.")
-            auto_reply = "Вы на связи с менеджером. Пожалуйста, ожидайте."
-            send_greenapi_message(chat_id, auto_reply)
-            return jsonify({"status": "success"}), 200
-
-        if bot_reply:
-            formatted_reply = process_text_for_whatsapp(bot_reply)
-            response = send_greenapi_message(chat_id, formatted_reply)
-
-            if response:
-                logging.info(f"Бот ответил {sender_name}: {formatted_reply.encode('utf-8', 'ignore').decode('utf-8')}")
-            else:
-                logging.error(f"Ошибка отправки ответа {sender_name}")
-        else:
-            logging.warning(f"Не удалось сгенерировать ответ для {sender_name}.")
+        # Серия быстрых сообщений склеивается в один ход (если включено)
+        debouncer = get_message_debouncer()
+        if debouncer is not None:
+            debouncer.submit(chat_id, sender, sender_name, message_text)
+            return jsonify({"status": "debounced"}), 200
 
+        respond_to_message(chat_id, sender, sender_name, message_text)
         return jsonify({"status": "success"}), 200
 
     except KeyError as e:
-        logging.error("Ошибка структуры сообщения GreenAPI: " + str(e))
+        logger.error("Ошибка структуры сообщения GreenAPI: %s", e)
+        ERRORS.inc("process_message")
         return jsonify({"status": "error", "message": "Invalid structure."}), 400
     except Exception as e:
-        logging.error("Непредвиденная ошибка: " + str(e))
+        logger.error("Непредвиденная ошибка: %s", e)
+        ERRORS.inc("process_message")
         return jsonify({"status": "error", "message": "Internal server error."}), 500
 
 
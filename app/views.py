@@ -1,56 +1,197 @@
 import logging
 import json
-from flask import Blueprint, request, jsonify
+import time
+from flask import Blueprint, Response, current_app, request, jsonify
 
 from .utils.whatsapp_utils import process_greenapi_message, is_valid_greenapi_message
+from .services.openai_service import get_answer_caches, get_mode_cache
+from .services.outbound_dispatcher import get_outbound_dispatcher
+from .services.message_debouncer import get_message_debouncer
+from .services.message_dedup import get_message_dedup
+from .decorators.security import admin_token_required
+from .utils.logs import LazyJSON
+from .utils.metrics import ERRORS, REGISTRY, WEBHOOK_SECONDS, stats_gauges
+from .utils.profiler import get_profiler, start_profiler, stop_profiler
+from .utils.tracing import start_trace
+
+logger = logging.getLogger(__name__)
 
-logging.getLogger().setLevel(logging.WARNING)
 
 webhook_blueprint = Blueprint("webhook", __name__)
+metrics_blueprint = Blueprint("metrics", __name__)
+admin_blueprint = Blueprint("admin", __name__)
 
 @webhook_blueprint.route("/webhook", methods=["POST"])
 def webhook_post():
     """Основной обработчик вебхуков от GreenAPI."""
+    started = time.perf_counter()
+    with start_trace("webhook"):
+        response = handle_webhook()
+    WEBHOOK_SECONDS.observe(time.perf_counter() - started, str(response[1]))
+    return response
+
+
+def handle_webhook():
+    dedup = get_message_dedup()
+    message_id = None
     try:
         raw_data = request.data.decode("utf-8", errors="ignore")
-        logging.debug(f"Raw Request Data: {raw_data}")  # Логируем только в DEBUG
+        logger.debug("Raw Request Data: %s", raw_data)  # Логируем только в DEBUG
 
         # Парсим JSON
         try:
             data = json.loads(raw_data)
-            logging.debug(f"Parsed Webhook Payload: {json.dumps(data, indent=2, ensure_ascii=False)}")
+            logger.debug("Parsed Webhook Payload: %s", LazyJSON(data, indent=2))
         except json.JSONDecodeError:
-            logging.error("Invalid JSON format in webhook")
+            logger.error("Invalid JSON format in webhook")
             return jsonify({"error": "Invalid JSON"}), 400
 
         # Проверяем корректность вебхука
         type_webhook = data.get("typeWebhook", "")
         if not is_valid_greenapi_message(data):
-            logging.error(f"Invalid GreenAPI webhook format: {type_webhook}")
+            logger.error("Invalid GreenAPI webhook format: %s", type_webhook)
             return jsonify({"error": "Invalid webhook"}), 400
 
         # Игнорируем неважные события
         ignored_events = {"outgoingMessageReceived", "outgoingAPIMessage", "outgoingMessageStatus", "stateInstanceChanged"}
         if type_webhook in ignored_events:
-            logging.debug(f"Ignored webhook event: {type_webhook}")
+            logger.debug("Ignored webhook event: %s", type_webhook)
+            return jsonify({"status": "ok"}), 200
+
+        # GreenAPI сообщает об исчерпании квоты — приостанавливаем исходящие
+        if type_webhook == "quotaExceeded":
+            logger.warning("Получен вебхук quotaExceeded от GreenAPI")
+            dispatcher = get_outbound_dispatcher()
+            if dispatcher is not None:
+                dispatcher.pause()
             return jsonify({"status": "ok"}), 200
 
         # Обработка API-сообщений
         if type_webhook == "outgoingAPIMessageReceived":
             message_text = data["messageData"].get("extendedTextMessageData", {}).get("text", "")
-            logging.debug(f"API message sent: {message_text}")
+            logger.debug("API message sent: %s", message_text)
             return jsonify({"status": "ok", "message": "API message received"}), 200
 
         # Обработка исходящих сообщений (от бота)
         if type_webhook == "outgoingMessageReceived":
             message_text = data["messageData"].get("textMessageData", {}).get("textMessage", "")
             chat_name = data["senderData"].get("chatName", "Unknown")
-            logging.debug(f"Message sent to {chat_name}: {message_text}")
+            logger.debug("Message sent to %s: %s", chat_name, message_text)
             return jsonify({"status": "ok", "message": "Outgoing message received"}), 200
 
+        # Повторная доставка того же сообщения (GreenAPI не дождался ответа) не обрабатывается
+        if dedup is not None and data.get("idMessage"):
+            if not dedup.claim(data["idMessage"]):
+                logger.info("Повторный вебхук %s пропущен", data['idMessage'])
+                return jsonify({"status": "duplicate"}), 200
+            message_id = data["idMessage"]
+
+        # В асинхронном режиме ставим вебхук в очередь и сразу отвечаем GreenAPI
+        webhook_queue = current_app.extensions.get("webhook_queue")
+        if webhook_queue is not None:
+            if not webhook_queue.submit(data):
+                logger.warning("Очередь вебхуков переполнена, отвечаем 429")
+                # GreenAPI доставит вебхук повторно — его нужно будет обработать
+                if message_id:
+                    dedup.release(message_id)
+                return jsonify({"status": "busy", "message": "Queue is full"}), 429, {"Retry-After": "5"}
+            return jsonify({"status": "queued"}), 200
+
         # Передаем дальше обработку входящих сообщений
-        return process_greenapi_message(data)
+        response = process_greenapi_message(data)
+        if message_id and response[1] >= 500:
+            dedup.release(message_id)
+        return response
 
     except Exception as e:
-        logging.error(f"Internal server error: {e}")
+        logger.error("Internal server error: %s", e)
+        ERRORS.inc("webhook")
+        if message_id:
+            dedup.release(message_id)
         return jsonify({"status": "error", "message": "Internal server error"}), 500
+
+
+@webhook_blueprint.route("/webhook/stats", methods=["GET"])
+@admin_token_required
+def webhook_stats():
+    """Глубина очереди и время ожидания — для подбора числа обработчиков."""
+    webhook_queue = current_app.extensions.get("webhook_queue")
+    if webhook_queue is None:
+        stats = {"mode": "sync"}
+    else:
+        stats = {"mode": "async", **webhook_queue.stats()}
+    stats["mode_cache"] = get_mode_cache().stats()
+    stats["llm_cache"] = {branch: cache.stats() for branch, cache in get_answer_caches().items()}
+    dispatcher = get_outbound_dispatcher()
+    if dispatcher is not None:
+        stats["outbound"] = dispatcher.stats()
+    debouncer = get_message_debouncer()
+    if debouncer is not None:
+        stats["debounce"] = debouncer.stats()
+    dedup = get_message_dedup()
+    if dedup is not None:
+        stats["dedup"] = dedup.stats()
+    return jsonify(stats), 200
+
+
+def collect_service_stats():
+    """Состояние очередей и кешей — то же, что /webhook/stats, в виде метрик."""
+    gauges = []
+    webhook_queue = current_app.extensions.get("webhook_queue")
+    if webhook_queue is not None:
+        gauges += stats_gauges("bot_webhook_queue", "Очередь вебхуков", webhook_queue.stats())
+    gauges += stats_gauges("bot_mode_cache", "Кеш режимов чата", get_mode_cache().stats())
+    for branch, cache in get_answer_caches().items():
+        gauges += stats_gauges("bot_llm_cache", "Кеш ответов GPT", cache.stats(), {"branch": branch})
+    dispatcher = get_outbound_dispatcher()
+    if dispatcher is not None:
+        gauges += stats_gauges("bot_outbound", "Очередь исходящих сообщений", dispatcher.stats())
+    debouncer = get_message_debouncer()
+    if debouncer is not None:
+        gauges += stats_gauges("bot_debounce", "Склейка сообщений", debouncer.stats())
+    dedup = get_message_dedup()
+    if dedup is not None:
+        gauges += stats_gauges("bot_dedup", "Повторные вебхуки", dedup.stats())
+    return gauges
+
+
+REGISTRY.add_collector(collect_service_stats)
+
+
+@metrics_blueprint.route("/metrics", methods=["GET"])
+@admin_token_required
+def metrics():
+    """Метрики в текстовом формате Prometheus."""
+    return Response(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@admin_blueprint.route("/admin/profiler", methods=["GET"])
+@admin_token_required
+def profiler_status():
+    profiler = get_profiler()
+    return jsonify(profiler.stats() if profiler is not None else {"running": False}), 200
+
+
+@admin_blueprint.route("/admin/profiler/start", methods=["POST"])
+@admin_token_required
+def profiler_start():
+    """Запускает профилировщик; шаг можно передать в JSON как interval_ms."""
+    body = request.get_json(silent=True) or {}
+    try:
+        interval_ms = float(body.get("interval_ms", current_app.config["PROFILER_INTERVAL_MS"]))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "interval_ms must be a number"}), 400
+    if interval_ms < 1:
+        return jsonify({"status": "error", "message": "interval_ms must be at least 1"}), 400
+    profiler = start_profiler(current_app.config["PROFILER_OUTPUT"], interval_ms / 1000)
+    return jsonify(profiler.stats()), 200
+
+
+@admin_blueprint.route("/admin/profiler/stop", methods=["POST"])
+@admin_token_required
+def profiler_stop():
+    """Останавливает профилировщик и отдаёт свёрнутые стеки (их же пишет в PROFILER_OUTPUT)."""
+    collapsed = stop_profiler()
+    if collapsed is None:
+        return jsonify({"status": "error", "message": "Profiler is not running"}), 409
+    return Response(collapsed, content_type="text/plain; charset=utf-8")
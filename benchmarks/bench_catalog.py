@@ -0,0 +1,222 @@
+"""
+Микробенчмарк функций каталога на синтетических каталогах разного размера.
+
+Каталог — synthetic_catalog.py (распределение брендов по Ципфу, названия
+на латинице, русском и казахском, оригиналы и разлив, дубликаты строк).
+Замеряются сборка снимка (build_snapshot), deduplicate_products и поиск:
+search_product, find_best_match, extract_brand_from_message,
+get_products_context (список товаров для промпта). Запросы — названия
+и бренды из каталога, опечатки, разлив, товары, которых нет.
+
+Результат сравнивается с сохранённой базой (catalog_baseline.json):
+если функция стала медленнее базы больше чем в --tolerance раз,
+скрипт завершается с кодом 1. База зависит от машины — после
+намеренных изменений или на новой машине её обновляют ключом
+--update-baseline.
+
+Запуск:
+    python benchmarks/bench_catalog.py --sizes 1000 10000 100000
+    python benchmarks/bench_catalog.py --sizes 1000 10000 --update-baseline
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic_catalog import BRANDS, generate_sheets  # noqa: E402
+
+from app.services.catalog_manager import build_snapshot  # noqa: E402
+from app.services.openai_service import (  # noqa: E402
+    deduplicate_products,
+    extract_brand_from_message,
+    find_best_match,
+    get_products_context,
+    prepare_products,
+    search_product,
+)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog_baseline.json")
+
+QUERY_TEMPLATES = [
+    "{name}",
+    "сколько стоит {name}",
+    "есть {brand} {name}?",
+    "{name} на разлив",
+    "что есть от {brand}",
+    "посоветуйте что-нибудь от {brand_typo}",
+    "{name_typo}",
+    "хочу {name_typo} 100 мл",
+]
+MISSES = ["какой у вас график работы", "привет", "есть что-то сладкое на вечер", "zzzz qqqq wwww"]
+CONVERSATION = [
+    {"user_message": "добрый день, ищу подарок жене", "bot_response": "Подскажите, какие ароматы ей нравятся?"},
+    {"user_message": "что-то цветочное и не очень сладкое", "bot_response": "Есть хорошие варианты."},
+]
+
+
+def _typo(rnd: random.Random, text: str) -> str:
+    """Одна опечатка: пропущенная или переставленная буква."""
+    if len(text) < 4:
+        return text
+    pos = rnd.randrange(1, len(text) - 2)
+    if rnd.random() < 0.5:
+        return text[:pos] + text[pos + 1:]
+    return text[:pos] + text[pos + 1] + text[pos] + text[pos + 2:]
+
+
+def make_queries(products: List[dict], count: int, seed: int = 7) -> List[str]:
+    rnd = random.Random(seed)
+    queries = []
+    for i in range(count):
+        if i % 10 == 9:
+            queries.append(rnd.choice(MISSES))
+            continue
+        product = rnd.choice(products)
+        name = str(product["name"]).lower()
+        brand = product["brand"] or rnd.choice(BRANDS)
+        queries.append(rnd.choice(QUERY_TEMPLATES).format(
+            name=name, brand=brand, name_typo=_typo(rnd, name), brand_typo=_typo(rnd, brand.lower()),
+        ))
+    return queries
+
+
+def time_per_call(func: Callable[[str], object], queries: List[str], rounds: int) -> float:
+    """Лучшее из rounds среднее время одного вызова, в микросекундах."""
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for query in queries:
+            func(query)
+        best = min(best, (time.perf_counter() - started) / len(queries))
+    return best * 1e6
+
+
+def time_once(func: Callable[[], object], rounds: int) -> float:
+    """Лучшее из rounds время одного запуска, в микросекундах."""
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1e6
+
+
+def bench_size(size: int, queries_count: int, rounds: int) -> Dict[str, float]:
+    sheets = generate_sheets(size)
+    rows = len(sheets["original"]) + len(sheets["spilled"])
+
+    def prepared() -> List[dict]:
+        raw = copy.deepcopy(sheets)
+        return prepare_products(raw["original"], "original") + prepare_products(raw["spilled"], "spilled")
+
+    # deduplicate_products меняет товары на месте — каждому прогону свою копию
+    inputs = [prepared() for _ in range(rounds)]
+    dedup_us = time_once(lambda: deduplicate_products(inputs.pop()), rounds)
+
+    products = deduplicate_products(prepared())
+    build_us = time_once(lambda: build_snapshot(products, version=1), max(1, rounds // 2))
+    snapshot = build_snapshot(products, version=1)
+    index = snapshot.index
+
+    queries = make_queries(products, queries_count)
+    results = {
+        "rows": rows,
+        "products": len(products),
+        "build_snapshot_us": build_us,
+        "deduplicate_products_us": dedup_us,
+        "search_product_us": time_per_call(lambda q: search_product(q, index), queries, rounds),
+        "find_best_match_us": time_per_call(lambda q: find_best_match(q, index), queries, rounds),
+        "extract_brand_from_message_us": time_per_call(lambda q: extract_brand_from_message(q, index),
+                                                        queries, rounds),
+        "get_products_context_us": time_per_call(lambda q: get_products_context(q, CONVERSATION, snapshot),
+                                                 queries, rounds),
+    }
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float, slack_us: float) -> List[str]:
+    """Список регрессий: функции, ставшие медленнее базы больше чем в tolerance раз."""
+    regressions = []
+    for size, metrics in results.items():
+        base = baseline.get(size)
+        if base is None:
+            continue
+        for name, value in metrics.items():
+            if not name.endswith("_us") or name not in base:
+                continue
+            # slack_us гасит шум на функциях, которые работают микросекунды
+            if value > base[name] * tolerance + slack_us:
+                regressions.append(f"{size}: {name} {value:.1f} мкс против {base[name]:.1f} в базе "
+                                   f"(x{value / base[name]:.2f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="строк в таблице")
+    parser.add_argument("--queries", type=int, default=200, help="запросов на функцию поиска")
+    parser.add_argument("--rounds", type=int, default=3, help="повторов, берётся лучший")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=1.5, help="допустимое замедление, раз")
+    parser.add_argument("--slack-us", type=float, default=20.0, help="допустимое абсолютное замедление, мкс")
+    parser.add_argument("--update-baseline", action="store_true", help="записать результаты как новую базу")
+    parser.add_argument("--output", help="куда записать результаты в JSON")
+    args = parser.parse_args()
+
+    # search_product пишет каждый запрос в INFO
+    logging.disable(logging.INFO)
+
+    results: Dict[str, Dict[str, float]] = {}
+    header = f"{'rows':>7} {'products':>8} " + " ".join(f"{name:>12}" for name in
+                                                        ("build ms", "dedup ms", "search us", "best us",
+                                                         "brand us", "context us"))
+    print(header)
+    for size in args.sizes:
+        metrics = bench_size(size, args.queries, args.rounds)
+        results[str(size)] = {key: round(value, 1) for key, value in metrics.items()}
+        print(f"{metrics['rows']:>7} {metrics['products']:>8} "
+              f"{metrics['build_snapshot_us'] / 1000:>12.1f} {metrics['deduplicate_products_us'] / 1000:>12.1f} "
+              f"{metrics['search_product_us']:>12.1f} {metrics['find_best_match_us']:>12.1f} "
+              f"{metrics['extract_brand_from_message_us']:>12.1f} {metrics['get_products_context_us']:>12.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nБаза обновлена: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nБазы {args.baseline} нет — сравнивать не с чем (создать: --update-baseline)")
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance, args.slack_us)
+    if regressions:
+        print("\nРегрессии относительно базы:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"\nРегрессий нет (допуск x{args.tolerance} + {args.slack_us:g} мкс)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Бенчмарк пропускной способности generate_response при параллельных отправителях.
+
+Сравнивает одну глобальную блокировку (старое поведение) с блокировками
+по чатам (KeyedLock). Тело обработчика имитируется sleep-ом,
+равным задержке OpenAI, поэтому сеть и Google Sheets не нужны.
+
+Запуск:
+    python benchmarks/bench_chat_locks.py --latency-ms 50 --messages 10
+"""
+import argparse
+import importlib.util
+import os
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Модуль загружается напрямую по пути: импорт пакета app тянет за собой
+# Google Sheets и OpenAI, которые для этого замера не нужны
+_spec = importlib.util.spec_from_file_location("concurrency", os.path.join(ROOT, "app", "utils", "concurrency.py"))
+concurrency = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(concurrency)
+KeyedLock = concurrency.KeyedLock
+
+
+class GlobalLock:
+    """Старый вариант: одна блокировка на весь процесс."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def hold(self, key):
+        return self._lock
+
+
+def run(locks, senders: int, messages: int, latency: float) -> float:
+    def sender(wa_id: str):
+        for _ in range(messages):
+            with locks.hold(wa_id):
+                time.sleep(latency)  # имитация вызова OpenAI
+
+    threads = [threading.Thread(target=sender, args=(f"7700000{i:04d}",)) for i in range(senders)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return senders * messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="имитируемая задержка OpenAI")
+    parser.add_argument("--messages", type=int, default=10, help="сообщений от каждого отправителя")
+    parser.add_argument("--senders", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    print(f"{'senders':>8} {'global msg/s':>14} {'per-chat msg/s':>15} {'speedup':>8}")
+    for n in args.senders:
+        global_rate = run(GlobalLock(), n, args.messages, latency)
+        locks = KeyedLock()
+        keyed_rate = run(locks, n, args.messages, latency)
+        print(f"{n:>8} {global_rate:>14.1f} {keyed_rate:>15.1f} {keyed_rate / global_rate:>7.1f}x")
+        assert len(locks) == 0, "после обработки остались записи чатов"
+
+    order = check_fifo()
+    print(f"порядок ожидающих одного чата: {'FIFO' if order else 'НАРУШЕН'}")
+    if not order:
+        raise SystemExit(1)
+
+
+def check_fifo(waiters: int = 20) -> bool:
+    """Потоки, вставшие в очередь одного чата по порядку, получают блокировку в том же порядке."""
+    locks = KeyedLock()
+    served = []
+    locks.acquire("chat")
+    threads = []
+    for i in range(waiters):
+        t = threading.Thread(target=lambda i=i: (locks.acquire("chat"), served.append(i), locks.release("chat")))
+        t.start()
+        threads.append(t)
+        # Ждём, пока поток возьмёт билет
+        while locks._entries["chat"].next_ticket < i + 2:
+            time.sleep(0.001)
+    locks.release("chat")
+    for t in threads:
+        t.join()
+    return served == list(range(waiters)) and len(locks) == 0
+
+
+if __name__ == "__main__":
+    main()
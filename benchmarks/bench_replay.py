@@ -0,0 +1,316 @@
+"""
+Сквозной бенчмарк: воспроизведение вебхуков GreenAPI против create_app().
+
+Корпус — JSON-файлы вебхуков в формате GreenAPI (benchmarks/replay_corpus:
+входящие текстовые, extendedTextMessage, нетекстовые, игнорируемые события).
+GreenAPI и OpenAI подменены локальными заглушками (stub_servers.py)
+с настраиваемой задержкой и долей ошибок, каталог — синтетический снимок
+на диске, база состояния — временный файл. Вебхуки отправляются по HTTP
+в настоящий Flask-сервер. Один проход по корпусу — диалог одного виртуального
+пользователя со своим чатом и своими idMessage: сообщения диалога идут
+по очереди, параллельно идут разные диалоги (--concurrency).
+Файлы идут в порядке имён: просьба оформить заказ и нетекстовые сообщения
+переключают чат на менеджера, поэтому они в конце диалога.
+
+Отчёт: пропускная способность, p50/p95/p99 времени ответа на вебхук
+(всего и по статусу ответа), времени generate_response по веткам
+(приветствие, цена, рекомендация...), пиковый RSS процесса.
+С --output результаты пишутся в JSON для сравнения между прогонами.
+
+Запуск:
+    python benchmarks/bench_replay.py --requests 2000 --concurrency 16 \\
+        --openai-latency-ms 300 --openai-error-rate 0.02 --output replay.json
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import requests  # noqa: E402
+
+from stub_servers import GreenApiStub, OpenAIStub  # noqa: E402
+from synthetic_catalog import generate_products  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replay_corpus")
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))
+    return ordered[pos]
+
+
+def summarize(durations: List[float]) -> dict:
+    """Сводка по списку длительностей в секундах; результат — в миллисекундах."""
+    return {
+        "count": len(durations),
+        "p50_ms": round(percentile(durations, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(durations, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(durations, 0.99) * 1000, 2),
+        "max_ms": round(max(durations, default=0.0) * 1000, 2),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss — в килобайтах на Linux и в байтах на macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def load_corpus(path: str) -> List[dict]:
+    files = sorted(glob.glob(os.path.join(path, "*.json")))
+    if not files:
+        raise SystemExit(f"В {path} нет файлов вебхуков *.json")
+    corpus = []
+    for name in files:
+        with open(name, encoding="utf-8") as f:
+            corpus.append({"file": os.path.basename(name), "body": json.load(f)})
+    return corpus
+
+
+def personalize(body: dict, user: int, seq: int) -> dict:
+    """Копия вебхука от имени виртуального пользователя user с уникальным idMessage."""
+    body = json.loads(json.dumps(body))
+    chat_id = f"7701{user:07d}@c.us"
+    if "senderData" in body:
+        body["senderData"]["chatId"] = chat_id
+        body["senderData"]["sender"] = chat_id
+        body["senderData"]["senderName"] = f"Клиент {user}"
+    if "chatId" in body:
+        body["chatId"] = chat_id
+    if "idMessage" in body:
+        body["idMessage"] = f"BENCH{user:05d}{seq:08d}"
+    return body
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+class BranchRecorder:
+    """Обёртка generate_response: время вызова по ветке, которая ответила."""
+
+    def __init__(self, generate_response, last_branch):
+        self._generate = generate_response
+        self._last_branch = last_branch
+        self._lock = threading.Lock()
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+
+    def __call__(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._generate(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            branch = self._last_branch() or "unknown"
+            with self._lock:
+                self.durations[branch].append(elapsed)
+
+    def calls(self) -> int:
+        with self._lock:
+            return sum(len(values) for values in self.durations.values())
+
+
+def prepare_environment(args, workdir: str, greenapi_url: str, openai_url: str):
+    """Переменные окружения для create_app(): заглушки вместо внешних сервисов, всё во временной папке."""
+    from app.services.catalog_manager import CatalogManager
+
+    snapshot_path = os.path.join(workdir, "catalog_snapshot.pkl")
+    catalog = CatalogManager(lambda: None)
+    catalog.publish(generate_products(args.catalog_size))
+    catalog.save(snapshot_path)
+
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "OPENAI_TRANSPORT": args.transport,
+        "OPENAI_MAX_CONCURRENCY": str(args.openai_concurrency),
+        "GREENAPI_API_URL": greenapi_url,
+        "GREENAPI_IDINSTANCE": "1101000001",
+        "GREENAPI_APITOKEN": "bench",
+        "MANAGER_WAID": "77000000001",
+        "STATE_DB_PATH": os.path.join(workdir, "bot_state.db"),
+        "CATALOG_SNAPSHOT_PATH": snapshot_path,
+        # Обновление из Google Sheets в бенчмарке не нужно
+        "CATALOG_REFRESH_INTERVAL": "86400",
+        "WEBHOOK_ASYNC": "true" if args.mode == "async" else "false",
+        "WEBHOOK_WORKERS": str(args.workers),
+        "WEBHOOK_QUEUE_SIZE": str(args.queue_size),
+        "DEBOUNCE_MS": str(args.debounce_ms),
+        "MODE_CACHE_WARMUP": "false",
+    })
+
+
+def wait_until_idle(app, recorder: BranchRecorder, greenapi: GreenApiStub, timeout: float):
+    """В асинхронном режиме ждёт, пока очередь вебхуков и склейка сообщений опустеют."""
+    from app.services.message_debouncer import get_message_debouncer
+
+    deadline = time.monotonic() + timeout
+    previous = None
+    while time.monotonic() < deadline:
+        webhook_queue = app.extensions.get("webhook_queue")
+        queue_stats = webhook_queue.stats() if webhook_queue is not None else {"depth": 0, "busy_workers": 0}
+        debouncer = get_message_debouncer()
+        pending = debouncer.stats()["pending_chats"] if debouncer is not None else 0
+        state = (recorder.calls(), greenapi.stats()["requests"])
+        if not queue_stats["depth"] and not queue_stats["busy_workers"] and not pending and state == previous:
+            return
+        previous = state
+        time.sleep(0.2)
+    logging.warning("Обработка не завершилась за отведённое время, результаты неполные")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="папка с JSON-файлами вебхуков")
+    parser.add_argument("--requests", type=int, default=1000, help="всего вебхуков")
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных диалогов")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync", help="WEBHOOK_ASYNC выключен/включён")
+    parser.add_argument("--workers", type=int, default=4, help="WEBHOOK_WORKERS")
+    parser.add_argument("--queue-size", type=int, default=1000, help="WEBHOOK_QUEUE_SIZE")
+    parser.add_argument("--debounce-ms", type=float, default=0.0, help="DEBOUNCE_MS")
+    parser.add_argument("--transport", choices=("sdk", "http"), default="http", help="OPENAI_TRANSPORT")
+    parser.add_argument("--openai-concurrency", type=int, default=8, help="OPENAI_MAX_CONCURRENCY")
+    parser.add_argument("--openai-latency-ms", type=float, default=200.0)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--greenapi-latency-ms", type=float, default=50.0)
+    parser.add_argument("--greenapi-error-rate", type=float, default=0.0)
+    parser.add_argument("--catalog-size", type=int, default=2000, help="строк в синтетическом каталоге")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--drain-timeout", type=float, default=120.0, help="ожидание разбора очереди, с")
+    parser.add_argument("--output", help="куда записать результаты в JSON")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    greenapi = GreenApiStub(args.greenapi_latency_ms, args.greenapi_error_rate, seed=args.seed).start()
+    openai_stub = OpenAIStub(args.openai_latency_ms, args.openai_error_rate, seed=args.seed).start()
+    workdir = tempfile.TemporaryDirectory()
+    cwd = os.getcwd()
+    # app.log и прочие файлы сервиса пишутся во временную папку
+    os.chdir(workdir.name)
+    try:
+        prepare_environment(args, workdir.name, greenapi.url, openai_stub.url)
+
+        from werkzeug.serving import make_server
+        from app import create_app
+        from app.services.openai_service import last_branch
+        from app.utils import whatsapp_utils
+
+        app = create_app()
+        # Логи сервиса и werkzeug на каждый вебхук исказили бы замер
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+        recorder = BranchRecorder(whatsapp_utils.generate_response, last_branch)
+        whatsapp_utils.generate_response = recorder
+
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        server_thread = threading.Thread(target=server.serve_forever, name="bench-server", daemon=True)
+        server_thread.start()
+        url = f"http://127.0.0.1:{server.server_port}/webhook"
+
+        sessions = threading.local()
+        latencies: List[float] = []
+        by_status: Dict[str, List[float]] = defaultdict(list)
+        http_codes: Counter = Counter()
+        lock = threading.Lock()
+
+        def send(session: requests.Session, seq: int):
+            item = corpus[seq % len(corpus)]
+            body = personalize(item["body"], seq // len(corpus), seq)
+            started = time.perf_counter()
+            try:
+                response = session.post(url, json=body, timeout=60)
+                code = response.status_code
+                try:
+                    status = response.json().get("status", "")
+                except ValueError:
+                    status = ""
+            except requests.RequestException:
+                code, status = 0, "client_error"
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                by_status[status or str(code)].append(elapsed)
+                http_codes[code] += 1
+
+        def converse(user: int):
+            session = getattr(sessions, "session", None)
+            if session is None:
+                session = sessions.session = requests.Session()
+            for seq in range(user * len(corpus), min((user + 1) * len(corpus), args.requests)):
+                send(session, seq)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(converse, range(-(-args.requests // len(corpus)))))
+        sent_elapsed = time.perf_counter() - started
+        if args.mode == "async" or args.debounce_ms > 0:
+            wait_until_idle(app, recorder, greenapi, args.drain_timeout)
+        total_elapsed = time.perf_counter() - started
+
+        server.shutdown()
+        results = {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+            "corpus_files": len(corpus),
+            "elapsed_s": round(total_elapsed, 3),
+            "throughput_rps": round(args.requests / sent_elapsed, 1) if sent_elapsed else 0.0,
+            "processed_rps": round(recorder.calls() / total_elapsed, 1) if total_elapsed else 0.0,
+            "webhook": summarize(latencies),
+            "webhook_by_status": {status: summarize(values) for status, values in sorted(by_status.items())},
+            "http_codes": {str(code): count for code, count in sorted(http_codes.items())},
+            "branches": {branch: summarize(values) for branch, values in sorted(recorder.durations.items())},
+            "greenapi_stub": greenapi.stats(),
+            "openai_stub": openai_stub.stats(),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    finally:
+        os.chdir(cwd)
+        greenapi.stop()
+        openai_stub.stop()
+
+    print(f"{args.requests} вебхуков за {results['elapsed_s']} с, режим {args.mode}, "
+          f"параллельность {args.concurrency}")
+    print(f"пропускная способность: {results['throughput_rps']} вебхуков/с, "
+          f"обработано ходов: {results['processed_rps']}/с, пиковый RSS: {results['peak_rss_mb']} МБ")
+    print(f"HTTP-коды: {results['http_codes']}; OpenAI: {results['openai_stub']}; GreenAPI: {results['greenapi_stub']}")
+    print()
+    print(f"{'':<22} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = [("webhook", results["webhook"])]
+    rows += [(f"  status={status}", stats) for status, stats in results["webhook_by_status"].items()]
+    rows += [(f"branch {branch}", stats) for branch, stats in results["branches"].items()]
+    for name, stats in rows:
+        print(f"{name:<22} {stats['count']:>7} {stats['p50_ms']:>9} {stats['p95_ms']:>9} "
+              f"{stats['p99_ms']:>9} {stats['max_ms']:>9}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты записаны в {args.output}")
+    workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Бенчмарк холодного и тёплого старта каталога.
+
+Холодный старт — загрузка из Google Sheets (имитируется sleep-ом) и сборка
+снимка с индексами. Тёплый — чтение последнего снимка с диска
+(CatalogManager.load). Каталог синтетический, сеть не нужна.
+
+Запуск:
+    python benchmarks/bench_startup.py --products 1000 10000 --sheets-ms 1500
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Пакеты регистрируются без выполнения app/__init__.py: он тянет за собой
+# Flask, Google Sheets и OpenAI, которые для этого замера не нужны
+for _name, _path in (("app", ("app",)), ("app.services", ("app", "services"))):
+    _module = types.ModuleType(_name)
+    _module.__path__ = [os.path.join(ROOT, *_path)]
+    sys.modules.setdefault(_name, _module)
+
+from app.services.catalog_manager import CatalogManager, build_snapshot  # noqa: E402
+
+WORDS = ["noir", "rose", "oud", "bleu", "intense", "absolu", "velvet", "amber", "musk", "vanilla",
+         "night", "wood", "citrus", "leather", "iris", "santal", "fleur", "elixir", "sport", "aqua"]
+
+
+def synthetic_catalog(size: int, seed: int = 1):
+    rnd = random.Random(seed)
+    brands = [f"{rnd.choice(WORDS)} {rnd.choice(WORDS)} house {i}" for i in range(max(1, size // 20))]
+    products = []
+    for i in range(size):
+        products.append({
+            "name": f"{rnd.choice(WORDS)} {rnd.choice(WORDS)} {i}",
+            "brand": rnd.choice(brands),
+            "price": rnd.randint(5, 300) * 100,
+            "type": "spilled" if i % 3 == 0 else "full",
+        })
+    return products
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--sheets-ms", type=float, default=1500.0, help="имитируемая загрузка из Google Sheets")
+    args = parser.parse_args()
+
+    print(f"{'products':>9} {'cold s':>9} {'warm s':>9} {'file KB':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.products:
+            products = synthetic_catalog(size)
+            path = os.path.join(tmp, f"catalog_{size}.pkl")
+
+            started = time.perf_counter()
+            time.sleep(args.sheets_ms / 1000)
+            build_snapshot(products, version=1)
+            cold = time.perf_counter() - started
+
+            writer = CatalogManager(lambda: None)
+            writer.publish(products)
+            writer.save(path)
+
+            reader = CatalogManager(lambda: None)
+            started = time.perf_counter()
+            assert reader.load(path)
+            warm = time.perf_counter() - started
+            assert len(reader.current()) == size
+
+            size_kb = os.path.getsize(path) / 1024
+            print(f"{size:>9} {cold:>9.3f} {warm:>9.3f} {size_kb:>9.0f} {cold / warm:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Проверка бюджета времени импорта пакета app.
+
+Импортирует app в отдельном процессе с `python -X importtime` (из пустого
+временного каталога) и проверяет, что:
+  * суммарное время импорта app не больше бюджета (лучший из --runs запусков);
+  * импорт не запускает потоков, не настраивает корневой логгер
+    и не создаёт файлов (база состояния, снимок каталога, логи).
+Завершается с кодом 1, если что-то из этого нарушено, — годится для CI.
+
+Запуск:
+    python benchmarks/check_import_time.py --budget-ms 500 --top 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, logging, os, threading
+import app
+print(json.dumps({
+    "threads": sorted(t.name for t in threading.enumerate()),
+    "root_handlers": len(logging.getLogger().handlers),
+    "files": sorted(os.listdir(".")),
+}))
+"""
+
+
+def import_once(workdir: str):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=workdir, env=env, capture_output=True, text=True, check=True,
+    )
+    # Строки вида "import time:  self [us] | cumulative | package"
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line.split(":", 1)[1].split("|"))
+        modules[name] = (int(self_us), int(cumulative_us))
+    return modules, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=500.0, help="допустимое время импорта app")
+    parser.add_argument("--runs", type=int, default=3, help="запусков; берётся самый быстрый")
+    parser.add_argument("--top", type=int, default=10, help="сколько самых долгих модулей показать")
+    args = parser.parse_args()
+
+    best_ms, best_modules, probe = None, None, None
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            modules, probe = import_once(workdir)
+        total_ms = modules["app"][1] / 1000
+        if best_ms is None or total_ms < best_ms:
+            best_ms, best_modules = total_ms, modules
+
+    print(f"{'cumulative ms':>14}  module")
+    slowest = sorted(best_modules.items(), key=lambda item: item[1][1], reverse=True)[:args.top]
+    for name, (_, cumulative_us) in slowest:
+        print(f"{cumulative_us / 1000:>14.1f}  {name}")
+
+    problems = []
+    if best_ms > args.budget_ms:
+        problems.append(f"импорт app занял {best_ms:.0f} мс при бюджете {args.budget_ms:.0f} мс")
+    if probe["threads"] != ["MainThread"]:
+        problems.append(f"при импорте запущены потоки: {probe['threads']}")
+    if probe["root_handlers"]:
+        problems.append(f"при импорте настроен корневой логгер ({probe['root_handlers']} обработчиков)")
+    if probe["files"]:
+        problems.append(f"при импорте созданы файлы: {probe['files']}")
+
+    print(f"\nimport app: {best_ms:.0f} ms (бюджет {args.budget_ms:.0f} ms)")
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Проверка: выключенное DEBUG-логирование не делает работы по сериализации.
+
+Через настоящий обработчик /webhook и process_greenapi_message проходят
+игнорируемые вебхуки — те самые пути, где раньше JSON вебхука собирался
+через json.dumps(..., indent=2) ещё до проверки уровня. Модулям app.views
+и app.utils.logs подставляется считающий json, и проверяется, что:
+  * при LOG_LEVEL=INFO json.dumps не вызывается ни разу;
+  * при DEBUG для модулей app сериализация есть (проверка сама себя);
+  * каждая запись на выходе — одна строка JSON с level, logger и message.
+Также замеряется цена одного выключенного logger.debug с LazyJSON и с
+прежним f-строчным вызовом. Завершается с кодом 1 при нарушении — годится для CI.
+
+Запуск:
+    python benchmarks/check_lazy_logging.py
+"""
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask import Flask  # noqa: E402
+
+import app.utils.logs as logs  # noqa: E402
+import app.views as views  # noqa: E402
+from app.utils.logs import LazyJSON, setup_logging, stop_logging  # noqa: E402
+from app.utils.whatsapp_utils import process_greenapi_message  # noqa: E402
+
+WEBHOOKS = [
+    {"typeWebhook": "outgoingMessageStatus", "chatId": "77010000001@c.us", "idMessage": "BAE5367237E13A87",
+     "status": "delivered", "instanceData": {"idInstance": 1101000001, "wid": "77000000000@c.us"}},
+    {"typeWebhook": "stateInstanceChanged", "stateInstance": "authorized",
+     "instanceData": {"idInstance": 1101000001, "wid": "77000000000@c.us"}},
+]
+
+
+class CountingJSON:
+    """Модуль json, который считает вызовы dumps."""
+
+    def __init__(self):
+        self.dumps_calls = 0
+
+    def dumps(self, *args, **kwargs):
+        self.dumps_calls += 1
+        return json.dumps(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(json, name)
+
+
+def run_webhooks(flask_app: Flask, rounds: int = 20) -> int:
+    """Прогоняет вебхуки через /webhook и process_greenapi_message; возвращает число json.dumps."""
+    counting = CountingJSON()
+    views.json, logs.json = counting, counting
+    try:
+        client = flask_app.test_client()
+        for _ in range(rounds):
+            for body in WEBHOOKS:
+                response = client.post("/webhook", data=json.dumps(body), content_type="application/json")
+                assert response.status_code == 200, response.status_code
+                with flask_app.app_context():
+                    process_greenapi_message(body)
+    finally:
+        views.json, logs.json = json, json
+    return counting.dumps_calls
+
+
+def configured(level: str, levels: str, log_file: str) -> io.StringIO:
+    output = io.StringIO()
+    with redirect_stdout(output):
+        setup_logging(level=level, levels=levels, fmt="json", log_file=log_file)
+    return output
+
+
+def cost_per_call(call, count: int = 100000) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        call()
+    return (time.perf_counter() - started) / count * 1e9
+
+
+def main():
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(views.webhook_blueprint)
+    failures = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log_file = os.path.join(tmp, "app.log")
+
+        configured("INFO", "", log_file)
+        disabled_dumps = run_webhooks(flask_app)
+        print(f"DEBUG выключен: json.dumps вызван {disabled_dumps} раз")
+        if disabled_dumps:
+            failures.append(f"при выключенном DEBUG json.dumps вызван {disabled_dumps} раз")
+
+        output = configured("INFO", "app=DEBUG", log_file)
+        enabled_dumps = run_webhooks(flask_app, rounds=1)
+        stop_logging()
+        print(f"DEBUG для app включён: json.dumps вызван {enabled_dumps} раз")
+        if not enabled_dumps:
+            failures.append("при включённом DEBUG сериализации нет — проверка ничего не проверяет")
+
+        records = output.getvalue().splitlines()
+        for line in records:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                failures.append(f"запись не в JSON: {line[:80]}")
+                break
+            if not {"ts", "level", "logger", "message"} <= record.keys():
+                failures.append(f"в записи нет обязательных полей: {line[:80]}")
+                break
+        print(f"записей в JSON: {len(records)}")
+
+    logger = logging.getLogger("app.check")
+    logger.setLevel(logging.INFO)
+    body = WEBHOOKS[0]
+    lazy_ns = cost_per_call(lambda: logger.debug("Webhook received: %s", LazyJSON(body, indent=2)))
+    eager_ns = cost_per_call(
+        lambda: logger.debug(f"Webhook received: {json.dumps(body, indent=2, ensure_ascii=False)}"), 20000)
+    print(f"выключенный logger.debug: LazyJSON {lazy_ns:.0f} нс, f-строка с json.dumps {eager_ns:.0f} нс")
+
+    if failures:
+        for failure in failures:
+            print(f"ОШИБКА: {failure}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
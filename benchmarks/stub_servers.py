@@ -0,0 +1,118 @@
+"""
+Локальные заглушки GreenAPI и OpenAI для бенчмарков.
+
+Обе отвечают в формате настоящих API, с настраиваемой задержкой и долей
+ошибок, и считают запросы. Запускаются в потоках текущего процесса.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    """Базовая заглушка: ThreadingHTTPServer на свободном порту 127.0.0.1."""
+
+    def __init__(self, latency_ms: float = 0.0, error_rate: float = 0.0, seed: int = 1):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                status, payload, headers = stub._respond(self.path, body)
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _respond(self, path: str, body: dict):
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return self.error_response()
+        return 200, self.ok_payload(path, body), {}
+
+    def error_response(self):
+        return 500, {"error": "stub failure"}, {}
+
+    def ok_payload(self, path: str, body: dict) -> dict:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors}
+
+
+class GreenApiStub(StubServer):
+    """POST /waInstance{id}/SendMessage/{token} -> {"idMessage": ...}."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = []
+
+    def ok_payload(self, path: str, body: dict) -> dict:
+        with self._lock:
+            self.sent.append((body.get("chatId"), body.get("message")))
+        return {"idMessage": uuid.uuid4().hex.upper()}
+
+
+class OpenAIStub(StubServer):
+    """POST /v1/chat/completions -> ответ в формате chat.completion. Ошибки — вперемешку 429 и 500."""
+
+    def error_response(self):
+        if self._random.random() < 0.5:
+            return 429, {"error": {"message": "Rate limit reached", "type": "requests"}}, {"Retry-After": "0.05"}
+        return 500, {"error": {"message": "stub failure", "type": "server_error"}}, {}
+
+    def ok_payload(self, path: str, body: dict) -> dict:
+        question = body.get("messages", [{}])[-1].get("content", "")
+        content = f"Рекомендуем обратить внимание на ароматы из нашего каталога. ({question[:40]})"
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
@@ -0,0 +1,95 @@
+"""
+Генератор синтетического каталога в формате строк Google Sheets.
+
+Строки выглядят как листы "original" и "spilled": поля name, brand, volume,
+cost, country, description. Популярность брендов убывает по закону Ципфа
+(у нескольких брендов большая часть ассортимента), названия смешивают
+латиницу, русский и казахский, около 40% позиций — на разлив, около 3%
+строк — дубликаты, как в живой таблице.
+
+    from synthetic_catalog import generate_sheets, generate_products
+    sheets = generate_sheets(10000)          # {"original": [...], "spilled": [...]}
+    products = generate_products(10000)      # подготовленный список, как после load_catalog
+"""
+import random
+from typing import Dict, List
+
+BRANDS = [
+    "Dior", "Chanel", "Tom Ford", "Giorgio Armani", "Yves Saint Laurent", "Versace", "Gucci",
+    "Dolce & Gabbana", "Lancome", "Guerlain", "Kilian", "Byredo", "Montale", "Mancera", "Creed",
+    "Hugo Boss", "Paco Rabanne", "Jo Malone", "Maison Francis Kurkdjian", "Carolina Herrera",
+    "Givenchy", "Prada", "Valentino", "Burberry", "Bvlgari", "Hermes", "Xerjoff", "Amouage",
+    "Lattafa", "Ajmal", "Zara", "Escentric Molecules", "Juliette Has A Gun", "Initio", "Nishane",
+    "Мон Парфюм", "Новая Заря", "Брокар", "Дзинтарс", "Алтын Дала", "Қазақ Иіс", "Дала Гүлі",
+]
+LATIN_WORDS = [
+    "sauvage", "noir", "rose", "oud", "bleu", "bloom", "intense", "night", "gold", "black", "wood",
+    "vanilla", "musk", "amber", "fleur", "eau", "absolu", "elixir", "santal", "velvet", "cherry",
+    "tobacco", "leather", "iris", "neroli", "aqua", "sport", "privee", "royal", "imperial",
+]
+RU_WORDS = [
+    "ночь", "роза", "жасмин", "бархат", "янтарь", "мускус", "ваниль", "сандал", "лаванда",
+    "красная", "москва", "сирень", "весна", "шёлк", "пион", "кедр",
+]
+KZ_WORDS = ["гүл", "дала", "түн", "алтын", "жібек", "ай", "күн", "таң", "бақ", "сұлу"]
+COUNTRIES = ["Франция", "Италия", "США", "ОАЭ", "Великобритания", "Испания", "Россия", "Казахстан"]
+DESCRIPTIONS = [
+    "сладкий", "цветочный", "свежий", "древесный", "восточный", "цитрусовый", "пряный",
+    "пудровый", "фруктовый", "кожаный", "морской", "гурманский",
+]
+ORIGINAL_VOLUMES = [30, 50, 50, 75, 90, 100, 100, 100, 125, "100 ml", "50ml"]
+
+
+def _brand_weights(count: int) -> List[float]:
+    return [1 / (rank + 1) for rank in range(count)]
+
+
+def _name(rnd: random.Random, brand: str) -> str:
+    if brand in ("Мон Парфюм", "Новая Заря", "Брокар", "Дзинтарс"):
+        pool = RU_WORDS
+    elif brand in ("Алтын Дала", "Қазақ Иіс", "Дала Гүлі"):
+        pool = KZ_WORDS
+    else:
+        pool = LATIN_WORDS
+    words = rnd.sample(pool, rnd.choice((1, 2, 2, 3)))
+    if rnd.random() < 0.1:
+        words.append(str(rnd.randint(1, 99)))
+    return " ".join(words)
+
+
+def generate_sheets(size: int, seed: int = 1, spilled_share: float = 0.4,
+                    duplicate_share: float = 0.03) -> Dict[str, List[dict]]:
+    """Строки обоих листов, всего size строк."""
+    rnd = random.Random(seed)
+    weights = _brand_weights(len(BRANDS))
+    sheets: Dict[str, List[dict]] = {"original": [], "spilled": []}
+    rows: List[tuple] = []
+    for _ in range(size):
+        if rows and rnd.random() < duplicate_share:
+            sheet, row = rnd.choice(rows)
+            sheets[sheet].append(dict(row))
+            continue
+        brand = rnd.choices(BRANDS, weights)[0]
+        spilled = rnd.random() < spilled_share
+        row = {
+            "name": _name(rnd, brand),
+            "brand": brand if rnd.random() > 0.01 else f" {brand} ",
+            "volume": "" if spilled else rnd.choice(ORIGINAL_VOLUMES),
+            "cost": rnd.randint(3, 60) * 100 if spilled else rnd.randint(15, 400) * 500,
+            "country": rnd.choice(COUNTRIES),
+            "description": ", ".join(rnd.sample(DESCRIPTIONS, 2)),
+        }
+        sheet = "spilled" if spilled else "original"
+        sheets[sheet].append(row)
+        rows.append((sheet, row))
+    return sheets
+
+
+def generate_products(size: int, seed: int = 1) -> List[dict]:
+    """Подготовленный каталог (как возвращает load_catalog) из size строк таблицы."""
+    from app.services.openai_service import deduplicate_products, prepare_products
+
+    sheets = generate_sheets(size, seed)
+    return deduplicate_products(
+        prepare_products(sheets["original"], "original") + prepare_products(sheets["spilled"], "spilled")
+    )